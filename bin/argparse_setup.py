@@ -65,6 +65,16 @@ class Argparse_Setup:
                 self.setup.set_base_branch(parsed_args.base_branch)
             del parsed_args.base_branch
 
+        if (parsed_args.index_cache):
+            if self.setup:
+                self.setup.set_index_cache(parsed_args.index_cache)
+            del parsed_args.index_cache
+
+        if (parsed_args.profile):
+            if self.setup:
+                self.setup.set_profiler(parsed_args.profile)
+            del parsed_args.profile
+
         # Parse repo option
         if (parsed_args.repo_verbose):
             if self.setup:
@@ -220,6 +230,13 @@ class Argparse_Setup:
             setup_base_branch = '(default %s)' % (self.setup.base_branch)
         self.base_args.add_argument('--base-branch', metavar="BRANCH", help='Base branch identifier %s' % (setup_base_branch))
 
+        setup_index_cache = ""
+        if self.setup and self.setup.index_cache:
+            setup_index_cache = '(default %s)' % (self.setup.index_cache)
+        self.base_args.add_argument('--index-cache', metavar="DIR", help='Directory where the layer index cache is shared between projects, may also be set with INDEX_CACHE %s' % (setup_index_cache))
+
+        self.base_args.add_argument('--profile', metavar="MODE", nargs='?', const='cpu', choices=['cpu', 'memory'], help='Profile setup with cProfile (cpu, the default) or also tracemalloc (memory), the reports are written to config/log, may also be set with SETUP_PROFILE')
+
         self.parser.add_argument('--mirror', help='Do not construct a project, instead construct a mirror of the repositories that would have been used to construct a project (requires a Layer Selection argument)', action='store_true')
     def add_repo_options(self):
         self.repo_args = self.parser.add_argument_group('repo Settings')
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# This program generates a synthetic, split mirror-index and times how long
+# it takes the Layer_Index to load it.  The mirror-index is laid out the
+# same way update_mirror_index writes it, one file per layerBranch, each
+# carrying the branch, the required layerBranches and their layerItems.
+# This is a developer tool, it is not used by setup.
+
+import argparse
+
+import os
+import sys
+
+import json
+import random
+import shutil
+import tempfile
+import time
+
+from layer_index import Layer_Index
+
+import logger_setup
+
+logger = logger_setup.setup_logging()
+
+DESCRIPTION = 'Benchmark Layer Index'
+BRANCH = 'master'
+
+def config_args(args):
+    parser = argparse.ArgumentParser(description='benchmark_layer_index.py: Time loading a synthetic mirror-index.')
+
+    parser.add_argument('--layers', help='Number of layers to generate (default 500)', type=int, default=500)
+    parser.add_argument('--recipes', help='Number of recipes to generate (default 50000)', type=int, default=50000)
+    parser.add_argument('--seed', help='Random seed used to generate the index', type=int, default=1)
+    parser.add_argument('--keep', metavar='DIR', help='Generate the mirror-index in DIR and keep it')
+    parser.add_argument('--repeat', help='Number of times to load the index', type=int, default=1)
+
+    return parser.parse_args(args)
+
+def generate_index(layers, recipes, seed):
+    r = random.Random(seed)
+
+    lindex = {}
+    lindex['CFG'] = { 'DESCRIPTION' : DESCRIPTION, 'TYPE' : 'restapi-files', 'URL' : '' }
+    lindex['branches'] = [ { 'id' : 1, 'name' : BRANCH, 'bitbake_branch' : BRANCH, 'updated' : '2017-01-01T00:00:00+0000' } ]
+    lindex['layerItems'] = []
+    lindex['layerBranches'] = []
+    lindex['layerDependencies'] = []
+    for i in range(1, layers + 1):
+        name = 'meta-layer%d' % i
+        lindex['layerItems'].append({ 'id' : i, 'name' : name, 'status' : 'P', 'layer_type' : 'A', 'summary' : name, 'description' : name,
+                                      'vcs_url' : 'git://git.example.com/%s' % name, 'vcs_web_url' : '', 'updated' : '2017-01-01T00:00:00+0000' })
+        lindex['layerBranches'].append({ 'id' : i, 'layer' : i, 'branch' : 1, 'collection' : 'layer%d' % i, 'vcs_subdir' : '', 'actual_branch' : '',
+                                         'vcs_last_rev' : '%040x' % r.getrandbits(160), 'updated' : '2017-01-01T00:00:00+0000' })
+        # Each layer depends on a few of the layers before it
+        for dep in r.sample(range(1, i), min(i - 1, 3)):
+            lindex['layerDependencies'].append({ 'id' : len(lindex['layerDependencies']) + 1, 'layerbranch' : i, 'dependency' : dep, 'required' : r.random() < 0.8 })
+
+    lindex['recipes'] = []
+    for i in range(1, recipes + 1):
+        lindex['recipes'].append({ 'id' : i, 'layerbranch' : r.randint(1, layers), 'filename' : 'recipe%d_1.0.bb' % i, 'filepath' : 'recipes-example/recipe%d' % i,
+                                   'pn' : 'recipe%d' % i, 'pv' : '1.0', 'summary' : 'recipe %d' % i, 'description' : 'recipe %d' % i, 'section' : 'base',
+                                   'license' : 'MIT', 'homepage' : '', 'updated' : '2017-01-01T00:00:00+0000' })
+
+    lindex['machines'] = []
+    lindex['distros'] = []
+    for i in range(1, layers + 1):
+        lindex['machines'].append({ 'id' : i, 'layerbranch' : i, 'name' : 'machine%d' % i, 'description' : 'machine %d' % i, 'updated' : '2017-01-01T00:00:00+0000' })
+        lindex['distros'].append({ 'id' : i, 'layerbranch' : i, 'name' : 'distro%d' % i, 'description' : 'distro %d' % i, 'updated' : '2017-01-01T00:00:00+0000' })
+
+    return lindex
+
+def write_mirror_index(lindex, path):
+    tables = {}
+    for entry in [ 'recipes', 'machines', 'distros', 'layerDependencies' ]:
+        tables[entry] = {}
+        for obj in lindex[entry]:
+            tables[entry].setdefault(obj['layerbranch'], []).append(obj)
+
+    layerItems = {}
+    for li in lindex['layerItems']:
+        layerItems[li['id']] = li
+
+    layerBranches = {}
+    for lb in lindex['layerBranches']:
+        layerBranches[lb['id']] = lb
+
+    os.makedirs(path, exist_ok=True)
+    for lb in lindex['layerBranches']:
+        pindex = {}
+        pindex['CFG'] = lindex['CFG']
+        pindex['branches'] = lindex['branches']
+        for entry in tables:
+            pindex[entry] = tables[entry].get(lb['id'], [])
+
+        pindex['layerBranches'] = [lb]
+        for dep in pindex['layerDependencies']:
+            if dep['required'] and layerBranches[dep['dependency']] not in pindex['layerBranches']:
+                pindex['layerBranches'].append(layerBranches[dep['dependency']])
+        pindex['layerItems'] = [ layerItems[p_lb['layer']] for p_lb in pindex['layerBranches'] ]
+
+        fname = os.path.join(path, '%s__%s.json' % (BRANCH, layerItems[lb['layer']]['name']))
+        json.dump(pindex, open(fname, 'wt'), indent=4)
+
+def main():
+    args = config_args(sys.argv[1:])
+
+    if args.keep:
+        path = args.keep
+    else:
+        path = tempfile.mkdtemp(prefix='benchmark_layer_index.')
+
+    try:
+        logger.plain('Generating %d layers and %d recipes in %s...' % (args.layers, args.recipes, path))
+        write_mirror_index(generate_index(args.layers, args.recipes, args.seed), path)
+
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            index = Layer_Index(indexcfg=[{ 'DESCRIPTION' : DESCRIPTION, 'TYPE' : 'restapi-files', 'URL' : '' }], base_branch=BRANCH, mirror=path)
+            times.append(time.perf_counter() - start)
+
+        lindex = index.index[0]
+        logger.plain('Loaded %d layerBranches and %d recipes.' % (len(lindex['layerBranches']), len(lindex['recipes'])))
+        logger.plain('Load time: best %.3fs, worst %.3fs over %d run(s).' % (min(times), max(times), len(times)))
+    finally:
+        if not args.keep:
+            shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
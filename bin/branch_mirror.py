@@ -50,6 +50,9 @@ if len(sys.argv) < 2:
 
 logger = logger_setup.setup_logging()
 
+# Run from the mirror, so the reports go to its log directory
+utils_setup.start_profiling('config/log', 'branch_mirror', os.getenv(utils_setup.PROFILE_ENV))
+
 dest_branch = sys.argv[1]
 
 force = False
@@ -65,7 +68,7 @@ if not os.path.exists(mirror_path):
     sys.exit(1)
 
 cmd = ['git', 'rev-parse', '--abbrev-ref', 'HEAD']
-ret = subprocess.Popen(cmd, cwd=mirror_path, close_fds=True, stdout=subprocess.PIPE)
+ret = utils_setup.Popen(cmd, cwd=mirror_path, close_fds=True, stdout=subprocess.PIPE)
 branch = ""
 output = ""
 while True:
@@ -173,6 +176,7 @@ for lindex in index.index:
                 bitbake_branch = branches['bitbake_branch']
                 branches['bitbake_branch'] = dest_branch
             branchid = branches['id']
+    index.reindex(lindex)
 
     for layer in lindex['layerItems']:
         if layer['vcs_url']:
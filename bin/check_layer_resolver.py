@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# This program compares the layer resolution of setup (Setup.resolve_layers)
+# with the original implementation, on recorded indexes.  Each index is a
+# serialized index (a json file, or a directory of them), listed in INDEXES
+# order.  The resolution is run once for every layer available on the
+# branch, starting from BASE_LAYERS plus that layer, and once starting from
+# all of them (as --all-layers does).  The resulting required and
+# recommended layers must match exactly.
+# With --record, the resolutions of the original implementation are saved
+# instead, test/test_layer_resolver.py checks setup against those.
+# This is a developer tool, it is not used by setup.
+
+import argparse
+
+import json
+import logging
+import os
+import sys
+
+import time
+
+from collections import deque, OrderedDict
+
+from layer_index import Layer_Index
+from setup import Setup
+
+import logger_setup
+import settings
+
+logger = logger_setup.setup_logging()
+
+def config_args(args):
+    parser = argparse.ArgumentParser(description='check_layer_resolver.py: Compare the layer resolution with the original implementation.')
+
+    parser.add_argument('indexes', metavar='INDEX', nargs='+', help='Serialized index (file or directory), in INDEXES order')
+    parser.add_argument('--branch', help='Branch to resolve the layers on (default master)', default='master')
+    parser.add_argument('--dl-layers', help='Include the download layers', action='store_true')
+    parser.add_argument('--layers', metavar='LAYER', nargs='+', help='Only start from these layers')
+    parser.add_argument('--verbose', help='Show the messages logged during the resolution', action='store_true')
+    parser.add_argument('--record', metavar='FILE', help='Write the resolutions of the original implementation to FILE, instead of comparing them')
+
+    return parser.parse_args(args)
+
+# The original implementation of Setup.process_layers, which looked up every
+# dequeued layer in all of the earlier indexes.
+def reference_resolve_layers(setup, requiredQueue, recommendedQueue):
+    depCacheCol = []
+    depCacheName = []
+
+    def checkCache(lindex, layerBranch, addCache=False):
+        (collection, name, vcs_url) = setup.index.getLayerInfo(lindex, layerBranch=layerBranch)
+
+        if collection in depCacheCol or name in depCacheName:
+            return True
+
+        if addCache:
+            if collection:
+                depCacheCol.append(collection)
+            if name:
+                depCacheName.append(name)
+        return False
+
+    def resolveIndexOrder(lindex, layerBranch, Queue):
+        (collection, name, vcs_url) = setup.index.getLayerInfo(lindex, layerBranch)
+        for pindex in setup.index.index:
+            if pindex == lindex:
+                break
+
+            pbranchid = setup.index.getBranchId(pindex, setup.get_branch(lindex=pindex))
+            if collection:
+                new_layerBranches = setup.index.getLayerBranch(pindex, pbranchid, collection=collection)
+                if new_layerBranches and new_layerBranches != []:
+                    for lb in new_layerBranches:
+                        Queue.append( (pindex, lb) )
+                    lindex = None
+                    layerBranch = None
+                    break
+
+            if name:
+                new_layerBranches = setup.index.getLayerBranch(pindex, pbranchid, name=name)
+                if new_layerBranches and new_layerBranches != []:
+                    for lb in new_layerBranches:
+                        Queue.append( (pindex, lb) )
+                    lindex = None
+                    layerBranch = None
+                    break
+
+        return (lindex, layerBranch)
+
+    while requiredQueue:
+        (lindex, layerBranch) = requiredQueue.popleft()
+
+        (lindex, layerBranch) = resolveIndexOrder(lindex, layerBranch, requiredQueue)
+
+        if not lindex or not layerBranch:
+            continue
+
+        if not checkCache(lindex, layerBranch, True):
+            setup.requiredlayers.append( (lindex, layerBranch) )
+            (required, recommended) = setup.index.getDependencies(lindex, layerBranch)
+            for dep in required:
+                requiredQueue.append( (lindex, dep) )
+
+            for dep in recommended:
+                recommendedQueue.append( (lindex, dep) )
+
+    while recommendedQueue:
+        (lindex, layerBranch) = recommendedQueue.popleft()
+
+        (lindex, layerBranch) = resolveIndexOrder(lindex, layerBranch, recommendedQueue)
+
+        if not lindex or not layerBranch:
+            continue
+
+        if not checkCache(lindex, layerBranch, True):
+            if setup.dl_layers != True:
+                layers = setup.index.find_layer(lindex, id=layerBranch['layer'])
+                if layers and ('-dl-' in layers[0]['name'] or layers[0]['name'].endswith('-dl')):
+                    continue
+            setup.recommendedlayers.append( (lindex, layerBranch) )
+            (required, recommended) = setup.index.getDependencies(lindex, layerBranch)
+            for dep in required + recommended:
+                recommendedQueue.append( (lindex, dep) )
+
+def describe(setup, layers):
+    result = []
+    for (lindex, layerBranch) in layers:
+        for layer in setup.index.find_layer(lindex, layerBranch=layerBranch):
+            result.append('%s:%s' % (lindex['CFG']['DESCRIPTION'], layer['name']))
+    return result
+
+# Returns a Setup with the serialized indexes (named after their file) loaded,
+# or None if none of them could be loaded
+def load_setup(paths, branch, dl_layers):
+    indexcfg = []
+    for path in paths:
+        indexcfg.append({ 'DESCRIPTION' : os.path.basename(path), 'TYPE' : 'restapi-files', 'URL' : os.path.abspath(path) })
+
+    index = Layer_Index(indexcfg=indexcfg, base_branch=branch)
+    if not index.index:
+        return None
+
+    setup = Setup()
+    setup.index = index
+    setup.base_branch = branch
+    setup.dl_layers = dl_layers
+    return setup
+
+# Returns the base layers and [(name, [(lindex, layerBranch)])] of the
+# resolutions to run, one per layer on the branch (or in layers) and then
+# all of them together
+def get_starts(setup, layers=None):
+    index = setup.index
+
+    # Same as process_layers, the base layers only come from the first index
+    base = []
+    lindex = index.index[0]
+    branchid = index.getBranchId(lindex, setup.get_branch(lindex=lindex))
+    if branchid:
+        for lname in settings.BASE_LAYERS.split():
+            for lb in index.getLayerBranch(lindex, branchid, name=lname) or []:
+                base.append( (lindex, lb) )
+
+    starts = []
+    for lindex in index.index:
+        branchid = index.getBranchId(lindex, setup.get_branch(lindex=lindex))
+        if not branchid:
+            continue
+        for lb in lindex['layerBranches']:
+            if lb['branch'] != branchid:
+                continue
+            for layer in index.find_layer(lindex, layerBranch=lb):
+                if not layers or layer['name'] in layers:
+                    starts.append( ('%s:%s' % (lindex['CFG']['DESCRIPTION'], layer['name']), [ (lindex, lb) ]) )
+    starts.append( ('all layers', [ start for (_, queue) in starts for start in queue ]) )
+
+    return (base, starts)
+
+# Run resolve (reference_resolve_layers or Setup.resolve_layers) from queue,
+# returns the (required, recommended) layers and the time it took.
+def resolve(setup, resolve, base, queue, verbose=False):
+    setup.requiredlayers = []
+    setup.recommendedlayers = []
+
+    level = logger.level
+    if not verbose:
+        logger.setLevel(logging.WARNING)
+    start = time.perf_counter()
+    try:
+        resolve(setup, deque(base + queue), deque([]))
+    finally:
+        logger.setLevel(level)
+
+    return ((describe(setup, setup.requiredlayers), describe(setup, setup.recommendedlayers)), time.perf_counter() - start)
+
+def main():
+    args = config_args(sys.argv[1:])
+
+    setup = load_setup(args.indexes, args.branch, args.dl_layers)
+    if not setup:
+        logger.critical('No indexes were loaded.')
+        sys.exit(1)
+
+    (base, starts) = get_starts(setup, args.layers)
+
+    if args.record:
+        # The results of the original implementation, see test/test_layer_resolver.py
+        resolutions = OrderedDict()
+        for (name, queue) in starts:
+            ((required, recommended), _) = resolve(setup, reference_resolve_layers, base, queue, args.verbose)
+            resolutions[name] = { 'required' : required, 'recommended' : recommended }
+        record = OrderedDict()
+        record['indexes'] = [ os.path.relpath(path, os.path.dirname(os.path.abspath(args.record))) for path in args.indexes ]
+        record['branch'] = args.branch
+        record['dl_layers'] = args.dl_layers
+        record['resolutions'] = resolutions
+        with open(args.record, 'w') as f:
+            json.dump(record, f, indent=4)
+            f.write('\n')
+        logger.plain('Recorded %d resolution(s) to %s.' % (len(starts), args.record))
+        return
+
+    failed = 0
+    times = { reference_resolve_layers : 0, Setup.resolve_layers : 0 }
+    for (name, queue) in starts:
+        results = []
+        for resolver in [ reference_resolve_layers, Setup.resolve_layers ]:
+            (result, elapsed) = resolve(setup, resolver, base, queue, args.verbose)
+            times[resolver] += elapsed
+            results.append(result)
+
+        if results[0] != results[1]:
+            failed += 1
+            logger.error('%s resolves differently' % (name))
+            logger.error('  original: required %s, recommended %s' % (' '.join(results[0][0]), ' '.join(results[0][1])))
+            logger.error('  resolver: required %s, recommended %s' % (' '.join(results[1][0]), ' '.join(results[1][1])))
+
+    logger.plain('Compared %d resolution(s) from %d index(es), %d difference(s).' % (len(starts), len(setup.index.index), failed))
+    logger.plain('Resolve time: original %.3fs, resolver %.3fs.' % (times[reference_resolve_layers], times[Setup.resolve_layers]))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
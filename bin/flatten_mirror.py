@@ -285,7 +285,7 @@ def main():
 
     # Find the base branch of the mirror-index to set a default
     cmd = ['git', 'rev-parse', '--abbrev-ref', 'HEAD']
-    _ret = subprocess.Popen(cmd, cwd=mirror_path, close_fds=True, stdout=subprocess.PIPE)
+    _ret = utils_setup.Popen(cmd, cwd=mirror_path, close_fds=True, stdout=subprocess.PIPE)
     branch = ""
     output = ""
     while True:
@@ -534,5 +534,8 @@ if __name__ == '__main__':
 
     setup_dir = os.path.dirname(os.path.dirname(sys.argv[0]))
 
+    # Run from the mirror, so the reports go to its log directory
+    utils_setup.start_profiling('config/log', 'flatten_mirror', os.getenv(utils_setup.PROFILE_ENV))
+
     ret = main()
     sys.exit(ret)
@@ -18,6 +18,18 @@ import json
 import sys
 import os
 import difflib
+import re
+
+import hashlib
+import pickle
+import stat
+import struct
+
+import concurrent.futures
+import datetime
+import fcntl
+import functools
+import time
 
 
 from collections import OrderedDict
@@ -34,43 +46,135 @@ import texttable as tt
 #        export        - Exported DB from a LayerIndex-web -- reads file(s)
 
 logger = logger_setup.setup_logging()
+
+# Binary index cache, see serialize_binary_index()
+BINARY_MAGIC = b'WRLIDX\n'
+BINARY_VERSION = 1
+
+# Entries of the binary cache that are only loaded when they are used
+LAZY_ENTRIES = ['recipes']
+
+class Lazy_Index(dict):
+    """
+        A REST-API index (dictionary) where some entries are only loaded
+        the first time they are used.  Entries that are not loaded yet keep
+        their place in the index and are still visible (in, iteration, keys,
+        len); anything that reads them (lindex[entry], get, items, values)
+        loads them.
+
+        Deferred entries are loaded from the source of the index (fetched,
+        or parsed) instead of a cache, they are not written to the index
+        caches until they are loaded.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.loaders = {}
+        self.deferred = set()
+
+    # loader() is called, with no arguments, to load entry
+    def set_loader(self, entry, loader):
+        dict.__setitem__(self, entry, None)
+        self.loaders[entry] = loader
+        self.deferred.discard(entry)
+
+    # Same as set_loader, for a loader that loads entry from the source
+    def defer(self, entry, loader):
+        self.set_loader(entry, loader)
+        self.deferred.add(entry)
+
+    def is_loaded(self, entry):
+        return entry not in self.loaders
+
+    def is_deferred(self, entry):
+        return entry in self.deferred
+
+    def load(self, entry):
+        if entry in self.loaders:
+            dict.__setitem__(self, entry, self.loaders[entry]())
+            del self.loaders[entry]
+            self.deferred.discard(entry)
+
+    def __getitem__(self, entry):
+        self.load(entry)
+        return dict.__getitem__(self, entry)
+
+    def __setitem__(self, entry, value):
+        self.loaders.pop(entry, None)
+        self.deferred.discard(entry)
+        dict.__setitem__(self, entry, value)
+
+    def __delitem__(self, entry):
+        self.loaders.pop(entry, None)
+        self.deferred.discard(entry)
+        dict.__delitem__(self, entry)
+
+    def get(self, entry, default=None):
+        if entry in self:
+            return self[entry]
+        return default
+
+    def items(self):
+        for entry in list(self.loaders):
+            self.load(entry)
+        return dict.items(self)
+
+    def values(self):
+        for entry in list(self.loaders):
+            self.load(entry)
+        return dict.values(self)
+
+# Number of REST API endpoints fetched at the same time
+FETCH_JOBS = 4
+
+# Maximum number of ids in each layerItems request
+LAYERITEMS_CHUNK = 100
+
+# Number of processes used to parse the files of a mirror-index
+LOAD_JOBS = os.cpu_count() or 1
+
+# Seconds a remote index in the shared cache is used without fetching it again
+SHARED_CACHE_TTL = 10 * 60
+
+# Size of the reads while parsing a Django export, see __iterDjangoExport
+DJANGO_READ_SIZE = 1024 * 1024
+
+# JSON whitespace, and the separator between the objects of an array
+JSON_WS_RE = re.compile(r'[ \t\n\r]*')
+JSON_SEP_RE = re.compile(r'[ \t\n\r]*,?[ \t\n\r]*')
+
 class Layer_Index():
     # Index in REST-API format...  This is used by external items.
     index = []
 
-    def __init__(self, indexcfg=[], base_branch=None, replace=[], mirror=None):
+    def __init__(self, indexcfg=[], base_branch=None, replace=[], mirror=None, database=None, shared_cache=None):
         self.index = []
 
-        # Do we have local mirror entries to load?
-        m_index = {}
+        # id and name keyed lookup tables for each loaded index, see reindex()
+        self.lookups = {}
 
-        if mirror:
-            for (dirpath, dirnames, filenames) in os.walk(mirror):
-                if dirpath.endswith('/.git') or '/.git/' in dirpath or dirpath.endswith('/xml') or '/xml/' in dirpath:
-                    continue
-                for filename in filenames:
-                    # Serialize function, ALWAYS writes out w/ .json extension
-                    if not filename.endswith('.json'):
-                        continue
-                    pindex = self.load_serialized_index(os.path.join(dirpath, filename), name='Mirrored Index')
-                    # A mirror can be made up of multiple indexes, so we need to identify which one they belong to
-                    if pindex and pindex['CFG']['DESCRIPTION'] in m_index:
-                        lindex = m_index[pindex['CFG']['DESCRIPTION']]
-                        for entry in pindex:
-                            if 'apilinks' == entry:
-                                continue
-                            if 'CFG' == entry:
-                                # Conflicts don't matter here, just accept it
-                                lindex[entry] = pindex[entry]
-                                continue
-                            if entry not in lindex:
-                                lindex[entry] = []
-                            try:
-                                lindex[entry] = self.__add_cmp_lists(pindex[entry], lindex[entry])
-                            except TypeError as error:
-                                raise TypeError('Merge failed of pindex[%s] and lindex[%s]: %s' % (entry, entry, error))
-                    else: # Not already know
-                        m_index[pindex['CFG']['DESCRIPTION']] = pindex
+        # id(lindex) -> digest of the configuration and content of the index,
+        # or None if the content can't be identified, see snapshot()
+        self.snapshots = {}
+
+        # id(lindex) -> entries of the index that are not part of its digest
+        # as they were not cached, see snapshot()
+        self.unsnapshotted = {}
+
+        # The local files the loaded indexes were loaded from (or would be
+        # loaded from next time): index files, and json index caches
+        self.paths = []
+
+        # Optional SQLite database (':memory:', or the directory of a
+        # temporary database file) used for the queries of the objects by
+        # layerBranch, see layer_index_sqlite.
+        self.database = None
+        if database:
+            from layer_index_sqlite import Layer_Index_DB
+            self.database = Layer_Index_DB(database)
+
+        # Local mirror entries are only loaded if the binary cache can't be used
+        m_index = None
+        m_digest = self.digest_path(mirror)
 
         for cfg in indexcfg:
             lindex = None
@@ -102,17 +206,83 @@ class Layer_Index():
                 if branch:
                     branch = branch.replace(find, rep)
 
-            # Do we have an mirrored version? If so use it, skip regular processing
-            if indexname in m_index:
-                logger.plain('Using index %s from the mirror index...' % (indexname))
-                lindex = m_index[indexname]
+            # The binary cache is keyed by everything that goes into the index
+            key = json.dumps({ 'DESCRIPTION' : indexname, 'TYPE' : indextype, 'URL' : indexurl, 'BRANCH' : branch,
+                               'REPLACE' : replace, 'MIRROR' : m_digest }, sort_keys=True)
+
+            # With a shared cache, every project of a user using the same
+            # index (same key) uses the same cache entry.  The entry is locked
+            # while the index is loaded and cached, so only one project loads
+            # it and the others wait and then use the binary cache.  If the
+            # shared cache can't be used, the project's own cache is.
+            lock = None
+            if indexcache and shared_cache:
+                entry = os.path.join(shared_cache, 'uid-%d' % os.getuid(), hashlib.sha256(key.encode('utf-8')).hexdigest())
+                try:
+                    lock = self.__lock_cache(entry)
+                    indexcache = os.path.join(entry, os.path.basename(indexcache))
+                except OSError as e:
+                    logger.warning('Unable to use the shared index cache %s: %s' % (shared_cache, e))
+                    logger.warning('Using the index cache %s instead.' % (indexcache))
+
+            cachefile = None
+            httpcache = None
+            if indexcache:
+                cachefile = self.__cache_path(indexcache)
+                httpcache = cachefile + '.http'
+
+            # Only local files can be checked without fetching them
+            source = None
+            if indextype in ['restapi-files', 'export']:
+                source = self.digest_path(indexurl)
+
+            # The entries the binary cache doesn't have (or can't read by the
+            # time they are used) are loaded from where it was made from
+            def cache_source(header, entry):
+                if header['SOURCE'] == 'mirror':
+                    return functools.partial(self.__load_mirror_entry, mirror, indexname, entry)
+                return functools.partial(self.__load_source_entry, indextype, indexurl, indexname, branch, httpcache, entry)
+
+            # Use the binary cache if it was made from the same sources, this
+            # skips the loading, replacements and writing of the cache.
+            header = None
+            if indexcache:
+                def accept(header):
+                    if header['KEY'] != key:
+                        return False
+                    if header['SOURCE'] == 'mirror' or (source and header['SOURCE'] == source):
+                        return True
+                    # Anything else is only shared for a while
+                    return lock is not None and time.time() - header.get('TIME', 0) < SHARED_CACHE_TTL
+                (header, lindex) = self.load_binary_index(cachefile + '.pickle', accept, cache_source)
+
+            if lindex:
+                logger.plain('Using index %s from the index cache...' % (indexname))
             else:
-               logger.plain('Loading index %s from %s...' % (indexname, indexurl))
+                if m_index is None:
+                    m_index = self.__load_mirror(mirror)
+
+                # Do we have an mirrored version? If so use it, skip regular processing
+                if indexname in m_index:
+                    logger.plain('Using index %s from the mirror index...' % (indexname))
+                    lindex = m_index[indexname]
+                    source = 'mirror'
+                else:
+                   logger.plain('Loading index %s from %s...' % (indexname, indexurl))
 
             # If not previously loaded from the mirror, attempt to load...
+            loaded = time.time()
             if not lindex:
                 if indextype == 'restapi-web':
-                    lindex = self.load_API_Index(indexurl, indexname, branches=branch)
+                    previous = None
+                    since = None
+                    if cachefile and cfg.get('INCREMENTAL'):
+                        # Any earlier load of the same index can be refreshed,
+                        # an entry that can't be read is fetched in full
+                        (pheader, previous) = self.load_binary_index(cachefile + '.pickle', lambda header: header['KEY'] == key,
+                                                                     lambda header, entry: list)
+                        since = pheader and pheader.get('SINCE')
+                    lindex = self.load_API_Index(indexurl, indexname, branches=branch, cache=httpcache, previous=previous, since=since)
                 elif indextype == 'restapi-files':
                     lindex = self.load_serialized_index(indexurl, name=indexname)
                 elif indextype == 'export':
@@ -125,28 +295,61 @@ class Layer_Index():
             # If we couldn't pull from the regular location, pull from the cache!
             if lindex is None and indexcache and os.path.exists(indexcache + '.json'):
                 logger.plain('Falling back to the index cache %s...' % (indexcache))
-                lindex = self.load_serialized_index(indexcache + '.json', name=indexname, branches=[branch])
+                source = None
+                loaded = 0
+                # The binary cache is only good if it matches the json cache
+                json_digest = self.digest_path(cachefile + '.json')
+                (_, lindex) = self.load_binary_index(cachefile + '.pickle', lambda header: header['JSON'] == json_digest, cache_source)
+                if not lindex:
+                    lindex = self.load_serialized_index(indexcache + '.json', name=indexname, branches=[branch])
 
             if not lindex or 'branches' not in lindex or 'layerItems' not in lindex or 'layerBranches' not in lindex:
                 logger.warning('Index %s was empty... Ignoring.' % indexname)
+                self.__unlock_cache(lock)
                 continue
 
-            # Start data transforms...
-            for entry in lindex['layerItems']:
-                for obj in entry:
-                    # Run replace on any 'url' items.
-                    if 'url' in obj:
-                        vcs_url = entry[obj]
-                        for (find, rep) in replace:
-                            vcs_url = vcs_url.replace(find, rep)
-                        entry[obj] = vcs_url
+            if not header:
+                # Start data transforms...
+                for entry in lindex['layerItems']:
+                    for obj in entry:
+                        # Run replace on any 'url' items.
+                        if 'url' in obj:
+                            vcs_url = entry[obj]
+                            for (find, rep) in replace:
+                                vcs_url = vcs_url.replace(find, rep)
+                            entry[obj] = vcs_url
+
+            # Digest of the content of the index, see snapshot().  The
+            # mirror-index digest (in the key) covers the entries that are
+            # not cached, anything else doesn't.
+            snapshot = None
+            if source == 'mirror':
+                snapshot = m_digest
+            elif source:
+                snapshot = source
+            unsnapshotted = []
+            if isinstance(lindex, Lazy_Index) and source != 'mirror' and not (header and header['SOURCE'] == 'mirror'):
+                unsnapshotted = [ entry for entry in lindex if lindex.is_deferred(entry) ]
 
             # Cache the data we loaded... (after replacements) if we loaded data.
             if lindex and indexcache:
-                dir = os.path.dirname(indexcache)
-                if dir:
-                    os.makedirs(dir, exist_ok=True)
-                self.serialize_index(lindex, indexcache, split=False)
+                if header:
+                    snapshot = self.digest_path(cachefile + '.json')
+                if not header or header['JSON'] != snapshot:
+                    cacheheader = { 'KEY' : key, 'SOURCE' : source, 'TIME' : loaded,
+                                    'SINCE' : getattr(lindex, 'since', header and header.get('SINCE') or {}) }
+                    try:
+                        snapshot = self.__write_cache(lindex, indexcache, cacheheader)
+                    except OSError as e:
+                        if not lock:
+                            raise
+                        logger.warning('Unable to write the shared index cache %s: %s' % (indexcache, e))
+                        logger.warning('Using the index cache %s instead.' % (cfg['CACHE']))
+                        indexcache = cfg['CACHE']
+                        snapshot = self.__write_cache(lindex, indexcache, cacheheader)
+                self.paths.append(self.__cache_path(indexcache) + '.json')
+
+            self.__unlock_cache(lock)
 
             lindex['CFG'] = cfg
             lindex['CFG']['BRANCH'] = branch
@@ -161,11 +364,158 @@ class Layer_Index():
             # Everything works off layerBranches, so make sure to keep it sorted!
             lindex['layerBranches'] = self.sortEntry(lindex['layerBranches'])
 
+            # The sort above reorders the entries, so (re)build the lookups now
+            self.reindex(lindex)
+
             if lindex:
                 self.index.append(lindex)
+                if indextype in ['restapi-files', 'export']:
+                    self.paths.append(indexurl)
+                self.snapshots[id(lindex)] = snapshot and hashlib.sha256((key + snapshot).encode('utf-8')).hexdigest()
+                self.unsnapshotted[id(lindex)] = unsnapshotted
+
+
+    # Return a digest identifying all of the loaded indexes, or None if any
+    # of them was loaded from a source that can't be identified without
+    # loading it again (a restapi-web index without a cache).  entries are
+    # the LAZY_ENTRIES the caller depends on, the digest of an index that
+    # deferred them to its source does not identify them.
+    def snapshot(self, entries=[]):
+        digest = hashlib.sha256()
+        for lindex in self.index:
+            if not self.snapshots.get(id(lindex)):
+                return None
+            if set(entries) & set(self.unsnapshotted.get(id(lindex), [])):
+                return None
+            digest.update(self.snapshots[id(lindex)].encode('utf-8'))
+        return digest.hexdigest()
+
+    # Write the json and binary caches of lindex, returns the digest of the
+    # json cache.  The entries deferred to the source of the index (see
+    # Lazy_Index) are left out, and listed as 'DEFERRED' in the header.
+    def __write_cache(self, lindex, indexcache, header):
+        deferred = []
+        if isinstance(lindex, Lazy_Index):
+            deferred = [ entry for entry in lindex if lindex.is_deferred(entry) ]
+        cached = { entry : lindex[entry] for entry in lindex if entry not in deferred }
+
+        dir = os.path.dirname(indexcache)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.serialize_index(cached, indexcache, split=False, compact=True)
+        snapshot = self.digest_path(self.__cache_path(indexcache) + '.json')
+        self.serialize_binary_index(cached, self.__cache_path(indexcache) + '.pickle', dict(header, JSON=snapshot, DEFERRED=deferred))
+        return snapshot
+
+    # Lock the shared cache entry in directory path, waiting for any other
+    # process using it.  The lock is released by __unlock_cache, or when the
+    # process exits.
+    #
+    # The entries are in a directory for each user (path is
+    # <shared cache>/uid-<uid>/<entry>), as a user only trusts the binary
+    # caches they wrote.  The shared cache is created writable by everyone
+    # (like /tmp), the user and entry directories only by the user.  Raises
+    # OSError if any of them can't be created or isn't safe to use.
+    def __lock_cache(self, path):
+        userdir = os.path.dirname(path)
+        shared = os.path.dirname(userdir)
+        try:
+            os.makedirs(shared)
+            os.chmod(shared, 0o1777)
+        except FileExistsError:
+            pass
+        for dir in [userdir, path]:
+            try:
+                os.mkdir(dir, 0o755)
+            except FileExistsError:
+                pass
+            if not self.__trusted_cache(os.stat(dir)):
+                raise PermissionError('%s is not owned by this user, or is writable by others' % dir)
+        lock = open(os.path.join(path, 'lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.plain('Waiting for the shared index cache %s...' % (path))
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def __unlock_cache(self, lock):
+        if lock:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    # The json files of the mirror-index in directory mirror
+    def __mirror_files(self, mirror):
+        fpaths = []
+        for (dirpath, dirnames, filenames) in os.walk(mirror):
+            if dirpath.endswith('/.git') or '/.git/' in dirpath or dirpath.endswith('/xml') or '/xml/' in dirpath:
+                continue
+            for filename in filenames:
+                # Serialize function, ALWAYS writes out w/ .json extension
+                if not filename.endswith('.json'):
+                    continue
+                fpaths.append(os.path.join(dirpath, filename))
+        return fpaths
 
+    def __load_mirror(self, mirror):
+        # Do we have local mirror entries to load?
+        m_index = {}
 
-    def load_API_Index(self, url, name=None, branches=None):
+        if mirror:
+            fpaths = self.__mirror_files(mirror)
+
+            # Per index id lookups used while merging the mirror files
+            m_ids = {}
+            # The files are parsed in parallel, but merged in the order
+            # they were found, so the result (and any conflict) is the same
+            # as loading them one by one.
+            for pindex in self.__load_mirror_files(fpaths):
+                # A mirror can be made up of multiple indexes, so we need to identify which one they belong to
+                if pindex and pindex['CFG']['DESCRIPTION'] in m_index:
+                    self.__merge_index(m_index[pindex['CFG']['DESCRIPTION']], pindex, m_ids[pindex['CFG']['DESCRIPTION']])
+                else: # Not already know
+                    m_index[pindex['CFG']['DESCRIPTION']] = Lazy_Index(pindex)
+                    m_ids[pindex['CFG']['DESCRIPTION']] = {}
+
+            # The LAZY_ENTRIES are parsed again when they are first used
+            for (name, lindex) in m_index.items():
+                for entry in LAZY_ENTRIES:
+                    lindex.defer(entry, functools.partial(self.__load_mirror_entry, mirror, name, entry))
+
+        return m_index
+
+    # Load entry of the index name from the mirror-index in directory mirror
+    def __load_mirror_entry(self, mirror, name, entry):
+        logger.debug('Loading %s of %s from the mirror index...' % (entry, name))
+        objects = []
+        ids = {}
+        for pindex in self.__load_mirror_files(self.__mirror_files(mirror), entry):
+            if pindex and pindex['CFG']['DESCRIPTION'] == name:
+                objects = self.__add_cmp_lists(pindex[entry], objects, ids)
+        logger.debug('...loading %s of %s from the mirror index, done.' % (entry, name))
+        return objects
+
+    # Yield _load_mirror_file() of each of fpaths, in order.  JSON
+    # decoding holds the GIL, so the files are parsed in LOAD_JOBS processes.
+    def __load_mirror_files(self, fpaths, entry=None):
+        load = functools.partial(_load_mirror_file, entry=entry)
+        done = 0
+        jobs = min(LOAD_JOBS, len(fpaths))
+        if jobs > 1:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                    for pindex in executor.map(load, fpaths, chunksize=max(1, len(fpaths) // (jobs * 4))):
+                        yield pindex
+                        done += 1
+                return
+            except (OSError, concurrent.futures.process.BrokenProcessPool) as e:
+                # Finish (and report any error) without the workers
+                logger.debug('Unable to load the mirror-index in parallel: %s' % e)
+
+        for fpath in fpaths[done:]:
+            yield load(fpath)
+
+    def load_API_Index(self, url, name=None, branches=None, cache=None, previous=None, since=None):
         """
             Fetches layer information from a remote layer index.
             The return value is a dictionary containing API,
@@ -176,24 +526,50 @@ class Layer_Index():
             http://layers.openembedded.org/layerindex/api/
 
             branches is a str or list of branches to filter on
+
+            cache is an optional directory where the responses and their
+            validators (ETag, Last-Modified) are kept.  Later calls send
+            conditional requests and reuse the kept response if the
+            server says it was not modified.
+
+            previous is an optional earlier result for the same url and
+            branches (e.g. from the index cache).  Tables where every
+            object has an 'updated' time are then refreshed incrementally,
+            see __refresh_table.  The server time of each table fetch is
+            kept in the since attribute of the result, the since of the
+            previous result is where its tables are refreshed from.
+
+            The LAZY_ENTRIES are only fetched when they are first used, see
+            Lazy_Index.
         """
-        lindex = {}
+        lindex = Lazy_Index()
+        lindex.since = {}
 
         assert url is not None
 
         logger.debug('Loading %s from url %s...' % (name, url))
 
-        def _get_json_response(apiurl=None, retry=True):
+        # apiurl -> server time of its last response
+        server_times = {}
+
+        def _get_json_response(apiurl=None, retry=True, usecache=True):
             assert apiurl is not None
 
-            res = utils_setup.fetch_url(apiurl)
+            (validators, cached) = self.__http_cache_get(cache if usecache else None, apiurl)
+            res = utils_setup.fetch_url(apiurl, headers=validators)
+            server_times[apiurl] = self.__server_time(res)
 
             try:
-                parsed = json.loads(res.read().decode('utf-8'))
+                if res.getcode() == 304:
+                    logger.debug("%s: not modified, using the cached response." % apiurl)
+                    data = cached
+                else:
+                    data = res.read()
+                parsed = json.loads(data.decode('utf-8'))
             except ConnectionResetError:
                 if retry:
                     logger.debug("%s: Connection reset by peer.  Retrying..." % url)
-                    parsed = _get_json_response(apiurl=apiurl, retry=False)
+                    parsed = _get_json_response(apiurl=apiurl, retry=False, usecache=usecache)
                     logger.debug("%s: retry successful.")
                 else:
                     logger.critical("%s: Connection reset by peer." % url)
@@ -202,11 +578,14 @@ class Layer_Index():
             except:
                 if retry:
                     logger.debug("%s: get response failed. Retrying..." % url)
-                    parsed = _get_json_response(apiurl=apiurl, retry=False)
+                    parsed = _get_json_response(apiurl=apiurl, retry=False, usecache=usecache)
                     logger.debug("%s: retry successful.")
                 else:
                     logger.critical("%s: get response failed" % url)
                     sys.exit(1)
+            else:
+                if res.getcode() != 304 and usecache:
+                    self.__http_cache_put(cache, apiurl, res, data)
 
             return parsed
 
@@ -230,74 +609,282 @@ class Layer_Index():
             logger.warning("No valid branches (%s) found at url %s." % (branches or "*", url))
             return lindex
 
-        filter = ""
-        if branches:
-            filter = "?filter=branch__name:%s" \
-                     % "OR".join(branches)
-        lindex['layerBranches'] = _get_json_response(lindex['apilinks']['layerBranches'] + filter)
-        if not lindex['layerBranches']:
-            logger.warning("No layers on branches (%s) found at url %s." % (branches or "*", url))
-            return lindex
-
-        layerids = []
-        for i, layerBranch in enumerate(lindex['layerBranches']):
-            layerids.append("%s" % layerBranch['layer'])
-
-        lindex['layerItems'] = _get_json_response(lindex['apilinks']['layerItems'])
+        # Everything else only depends on the branches, so fetch it all at
+        # the same time.
+        # With timed, (objects, server time) is returned
+        def _fetch(entry, apiurl, usecache=True, timed=False):
+            start = time.time()
+            logger.debug('Fetching %s from %s...' % (entry, apiurl))
+            parsed = _get_json_response(apiurl, usecache=usecache)
+            logger.debug('...fetching %s from %s, done (%.2f seconds).' % (entry, apiurl, time.time() - start))
+            if timed:
+                return (parsed, server_times.get(apiurl))
+            return parsed
 
-        filter = ""
+        bfilter = ""
+        lbfilter = ""
         if branches:
-            filter = "?filter=layerbranch__branch__name:%s" \
+            bfilter = "?filter=branch__name:%s" \
                      % "OR".join(branches)
-        lindex['layerDependencies'] = _get_json_response(lindex['apilinks']['layerDependencies'] + filter)
-
-        filter = ""
-        if branches:
-            filter = "?filter=layerbranch__branch__name:%s" \
+            lbfilter = "?filter=layerbranch__branch__name:%s" \
                      % "OR".join(branches)
-        lindex['machines'] = _get_json_response(lindex['apilinks']['machines'] + filter)
 
-        filter = ""
-        if branches:
-            filter = "?filter=layerbranch__branch__name:%s" \
-                     % "OR".join(branches)
-        lindex['recipes'] = _get_json_response(lindex['apilinks']['recipes'] + filter)
+        # entry -> url, in the order the entries are added to the lindex
+        endpoints = OrderedDict()
+        endpoints['layerBranches'] = lindex['apilinks']['layerBranches'] + bfilter
+        endpoints['layerItems'] = lindex['apilinks']['layerItems']
+        endpoints['layerDependencies'] = lindex['apilinks']['layerDependencies'] + lbfilter
+        endpoints['machines'] = lindex['apilinks']['machines'] + lbfilter
+        endpoints['recipes'] = lindex['apilinks']['recipes'] + lbfilter
+        if 'distros' in lindex['apilinks']:
+            endpoints['distros'] = lindex['apilinks']['distros'] + lbfilter
+        if 'wrtemplates' in lindex['apilinks']:
+            endpoints['wrtemplates'] = lindex['apilinks']['wrtemplates'] + lbfilter
+        if 'YPCompatibleVersions' in lindex['apilinks']:
+            endpoints['YPCompatibleVersions'] = lindex['apilinks']['YPCompatibleVersions']
 
-        filter = ""
+        # When filtering on branches, only the layerItems used by the
+        # layerBranches (and their dependencies) are fetched, see below.
         if branches:
-            filter = "?filter=layerbranch__branch__name:%s" \
-                     % "OR".join(branches)
-        if 'distros' in lindex['apilinks']:
-            lindex['distros'] = _get_json_response(lindex['apilinks']['distros'] + filter)
-        else:
+            del endpoints['layerItems']
+
+        def _fetch_table(entry):
+            if previous and previous.get(entry) and all('updated' in obj for obj in previous[entry]):
+                (objects, lindex.since[entry]) = self.__refresh_table(_fetch, entry, endpoints[entry], previous[entry], (since or {}).get(entry))
+            else:
+                (objects, lindex.since[entry]) = _fetch(entry, endpoints[entry], timed=True)
+            return objects
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_JOBS) as executor:
+            futures = OrderedDict()
+            for entry in endpoints:
+                if entry not in LAZY_ENTRIES:
+                    futures[entry] = executor.submit(_fetch_table, entry)
+
+            lindex['layerBranches'] = futures['layerBranches'].result()
+            if not lindex['layerBranches']:
+                logger.warning("No layers on branches (%s) found at url %s." % (branches or "*", url))
+                for future in futures.values():
+                    future.cancel()
+                return lindex
+
+            if branches:
+                lindex['layerItems'] = self.__fetch_layerItems(executor, _fetch, lindex['apilinks']['layerItems'],
+                                                               lindex['layerBranches'], futures['layerDependencies'].result())
+
+            for entry in endpoints:
+                if entry in futures:
+                    lindex[entry] = futures[entry].result()
+                else:
+                    lindex.defer(entry, functools.partial(_fetch_table, entry))
+
+        if 'distros' not in lindex:
             # Not all layer indexes have a distribution API.  If not we need to emulate nodistro.
             lindex['distros'] = []
             idx = 1
             for branch in lindex['branches']:
-                for lb in self.getLayerBranch(lindex, branch['id'], name='openembedded-core'):
+                # Only the layerItems on the branches are fetched, so
+                # openembedded-core may not be in the index at all
+                for lb in self.getLayerBranch(lindex, branch['id'], name='openembedded-core') or []:
                     lindex['distros'].append({"layerbranch": lb['id'], "id": idx, "description": "default", "updated": "2016-01-01T00:00:00+0000", "name": "nodistro"})
                     idx = idx + 1
 
-        filter = ""
-        if branches:
-            filter = "?filter=layerbranch__branch__name:%s" \
-                     % "OR".join(branches)
-        if 'wrtemplates' in lindex['apilinks']:
-            lindex['wrtemplates'] = _get_json_response(lindex['apilinks']['wrtemplates'] + filter)
-        else:
+        if 'wrtemplates' not in lindex:
             lindex['wrtemplates'] = []
 
-        if 'YPCompatibleVersions' in lindex['apilinks']:
-            lindex['YPCompatibleVersions'] = _get_json_response(lindex['apilinks']['YPCompatibleVersions'])
-        else:
+        if 'YPCompatibleVersions' not in lindex:
             lindex['YPCompatibleVersions'] = []
 
         logger.debug('...loading %s from url %s, done.' % (name, url))
 
         return lindex
 
+    # Load entry of an index from its source (url of type indextype), for
+    # the entries that are not in the index cache, see load_binary_index.
+    def __load_source_entry(self, indextype, url, name, branch, cache, entry):
+        logger.plain('Loading %s of index %s from %s...' % (entry, name, url))
+        lindex = None
+        if indextype == 'restapi-web':
+            lindex = self.load_API_Index(url, name, branches=branch, cache=cache)
+        elif indextype == 'restapi-files':
+            lindex = self.load_serialized_index(url, name=name)
+        elif indextype == 'export':
+            lindex = self.load_django_export(url, name=name)
+
+        if not lindex or entry not in lindex:
+            logger.warning('Unable to load %s of index %s from %s.' % (entry, name, url))
+            return []
+        return lindex[entry]
+
+    # The time of the server when it sent the response res (its Date), in
+    # the format of the 'updated' times, or None if it isn't known
+    def __server_time(self, res):
+        from email.utils import parsedate_to_datetime
+
+        date = getattr(res, 'headers', None) and res.headers.get('Date')
+        if not date:
+            return None
+        try:
+            date = parsedate_to_datetime(date)
+        except (TypeError, ValueError):
+            return None
+        if not date.tzinfo:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return date.astimezone(datetime.timezone.utc).isoformat()
+
+    # The http cache keeps the last response of each url, and its validators,
+    # in a pair of files named after the url: <sha256>.meta and <sha256>.body
+    def __http_cache_file(self, cache, url):
+        return os.path.join(cache, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    # Returns (request headers, response body) for a conditional request of
+    # url, or (None, None) if there is nothing usable in the cache.
+    def __http_cache_get(self, cache, url):
+        if not cache:
+            return (None, None)
+
+        fname = self.__http_cache_file(cache, url)
+        try:
+            meta = json.load(open(fname + '.meta', 'rt', encoding='utf-8'))
+            with open(fname + '.body', 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return (None, None)
+
+        if meta.get('url') != url or hashlib.sha256(body).hexdigest() != meta.get('sha256'):
+            return (None, None)
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last-modified'):
+            headers['If-Modified-Since'] = meta['last-modified']
+        if not headers:
+            return (None, None)
+        return (headers, body)
+
+    def __http_cache_put(self, cache, url, res, body):
+        if not cache or not hasattr(res, 'headers'):
+            return
+
+        meta = {}
+        meta['url'] = url
+        meta['etag'] = res.headers.get('ETag')
+        meta['last-modified'] = res.headers.get('Last-Modified')
+        meta['sha256'] = hashlib.sha256(body).hexdigest()
+
+        fname = self.__http_cache_file(cache, url)
+        if not meta['etag'] and not meta['last-modified']:
+            # Nothing to validate against, don't keep a stale copy either
+            for ext in ['.meta', '.body']:
+                if os.path.exists(fname + ext):
+                    os.remove(fname + ext)
+            return
+
+        os.makedirs(cache, exist_ok=True)
+        # The body first, the meta data refers to it
+        utils_setup.write_if_changed(fname + '.body', body)
+        utils_setup.write_if_changed(fname + '.meta', json.dumps(meta))
+
+    # Fetch the layerItems referenced by layerBranches and layerDependencies,
+    # using an id filter of at most LAYERITEMS_CHUNK ids per request.  If the
+    # server doesn't support the filter, everything is fetched instead.
+    def __fetch_layerItems(self, executor, fetch, apiurl, layerBranches, layerDependencies):
+        from urllib.error import HTTPError
+
+        layerids = set()
+        for lb in layerBranches:
+            layerids.add(lb['layer'])
+        for ld in layerDependencies:
+            layerids.add(ld['dependency'])
+        layerids = sorted(layerids)
+
+        futures = []
+        for i in range(0, len(layerids), LAYERITEMS_CHUNK):
+            filter = "?filter=id:%s" \
+                     % "OR".join(["%s" % layerid for layerid in layerids[i:i + LAYERITEMS_CHUNK]])
+            futures.append(executor.submit(fetch, 'layerItems', apiurl + filter))
+
+        layerItems = []
+        try:
+            for future in futures:
+                layerItems.extend(future.result())
+        except HTTPError as e:
+            logger.debug("%s: id filter failed (%s), fetching all layerItems..." % (apiurl, e))
+            layerItems = fetch('layerItems', apiurl)
+
+        # The server may also have ignored the filter
+        layerids = set(layerids)
+        return [li for li in layerItems if li['id'] in layerids]
+
+    # Refresh the objects of table entry, fetched from apiurl, in previous.
+    # Returns (objects, server time of the refresh).
+    #
+    # Only the objects updated since the server time of the previous fetch
+    # (or the newest 'updated' time in previous) are fetched, then a listing
+    # of the ids ('fields=id') finds the deleted objects.  Anything updated
+    # between the two requests is updated after the server time of the
+    # first, so the next refresh fetches it, and anything added between them
+    # is fetched by id.  If the server sends whole objects for the listing,
+    # it is simply used as the table.  If the server rejects any request, the
+    # whole table is fetched.
+    def __refresh_table(self, fetch, entry, apiurl, previous, since=None):
+        from urllib.error import HTTPError
+        from urllib.parse import quote
+
+        if not since:
+            since = max(obj['updated'] for obj in previous)
+        if '?filter=' in apiurl:
+            updatedurl = apiurl + ',updated__gte:%s' % quote(since, safe='')
+        else:
+            updatedurl = apiurl + '?filter=updated__gte:%s' % quote(since, safe='')
+        idsurl = apiurl + ('&' if '?' in apiurl else '?') + 'fields=id'
+
+        try:
+            # The updates change constantly, there is no point caching them
+            (updated, servertime) = fetch(entry, updatedurl, usecache=False, timed=True)
+
+            listing = fetch(entry, idsurl)
+            if any(len(obj) > 1 for obj in listing):
+                logger.debug('%s: fields=id was ignored, using the full listing.' % apiurl)
+                return (listing, servertime)
+
+            objects = {}
+            for obj in previous:
+                objects[obj['id']] = obj
+            for obj in updated:
+                objects[obj['id']] = obj
+
+            # Added after the updates were fetched
+            added = [ obj['id'] for obj in listing if obj['id'] not in objects ]
+            for i in range(0, len(added), LAYERITEMS_CHUNK):
+                ids = set(added[i:i + LAYERITEMS_CHUNK])
+                if '?filter=' in apiurl:
+                    idurl = apiurl + ',id:%s' % 'OR'.join('%s' % id for id in sorted(ids))
+                else:
+                    idurl = apiurl + '?filter=id:%s' % 'OR'.join('%s' % id for id in sorted(ids))
+                logger.debug('%s: fetching %s %s added since the updates...' % (apiurl, len(ids), entry))
+                for obj in fetch(entry, idurl, usecache=False):
+                    # The server may have ignored the filter
+                    if obj['id'] in ids:
+                        objects[obj['id']] = obj
+        except HTTPError as e:
+            logger.debug('%s: incremental refresh failed (%s), fetching all %s...' % (apiurl, e, entry))
+            return fetch(entry, apiurl, timed=True)
+
+        # Anything listed that is still missing was deleted after the listing
+        result = [ objects[obj['id']] for obj in listing if obj['id'] in objects ]
+
+        logger.debug('%s: %s refreshed incrementally, %s updated, %s added, %s removed.' %
+                     (apiurl, entry, len(updated), len(added), len(objects) - len(result)))
+        return (result, servertime)
+
     # Merge listone and listtwo, returning listtwo
-    def __add_cmp_lists(self, listone, listtwo):
+    #
+    # ids is the 'id' -> object dictionary of listtwo.  It is kept up to date
+    # as objects are added, so a caller merging many lists into the same
+    # listtwo can pass the same dictionary each time and avoid rescanning.
+    def __add_cmp_lists(self, listone, listtwo, ids=None):
         # Copy the items from listone, into listtwo -- if it isn't already
         # there..  if it is there, verify it's the same or raise an error...
 
@@ -307,29 +894,48 @@ class Layer_Index():
         if not listtwo: # List two is empty, just return listone
             return listone
 
-        for one in reversed(listone):
-            found = False
+        if ids is None:
+            ids = {}
+
+        # (Re)build the lookup if listtwo was changed behind our back
+        if len(ids) != len(listtwo):
+            ids.clear()
             for two in listtwo:
-                if 'id' in one and 'id' in two:
-                    if one['id'] == two['id']:
-                        found = True
-                        # Contents need to be the same!
-                        if one != two:
-                            # Something is out of sync here...
-                            raise TypeError('Cannot merge two objects with the same id %s, but different contents:\n%s\n%s' % (one['id'], one, two))
-                        break
-                else:
+                if not 'id' in two:
                     # This is not a valid object
-                    if not 'id' in one and 'id' in two:
-                        raise TypeError('No id in object from the first parameter list:\n%s' % (one))
-                    if 'id' in one and not 'id' in two:
-                        raise TypeError('No id in object from the second parameter list:\n%s' % (two))
-                    if not 'id' in one and not 'id' in two:
-                        raise TypeError('No id in object in either parameter list:\n%s\n%s' % (one, two))
-            if not found:
+                    raise TypeError('No id in object from the second parameter list:\n%s' % (two))
+                ids.setdefault(two['id'], two)
+
+        for one in reversed(listone):
+            if not 'id' in one:
+                # This is not a valid object
+                raise TypeError('No id in object from the first parameter list:\n%s' % (one))
+            two = ids.get(one['id'])
+            if two is None:
                 listtwo.append(one)
+                ids[one['id']] = one
+            elif one != two:
+                # Something is out of sync here...
+                raise TypeError('Cannot merge two objects with the same id %s, but different contents:\n%s\n%s' % (one['id'], one, two))
         return listtwo
 
+    # Merge the entries of pindex into lindex.  ids holds the id lookup of
+    # each lindex entry, see __add_cmp_lists.
+    def __merge_index(self, lindex, pindex, ids):
+        for entry in pindex:
+            if 'apilinks' == entry:
+                continue
+            if 'CFG' == entry:
+                # Conflicts don't matter here, just accept it
+                lindex[entry] = pindex[entry]
+                continue
+            if entry not in lindex:
+                lindex[entry] = []
+            try:
+                lindex[entry] = self.__add_cmp_lists(pindex[entry], lindex[entry], ids.setdefault(entry, {}))
+            except TypeError as error:
+                raise TypeError('Merge failed of pindex[%s] and lindex[%s]: %s' % (entry, entry, error))
+
     def load_serialized_index(self, path, name=None, branches=None):
         lindex = {}
         lindex['branches'] = []
@@ -344,23 +950,13 @@ class Layer_Index():
 
         assert path is not None
 
+        ids = {}
+
         def loadCache(path):
             logger.debug('Loading json file %s' % path)
             pindex = json.load(open(path, 'rt', encoding='utf-8'))
 
-            for entry in pindex:
-                if 'apilinks' == entry:
-                    continue
-                if 'CFG' == entry:
-                    # Conflicts don't matter here, just accept it
-                    lindex[entry] = pindex[entry]
-                    continue
-                if entry not in lindex:
-                    lindex[entry] = []
-                try:
-                    lindex[entry] = self.__add_cmp_lists(pindex[entry], lindex[entry])
-                except TypeError as error:
-                    raise TypeError('Merge failed of pindex[%s] and lindex[%s]: %s' % (entry, entry, error))
+            self.__merge_index(lindex, pindex, ids)
 
             logger.debug('...loading json file %s, done.' % path)
 
@@ -397,55 +993,49 @@ class Layer_Index():
 
         assert path is not None
 
+        ids = {}
+
         def loadDB(path):
+            # The entry is not used after this, so its fields become the object
             def constructObject(entry):
-                obj = entry['fields'].copy()
+                obj = entry['fields']
                 obj['id'] = entry['pk']
                 return obj
 
             pindex = {}
 
             logger.debug('Loading json file %s' % path)
-            dbindex = json.load(open(path, 'rt', encoding='utf-8'))
 
             # We discard anything that doesn't start with 'layerindex.'
             # the other data is adminstrative and stuff we should not mess with
-            for entry in dbindex:
-                if 'model' in entry:
-                    model = entry['model']
-                    if model.startswith('layerindex.'):
-                        if 'branch' == model[11:]:
-                            name = 'branches'
-                        elif 'layeritem' == model[11:]:
-                            name = 'layerItems'
-                        elif 'layerbranch' == model[11:]:
-                            name = 'layerBranches'
-                        elif 'layerdependency' == model[11:]:
-                            name = 'layerDependencies'
-                        elif 'recipe' == model[11:]:
-                            name = 'recipes'
-                        elif 'machine' == model[11:]:
-                            name = 'machines'
-                        elif 'distro' == model[11:]:
-                            name = 'distros'
-                        elif 'wrtemplate' == model[11:]:
-                            name = 'wrtemplates'
-                        elif 'ypcompatibleversion' == model[11:]:
-                            name = 'YPCompatibleVersions'
-                        else:
-                            name = model[11:]
+            for entry in self.__iterDjangoExport(path):
+                model = entry['model']
+                if 'branch' == model[11:]:
+                    name = 'branches'
+                elif 'layeritem' == model[11:]:
+                    name = 'layerItems'
+                elif 'layerbranch' == model[11:]:
+                    name = 'layerBranches'
+                elif 'layerdependency' == model[11:]:
+                    name = 'layerDependencies'
+                elif 'recipe' == model[11:]:
+                    name = 'recipes'
+                elif 'machine' == model[11:]:
+                    name = 'machines'
+                elif 'distro' == model[11:]:
+                    name = 'distros'
+                elif 'wrtemplate' == model[11:]:
+                    name = 'wrtemplates'
+                elif 'ypcompatibleversion' == model[11:]:
+                    name = 'YPCompatibleVersions'
+                else:
+                    name = model[11:]
 
-                        if name not in pindex:
-                            pindex[name] = []
-                        pindex[name].append(constructObject(entry))
+                if name not in pindex:
+                    pindex[name] = []
+                pindex[name].append(constructObject(entry))
 
-            for entry in pindex:
-                if entry not in lindex:
-                    lindex[entry] = []
-                try:
-                    lindex[entry] = self.__add_cmp_lists(pindex[entry], lindex[entry])
-                except TypeError as error:
-                    raise TypeError('Merge failed of pindex[%s] and lindex[%s]: %s' % (entry, entry, error))
+            self.__merge_index(lindex, pindex, ids)
 
             logger.debug('...loading json file %s, done.' % path)
 
@@ -468,39 +1058,289 @@ class Layer_Index():
 
         return lindex
 
+    # Parse the Django export (manage.py dumpdata output) in path one object
+    # at a time, and yield the objects of the 'layerindex.*' models.  Only
+    # the current object is held in memory, objects of other models are
+    # dropped as soon as they are decoded.
+    def __iterDjangoExport(self, path):
+        decoder = json.JSONDecoder()
+        with open(path, 'rt', encoding='utf-8') as f:
+            buf = f.read(DJANGO_READ_SIZE)
+            pos = JSON_WS_RE.match(buf).end()
+
+            # Not an array, nothing to stream
+            if not buf.startswith('[', pos):
+                dbindex = json.loads(buf + f.read())
+                for entry in dbindex:
+                    if isinstance(entry, dict) and 'model' in entry and entry['model'].startswith('layerindex.'):
+                        yield entry
+                return
+            pos += 1
+
+            eof = False
+            while True:
+                pos = JSON_SEP_RE.match(buf, pos).end()
+                if buf.startswith(']', pos):
+                    return
+
+                try:
+                    (entry, pos) = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # The object continues past the buffer, read some more
+                    data = f.read(DJANGO_READ_SIZE)
+                    eof = not data
+                    buf = buf[pos:] + data
+                    pos = 0
+                    continue
+
+                if isinstance(entry, dict) and 'model' in entry and entry['model'].startswith('layerindex.'):
+                    yield entry
+
     # Provide a function to sort layer index content (restapi format)
     # When serializing the data this is import to limit
     # changes to the files...
+    # Lists are sorted by id in place, the objects themselves are not copied
+    # (their keys are sorted by canonical_json).  A dictionary is returned as
+    # a new OrderedDict, sorted by key.
     def sortEntry(self, item):
-        newitem = item
-        try:
-            if type(newitem) == type(dict()):
-                newitem = OrderedDict(sorted(newitem.items(), key=lambda t: t[0]))
-            elif type(newitem) == type(list()):
-                newitem.sort(key=lambda obj: obj['id'])
-                for index, entry in enumerate(newitem):
-                    newitem[index] = self.sortEntry(newitem[index])
-        except:
-            pass
+        if isinstance(item, dict):
+            return OrderedDict(sorted(item.items(), key=lambda t: t[0]))
+        elif isinstance(item, list):
+            try:
+                item.sort(key=lambda obj: obj['id'])
+            except (KeyError, TypeError):
+                # Not a list of objects with ids, keep the order
+                pass
 
-        return newitem
+        return item
 
-    # Sort and return a new restapi style index
+    # Sort and return a restapi style index
     def sortRestApi(self, index):
         lindex = self.sortEntry(index)
         for entry in lindex:
             lindex[entry] = self.sortEntry(lindex[entry])
         return lindex
 
+    # Return index (restapi format) as JSON text in canonical form: entries
+    # sorted by id and keys sorted, the same index always gives the same
+    # text.  The text is encoded straight from the index objects, without
+    # copying them.  compact leaves out the indentation, for files that are
+    # only ever read back by the Layer_Index.
+    def canonical_json(self, index, compact=False):
+        return ''.join(self.iter_canonical_json(index, compact))
+
+    # canonical_json, as an iterator over the pieces of the text.  Pass it to
+    # utils_setup.write_if_changed to write the text without building it.
+    def iter_canonical_json(self, index, compact=False):
+        if compact:
+            encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+        else:
+            encoder = json.JSONEncoder(sort_keys=True, indent=4)
+        return encoder.iterencode(self.sortRestApi(index))
+
+    # Cache files are named after the last component of the path
+    def __cache_path(self, path):
+        dir = os.path.dirname(path)
+        base = os.path.basename(path)
+        fname = base.translate(str.maketrans('/ ', '__'))
+        return os.path.join(dir, fname)
+
+    # Return the sha256 of the file, or of the json files in the directory,
+    # path.  None is returned if there is nothing to check.
+    def digest_path(self, path):
+        if not path or not os.path.exists(path):
+            return None
+
+        digest = hashlib.sha256()
+
+        def add_file(fpath, name):
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            digest.update(struct.pack('>QQ', len(name), len(data)))
+            digest.update(name)
+            digest.update(data)
+
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                if '.git' in dirnames:
+                    dirnames.remove('.git')
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if not filename.endswith('.json'):
+                        continue
+                    fpath = os.path.join(dirpath, filename)
+                    add_file(fpath, os.path.relpath(fpath, path).encode('utf-8'))
+        else:
+            add_file(path, b'')
+
+        return digest.hexdigest()
+
+    # The binary cache is a faster to load copy of the json cache.  The
+    # format is:
+    #   BINARY_MAGIC
+    #   version, header length (big endian 32-bit unsigned)
+    #   header (json)
+    #   sections (pickle), one per entry, in the order listed in the header
+    #
+    # header is a dictionary that is written as is, plus a 'SECTIONS' list of
+    # [entry, length, sha256] for the sections that follow it.
+    def serialize_binary_index(self, lindex, path, header):
+        sections = []
+        for entry in lindex:
+            # Need to filter out local information
+            if 'CFG' == entry or 'apilinks' == entry:
+                continue
+            sections.append((entry, pickle.dumps(lindex[entry], pickle.HIGHEST_PROTOCOL)))
+
+        header = dict(header)
+        header['SECTIONS'] = [ [entry, len(data), hashlib.sha256(data).hexdigest()] for (entry, data) in sections ]
+        hdata = json.dumps(header, sort_keys=True).encode('utf-8')
+
+        # Replaced atomically, so a partial cache is never used.  A cache
+        # load_binary_index would not trust is replaced by our own, and it is
+        # not writable by anyone else.
+        data = [BINARY_MAGIC, struct.pack('>II', BINARY_VERSION, len(hdata)), hdata]
+        data.extend(section for (entry, section) in sections)
+        try:
+            if os.path.exists(path) and not self.__trusted_cache(os.stat(path)):
+                os.remove(path)
+        except OSError as e:
+            logger.debug('%s: unable to remove: %s' % (path, e))
+        utils_setup.write_if_changed(path, b''.join(data), mode=0o644)
+
+    # The binary cache is unpickled, which can run any code, so it is only
+    # loaded if this user wrote it: owned by the user, and not writable by
+    # anyone else.  This matters for the shared cache (--index-cache).
+    def __trusted_cache(self, st):
+        return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    # Returns (header, lindex), the lindex is only loaded if accept(header)
+    # returns True and the contents are intact, otherwise (None, None).
+    #
+    # The LAZY_ENTRIES are only read (and checked) when they are first used,
+    # the file is not kept open until then.  source(header, entry) returns a
+    # loader of entry from wherever the cache was made from.  It is used for
+    # the entries that were deferred when the cache was written, and for the
+    # LAZY_ENTRIES if the file changed by the time they are used.
+    def load_binary_index(self, path, accept, source=None):
+        if not os.path.exists(path):
+            return (None, None)
+
+        logger.debug('Loading binary cache %s' % path)
+        try:
+            with open(path, 'rb') as f:
+                if not self.__trusted_cache(os.fstat(f.fileno())):
+                    logger.debug('%s: not written by this user, not trusted' % path)
+                    return (None, None)
+
+                if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                    logger.debug('%s: not a binary index cache' % path)
+                    return (None, None)
+
+                (version, hlen) = struct.unpack('>II', f.read(struct.calcsize('>II')))
+                if version != BINARY_VERSION:
+                    logger.debug('%s: unsupported version %s' % (path, version))
+                    return (None, None)
+
+                header = json.loads(f.read(hlen).decode('utf-8'))
+                if not accept(header):
+                    logger.debug('%s: out of date' % path)
+                    return (None, None)
+
+                st = os.fstat(f.fileno())
+                offset = f.tell()
+                if offset + sum(length for (entry, length, digest) in header['SECTIONS']) != st.st_size:
+                    logger.debug('%s: truncated' % path)
+                    return (None, None)
+
+                lindex = Lazy_Index()
+                for (entry, length, digest) in header['SECTIONS']:
+                    if entry in LAZY_ENTRIES:
+                        lindex.set_loader(entry, functools.partial(self.__load_binary_section, path, (st.st_dev, st.st_ino, st.st_mtime_ns),
+                                                                   entry, offset, length, digest, source and source(header, entry)))
+                        f.seek(length, os.SEEK_CUR)
+                    else:
+                        section = f.read(length)
+                        if hashlib.sha256(section).hexdigest() != digest:
+                            logger.debug('%s: %s is corrupt' % (path, entry))
+                            return (None, None)
+                        lindex[entry] = pickle.loads(section)
+                    offset += length
+
+                for entry in header.get('DEFERRED', []):
+                    loader = source and source(header, entry)
+                    if not loader:
+                        logger.debug('%s: %s was not cached' % (path, entry))
+                        return (None, None)
+                    lindex.defer(entry, loader)
+        except Exception as e:
+            logger.debug('%s: unable to load: %s' % (path, e))
+            return (None, None)
+
+        logger.debug('...loading binary cache %s, done.' % path)
+        return (header, lindex)
+
+    # Load the section of entry at offset in the binary cache path, if the
+    # file is still the one identified by fileid (device, inode, mtime)
+    # and the section is intact.  Otherwise entry is loaded by fallback.
+    def __load_binary_section(self, path, fileid, entry, offset, length, digest, fallback):
+        logger.debug('Loading %s from binary cache %s' % (entry, path))
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if (st.st_dev, st.st_ino, st.st_mtime_ns) == fileid and self.__trusted_cache(st):
+                    f.seek(offset)
+                    section = f.read(length)
+                    if hashlib.sha256(section).hexdigest() == digest:
+                        return pickle.loads(section)
+        except OSError as e:
+            logger.debug('%s: unable to read %s: %s' % (path, entry, e))
+
+        if not fallback:
+            raise ValueError('%s: %s changed after the cache was loaded' % (path, entry))
+        logger.debug('%s: %s changed after the cache was loaded, loading it again...' % (path, entry))
+        return fallback()
+
+    # Split each table of lindex (except those in skip) by the layerBranch,
+    # or layer, its objects belong to.  Objects with neither go with every
+    # layerBranch.  The position of each object is kept, so the subsets
+    # can be put back in table order, see __partitionFor.
+    def __partition(self, lindex, skip):
+        partitions = {}
+        for entry in lindex:
+            if entry in skip:
+                continue
+            partition = {}
+            for pos, obj in enumerate(lindex[entry]):
+                if 'layerbranch' in obj:
+                    key = ('layerbranch', obj['layerbranch'])
+                elif 'layer' in obj:
+                    key = ('layer', obj['layer'])
+                else:
+                    # No simple filter method, just include it...
+                    key = None
+                partition.setdefault(key, []).append((pos, obj))
+            partitions[entry] = partition
+        return partitions
+
+    # Return the objects of a partitioned table for layerBranch lb, layers
+    # is the result of find_layer(layerBranch=lb).
+    def __partitionFor(self, partition, lb, layers):
+        filtered = partition.get(('layerbranch', lb['id']), []) + partition.get(None, [])
+        for layer in layers:
+            filtered += partition.get(('layer', layer['id']), [])
+        return [obj for (pos, obj) in sorted(filtered, key=lambda t: t[0])]
+
     # layerBranches must be a list of layerBranch entries to parse, it only affects
-    # output when 'split' is True.
-    def serialize_index(self, lindex, path, split=False, layerBranches=None, IncludeCFG=False, mirror=False, base_url=None):
+    # output when 'split' is True.  Files are only rewritten if their contents
+    # change, the list of files that make up the output is returned.
+    # compact writes the JSON without indentation, see canonical_json.
+    def serialize_index(self, lindex, path, split=False, layerBranches=None, IncludeCFG=False, mirror=False, base_url=None, compact=False):
         # If we're not splitting, we must be caching...
         if not split:
-            dir = os.path.dirname(path)
-            base = os.path.basename(path)
-            fname = base.translate(str.maketrans('/ ', '__'))
-            fpath = os.path.join(dir, fname)
+            fpath = self.__cache_path(path)
 
             # Need to filter out local information
             pindex = {}
@@ -509,38 +1349,28 @@ class Layer_Index():
                     continue
                 pindex[entry] = lindex[entry]
 
-            json.dump(self.sortRestApi(pindex), open(fpath + '.json', 'wt'), indent=4)
-            return
+            utils_setup.write_if_changed(fpath + '.json', self.iter_canonical_json(pindex, compact))
+            return [fpath + '.json']
 
         # We serialize based on the layerBranches, this allows us to subset
         # everything in a logical way...
         if not layerBranches:
             layerBranches = lindex['layerBranches']
+
+        written = []
+        skip = ['CFG', 'apilinks', 'branches', 'layerBranches', 'layerItems']
+        partitions = self.__partition(lindex, skip)
         for lb in layerBranches:
             pindex = {}
 
-            def filter_item(lb, objects):
-                filtered = []
-                for obj in lindex[objects]:
-                    if 'layerbranch' in obj:
-                        if obj['layerbranch'] == lb['id']:
-                            filtered.append(obj)
-                    elif 'layer' in obj:
-                        for layer in self.find_layer(lindex, layerBranch=lb):
-                            if  obj['layer'] == layer['id']:
-                                filtered.append(obj)
-                    else:
-                        # No simple filter method, just include it...
-                        filtered.append(obj)
-                return filtered
-
+            layers = self.find_layer(lindex, layerBranch=lb)
             for entry in lindex:
-                if (IncludeCFG == False and 'CFG' == entry) or 'apilinks' == entry or 'branches' == entry or 'layerBranches' == entry or 'layerItems' == entry:
-                    continue
-                elif (IncludeCFG == True and 'CFG' == entry):
+                if (IncludeCFG == True and 'CFG' == entry):
                     pindex[entry] = lindex[entry]
                     continue
-                pindex[entry] = filter_item(lb, entry)
+                elif entry in skip:
+                    continue
+                pindex[entry] = self.__partitionFor(partitions[entry], lb, layers)
 
             for branch in lindex['branches']:
                 if branch['id'] == lb['branch']:
@@ -597,10 +1427,14 @@ class Layer_Index():
             fname = fname.translate(str.maketrans('/ ', '__'))
             fpath = os.path.join(dir, fname)
 
-            json.dump(self.sortRestApi(pindex), open(fpath + '.json', 'wt'), indent=4)
+            utils_setup.write_if_changed(fpath + '.json', self.iter_canonical_json(pindex, compact))
+            written.append(fpath + '.json')
+
+        return written
 
     # layerBranches must be a list of layerBranch entries to parse, it only affects
-    # output when 'split' is True.
+    # output when 'split' is True.  Files are only rewritten if their contents
+    # change, the list of files that make up the output is returned.
     def serialize_django_export(self, lindex, path, split=False, layerBranches=None, IncludeCFG=False):
         def convertToDjango(restindex):
             dbindex = []
@@ -661,38 +1495,30 @@ class Layer_Index():
                     continue
                 pindex[entry] = lindex[entry]
 
-            json.dump(convertToDjango(self.sortRestApi(pindex)), open(fpath + '.json', 'wt'), indent=4)
-            return
+            utils_setup.write_if_changed(fpath + '.json', json.JSONEncoder(indent=4).iterencode(convertToDjango(self.sortRestApi(pindex))))
+            return [fpath + '.json']
 
         # We serialize based on the layerBranches, this allows us to subset
         # everything in a logical way...
         if not layerBranches:
             layerBranches = lindex['layerBranches']
+
+        written = []
+        skip = ['apilinks', 'branches', 'layerBranches', 'layerItems']
+        if IncludeCFG == False:
+            skip.append('CFG')
+        partitions = self.__partition(lindex, skip)
         for lb in layerBranches:
             pindex = {}
 
-            def filter_item(lb, objects):
-                filtered = []
-                for obj in lindex[objects]:
-                    if 'layerbranch' in obj:
-                        if obj['layerbranch'] == lb['id']:
-                            filtered.append(obj)
-                    elif 'layer' in obj:
-                        for layer in self.find_layer(lindex, layerBranch=lb):
-                            if obj['layer'] == layer['id']:
-                                filtered.append(obj)
-                    else:
-                        # No simple filter method, just include it...
-                        filtered.append(obj)
-                return filtered
-
+            layers = self.find_layer(lindex, layerBranch=lb)
             for entry in lindex:
-                if (IncludeCFG == False and 'CFG' == entry) or 'apilinks' == entry or 'branches' == entry or 'layerBranches' == entry or 'layerItems' == entry:
+                if entry in skip:
                     continue
-                pindex[entry] = filter_item(lb, entry)
+                pindex[entry] = self.__partitionFor(partitions[entry], lb, layers)
 
             pindex['layerBranches'] = [lb]
-            pindex['layerItems'] = self.find_layer(lindex, layerBranch=lb)
+            pindex['layerItems'] = layers
 
             for branch in lindex['branches']:
                 if branch['id'] == lb['branch']:
@@ -704,7 +1530,93 @@ class Layer_Index():
             fname = fname.translate(str.maketrans('/ ', '__'))
             fpath = os.path.join(dir, fname)
 
-            json.dump(convertToDjango(self.sortRestApi(pindex)), open(fpath + '.json', 'wt'), indent=4)
+            utils_setup.write_if_changed(fpath + '.json', json.JSONEncoder(indent=4).iterencode(convertToDjango(self.sortRestApi(pindex))))
+            written.append(fpath + '.json')
+
+        return written
+
+    # Build the lookup tables used by find_layer, getLayerBranch, getBranch...
+    # The tables reference the objects in the lindex lists, so they are
+    # rebuilt automatically if a list is replaced or grows.  Anyone that
+    # replaces entries in place or changes a key (id, name, collection, ...)
+    # of an existing entry must call reindex() afterwards.
+    def reindex(self, lindex):
+        def group(table, key):
+            result = {}
+            if not self.__isLoaded(lindex, table):
+                # Built once the table is loaded, see __getLookup
+                return result
+            for pos, obj in enumerate(lindex.get(table) or []):
+                if key in obj:
+                    result.setdefault(obj[key], []).append((pos, obj))
+            return result
+
+        tables = {}
+        tables['branches:id'] = group('branches', 'id')
+        tables['branches:name'] = group('branches', 'name')
+        tables['layerItems:id'] = group('layerItems', 'id')
+        tables['layerItems:name'] = group('layerItems', 'name')
+        tables['layerBranches:id'] = group('layerBranches', 'id')
+        tables['layerBranches:layer'] = group('layerBranches', 'layer')
+        tables['layerBranches:collection'] = group('layerBranches', 'collection')
+        tables['YPCompatibleVersions:id'] = group('YPCompatibleVersions', 'id')
+        tables['distros:name'] = group('distros', 'name')
+        tables['machines:name'] = group('machines', 'name')
+        tables['recipes:pn'] = group('recipes', 'pn')
+        tables['wrtemplates:name'] = group('wrtemplates', 'name')
+        tables['layerDependencies:layerbranch'] = group('layerDependencies', 'layerbranch')
+
+        # layerBranch id -> (required, recommended), filled in by getDependencies
+        tables['dependencies'] = {}
+
+        branchLayer = {}
+        for lb in lindex.get('layerBranches') or []:
+            branchLayer.setdefault((lb['branch'], lb['layer']), []).append(lb)
+        tables['layerBranches:branch,layer'] = branchLayer
+
+        self.lookups[id(lindex)] = (lindex, self.__lookupSignature(lindex), tables)
+        return tables
+
+    def __lookupSignature(self, lindex):
+        signature = []
+        for table in ['branches', 'layerItems', 'layerBranches', 'layerDependencies', 'YPCompatibleVersions', 'distros', 'machines', 'recipes', 'wrtemplates']:
+            if not self.__isLoaded(lindex, table):
+                signature.append(None)
+            else:
+                signature.append((id(lindex.get(table)), len(lindex.get(table) or [])))
+        return tuple(signature)
+
+    # Is table of lindex loaded (see Lazy_Index)?
+    def __isLoaded(self, lindex, table):
+        return not isinstance(lindex, Lazy_Index) or lindex.is_loaded(table)
+
+    def __getLookups(self, lindex):
+        if id(lindex) in self.lookups:
+            (l_lindex, signature, tables) = self.lookups[id(lindex)]
+            if l_lindex is lindex and signature == self.__lookupSignature(lindex):
+                return tables
+        return self.reindex(lindex)
+
+    def __getLookup(self, lindex, key):
+        # A table that is loaded lazily is loaded the first time it is
+        # searched, this also invalidates the lookups.
+        if isinstance(lindex, Lazy_Index):
+            lindex.load(key.split(':')[0])
+        return self.__getLookups(lindex)[key]
+
+    # Return the objects (in list order) that have key == value
+    def __lookup(self, lindex, key, value):
+        return [obj for (_, obj) in self.__getLookup(lindex, key).get(value, [])]
+
+    # Return the objects of table (in list order) that belong to layerBranch
+    def __layerBranchObjects(self, lindex, table, layerBranch):
+        objects = lindex[table]
+        if self.database:
+            # The lookup tables are rebuilt when lindex changes, so they
+            # tell us when the database needs to be reloaded too.
+            self.database.load(id(lindex), lindex, self.__getLookups(lindex), table)
+            return [objects[pos] for pos in self.database.layerBranchObjects(id(lindex), table, layerBranch['id'])]
+        return [obj for obj in objects if obj['layerbranch'] == layerBranch['id']]
 
     def print_close_matches(self, key, value, full_list):
         msg = '%s "%s" not found' % (key, value)
@@ -719,36 +1631,25 @@ class Layer_Index():
         if layerBranch:
             id = layerBranch['layer']
 
-        # Only one layerItem per lindex, so break once we find it
+        # Only one layerItem per lindex, so stop once we find it
         if id:
-            for layer in lindex['layerItems']:
-                if layer['id'] == id:
-                    result.append(layer)
-                    if layerBranch:
-                        result[-1]['collection'] = layerBranch['collection']
-                    else:
-                        for branch in lindex['layerBranches']:
-                            if branch['layer'] == id:
-                                result[-1]['collection'] = branch['collection']
-                                break
-                    break
+            for layer in self.__lookup(lindex, 'layerItems:id', id)[:1]:
+                result.append(layer)
+                if layerBranch:
+                    result[-1]['collection'] = layerBranch['collection']
+                else:
+                    for branch in self.__lookup(lindex, 'layerBranches:layer', id)[:1]:
+                        result[-1]['collection'] = branch['collection']
             return result
 
         if name:
-            full_list = []
-            found = False
-            for layer in lindex['layerItems']:
-                value_from_index = layer['name']
-                full_list.append(value_from_index)
-                if value_from_index == name:
-                    result.append(layer)
-                    for branch in lindex['layerBranches']:
-                        if branch['layer'] == layer['id']:
-                            result[-1]['collection'] = branch['collection']
-                            break
-                    found = True
-                    break
-            if not found:
+            layers = self.__lookup(lindex, 'layerItems:name', name)
+            for layer in layers[:1]:
+                result.append(layer)
+                for branch in self.__lookup(lindex, 'layerBranches:layer', layer['id'])[:1]:
+                    result[-1]['collection'] = branch['collection']
+            if not layers:
+                full_list = [layer['name'] for layer in lindex['layerItems']]
                 self.print_close_matches('layer', name, full_list)
             return result
 
@@ -765,28 +1666,31 @@ class Layer_Index():
 
         for k, v in args.items():
             if v:
-                full_list = []
-                found = False
-                for index_dict in lindex[k]:
-                    if k == 'recipes':
-                        value_from_index = index_dict['pn']
-                    else:
-                        value_from_index = index_dict['name']
-                    full_list.append(value_from_index)
-                    if value_from_index == v:
-                        found = True
-                        layerBranchIds.append(index_dict['layerbranch'])
-                if not found:
+                if k == 'recipes':
+                    key = 'pn'
+                else:
+                    key = 'name'
+                objs = self.__lookup(lindex, '%s:%s' % (k, key), v)
+                for index_dict in objs:
+                    layerBranchIds.append(index_dict['layerbranch'])
+                if not objs:
+                    full_list = [index_dict[key] for index_dict in lindex[k]]
                     self.print_close_matches(k.rstrip('s'), v, full_list)
 
         if layerBranchIds:
-            for layerBranch in lindex['layerBranches']:
-                for layerBranchId in layerBranchIds:
-                    if layerBranch['id'] == layerBranchId:
-                        for layer in lindex['layerItems']:
-                            if layer['id'] == layerBranch['layer']:
-                                result.append(layer)
-                                result[-1]['collection'] = layerBranch['collection']
+            # Results are in layerBranches order, once for each time the
+            # layerBranch was referenced.
+            count = {}
+            for layerBranchId in layerBranchIds:
+                count[layerBranchId] = count.get(layerBranchId, 0) + 1
+            layerBranches = []
+            for layerBranchId in count:
+                layerBranches.extend(self.__getLookup(lindex, 'layerBranches:id').get(layerBranchId, []))
+            for (_, layerBranch) in sorted(layerBranches, key=lambda t: t[0]):
+                for _ in range(count[layerBranch['id']]):
+                    for layer in self.__lookup(lindex, 'layerItems:id', layerBranch['layer']):
+                        result.append(layer)
+                        result[-1]['collection'] = layerBranch['collection']
             return result
 
         return None
@@ -826,9 +1730,8 @@ class Layer_Index():
     def getYPCompatibleVersion(self, lindex, id):
         if not id:
             return []
-        for vers in lindex['YPCompatibleVersions']:
-            if vers['id'] == id:
-                return vers['name'].split()
+        for vers in self.__lookup(lindex, 'YPCompatibleVersions:id', id)[:1]:
+            return vers['name'].split()
         return []
 
     def list_obj(self, base_branch, object, display, compat='all'):
@@ -850,12 +1753,13 @@ class Layer_Index():
                         if compat not in self.getYPCompatibleVersion(lindex, lb['yp_compatible_version']):
                             continue
                     for layer in self.find_layer(lindex, layerBranch=lb):
-                        for obj in lindex[object]:
-                            if obj['layerbranch'] == lb['id'] and lb['branch'] == branchid:
-                                lname = layer['name']
-                                name = obj['name']
-                                description = (obj['description'] or name).strip()
-                                table.add_row([name, description, lname])
+                        if lb['branch'] != branchid:
+                            continue
+                        for obj in self.__layerBranchObjects(lindex, object, lb):
+                            lname = layer['name']
+                            name = obj['name']
+                            description = (obj['description'] or name).strip()
+                            table.add_row([name, description, lname])
                 s = table.draw()
                 logger.plain(s)
             logger.plain ('')
@@ -870,9 +1774,10 @@ class Layer_Index():
                         if compat not in self.getYPCompatibleVersion(lindex, lb['yp_compatible_version']):
                             continue
                     for layer in self.find_layer(lindex, layerBranch=lb):
-                        for obj in lindex['machines']:
-                            if obj['layerbranch'] == lb['id'] and lb['branch'] == branchid:
-                                machines.append(obj['name'])
+                        if lb['branch'] != branchid:
+                            continue
+                        for obj in self.__layerBranchObjects(lindex, 'machines', lb):
+                            machines.append(obj['name'])
         return machines
 
 
@@ -895,35 +1800,32 @@ class Layer_Index():
                 # there are more layerBranches then objects (usually)...
                 for lb in lindex['layerBranches']:
                     for layer in self.find_layer(lindex, layerBranch=lb):
-                        for obj in lindex['recipes']:
-                            if obj['layerbranch'] == lb['id'] and lb['branch'] == branchid:
-                                lname = layer['name']
-                                pn = obj['pn']
-                                pv = obj['pv']
-                                summary = (obj['summary'] or pn).strip()
-                                logger.plain('%s %s %s' % ('{:15}'.format(pn), '{:9}'.format(pv), summary[:50]))
+                        if lb['branch'] != branchid:
+                            continue
+                        for obj in self.__layerBranchObjects(lindex, 'recipes', lb):
+                            lname = layer['name']
+                            pn = obj['pn']
+                            pv = obj['pv']
+                            summary = (obj['summary'] or pn).strip()
+                            logger.plain('%s %s %s' % ('{:15}'.format(pn), '{:9}'.format(pv), summary[:50]))
             logger.plain ('')
 
     def getBranchId(self, lindex, name):
-        for branch in lindex['branches']:
-            if branch['name'] == name:
-                return branch['id']
+        for branch in self.__lookup(lindex, 'branches:name', name)[:1]:
+            return branch['id']
         return None
 
     def getLayerBranch(self, lindex, branchid, layerBranchId=None, collection=None, name=None, distro=None, machine=None, recipe=None, wrtemplate=None, layerItem=None):
         result = []
         if layerBranchId:
-            for lb in lindex['layerBranches']:
-                if branchid == lb['branch'] and layerBranchId == lb['id']:
+            for lb in self.__lookup(lindex, 'layerBranches:id', layerBranchId):
+                if branchid == lb['branch']:
                     result.append(lb)
                     break
             return result
 
         if collection:
-            for lb in lindex['layerBranches']:
-                if 'collection' in lb and collection == lb['collection']:
-                    result.append(lb)
-                    break
+            result.extend(self.__lookup(lindex, 'layerBranches:collection', collection)[:1])
             return result
 
         layerItems = []
@@ -953,19 +1855,21 @@ class Layer_Index():
                     layerItems = layerItems + layerItem
 
         if layerItems:
+            branchLayer = self.__getLookup(lindex, 'layerBranches:branch,layer')
             for layerItem in layerItems:
-                for lb in lindex['layerBranches']:
-                    if branchid == lb['branch'] and layerItem['id'] == lb['layer']:
-                        result.append(lb)
+                result.extend(branchLayer.get((branchid, layerItem['id']), []))
             return result
 
         return None
 
     def getDependencies(self, lindex, layerBranch):
-        required = []
-        recommended = []
-        for ld in lindex['layerDependencies']:
-            if layerBranch['id'] == ld['layerbranch']:
+        # The result only depends on the layerBranch, so it is computed once
+        # and then served from the dependency map of the index.
+        dependencies = self.__getLookup(lindex, 'dependencies')
+        if layerBranch['id'] not in dependencies:
+            required = []
+            recommended = []
+            for ld in self.__lookup(lindex, 'layerDependencies:layerbranch', layerBranch['id']):
                 layers = self.find_layer(lindex, id=ld['dependency'])
                 if (not layers or layers == []) and ld['required'] == True:
                     logger.warning('%s: Unable to find dependency %s -- Skipping' % (self.find_layer(lindex, layerBranch=layerBranch)[0]['name'], ld['dependency']))
@@ -979,8 +1883,10 @@ class Layer_Index():
                         else:
                             #print('li_getdep_dep: %s (%s) rec %s (%s)' % (self.find_layer(lindex, layerBranch=layerBranch)['name'], layerBranch['id'], self.find_layer(lindex, layerBranch=lb)['name'], ld['dependency']) )
                             recommended.append(lb)
+            dependencies[layerBranch['id']] = (required, recommended)
 
-        return (required, recommended)
+        (required, recommended) = dependencies[layerBranch['id']]
+        return (list(required), list(recommended))
 
     def getLayerInfo(self, lindex, layerBranch):
         collection = None
@@ -997,9 +1903,8 @@ class Layer_Index():
         return (collection, name, vcs_url)
 
     def getBranch(self, lindex, branchid):
-        for branch in lindex['branches']:
-            if branch['id'] == branchid:
-                return branch
+        for branch in self.__lookup(lindex, 'branches:id', branchid)[:1]:
+            return branch
         return None
 
     def getBitbakeBranch(self, lindex, branchid):
@@ -1012,3 +1917,17 @@ class Layer_Index():
         if lindex and 'CFG' in lindex and 'BRANCH' in lindex['CFG']:
             return lindex['CFG']['BRANCH']
         return default
+
+# Load one file of a mirror-index, run in a worker process by
+# Layer_Index.__load_mirror_files.  Only the CFG and entry are returned if
+# entry is given, otherwise everything but the LAZY_ENTRIES, so they are not
+# sent back to Layer_Index (or merged) until they are used.
+def _load_mirror_file(fpath, entry=None):
+    pindex = Layer_Index().load_serialized_index(fpath, name='Mirrored Index')
+    if not pindex:
+        return pindex
+    if entry:
+        return { 'CFG' : pindex['CFG'], entry : pindex[entry] }
+    for entry in LAZY_ENTRIES:
+        pindex.pop(entry, None)
+    return pindex
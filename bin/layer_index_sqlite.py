@@ -0,0 +1,93 @@
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# SQLite storage for the queries of the Layer_Index objects by layerBranch
+# (recipes, machines, distros, ...).
+#
+# The objects themselves stay in the Layer_Index (setup modifies them in
+# place), the database only holds their layerbranch and the position
+# ('pos') of each object in its table.  Queries return those positions, so
+# the caller can hand back the original objects.
+#
+# Each loaded index is identified by an 'idx' value chosen by the caller.
+# The database is private to one Layer_Index: it is either in memory, or
+# a temporary file made in the given directory, which is removed when the
+# Layer_Index_DB is closed (or garbage collected).  Existing databases are
+# never opened, so they can't be clobbered.
+
+import os
+import sqlite3
+import tempfile
+import weakref
+
+import logger_setup
+
+logger = logger_setup.setup_logging()
+
+SCHEMA = [
+    'CREATE TABLE objects (idx INTEGER, tbl TEXT, pos INTEGER, layerbranch INTEGER)',
+    'CREATE INDEX objects_idx_tbl_layerbranch ON objects (idx, tbl, layerbranch)',
+]
+
+def _close(db, path):
+    db.close()
+    if path:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+class Layer_Index_DB():
+    # path is ':memory:', or the directory of the temporary database file
+    def __init__(self, path=':memory:'):
+        tmpfile = None
+        if path != ':memory:':
+            (fd, tmpfile) = tempfile.mkstemp(prefix='layer-index-', suffix='.sqlite', dir=path)
+            os.close(fd)
+        self.path = tmpfile or path
+
+        # (idx, table) -> version of the index that was loaded, see load()
+        self.loaded = {}
+
+        logger.debug('Opening index database %s' % self.path)
+        self.db = sqlite3.connect(self.path)
+        self._finalizer = weakref.finalize(self, _close, self.db, tmpfile)
+        for sql in SCHEMA:
+            self.db.execute(sql)
+        self.db.commit()
+
+    def close(self):
+        self._finalizer()
+
+    # Load the table of lindex as idx, unless this version of it was
+    # already loaded.  version is any object that is replaced whenever the
+    # tables of lindex change.
+    def load(self, idx, lindex, version, table):
+        if self.loaded.get((idx, table)) is version:
+            return
+
+        logger.debug('Loading %s of index %s into %s...' % (table, idx, self.path))
+        self.db.execute('DELETE FROM objects WHERE idx = ? AND tbl = ?', (idx, table))
+        rows = ((idx, table, pos, obj.get('layerbranch')) for (pos, obj) in enumerate(lindex.get(table) or []))
+        self.db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?)', rows)
+        self.db.commit()
+        self.loaded[(idx, table)] = version
+        logger.debug('...loading %s of index %s into %s, done.' % (table, idx, self.path))
+
+    # The positions (in order) of the objects of table that belong to
+    # layerbranch
+    def layerBranchObjects(self, idx, table, layerbranch):
+        rows = self.db.execute('SELECT pos FROM objects WHERE idx = ? AND tbl = ? AND layerbranch = ? ORDER BY pos', (idx, table, layerbranch))
+        return [pos for (pos,) in rows]
@@ -36,7 +36,14 @@ PLAIN_LOG_LEVEL = 15
 TO_FILE_LOG_LEVEL = 1
 # NOTSET = 0
 
+# Command output is logged with extra=CMD_OUTPUT.  At most CMD_OUTPUT_RATE
+# lines of it are shown on the screen each second, the rest only goes to the
+# log file (if any).
+CMD_OUTPUT = { 'cmd_output' : True }
+CMD_OUTPUT_RATE = 50
+
 logger = None
+screen_handler = None
 
 def plain(self, message, *args, **kws):
     """Function to be added to the logger for plain log level support"""
@@ -53,13 +60,15 @@ def to_file(self, message, *args, **kws):
 def setup_logging(level=PLAIN_LOG_LEVEL, output=sys.stdout):
     """create the setup.py singleton logger."""
     global logger
+    global screen_handler
     if logger:
         return logger
 
     logger = logging.getLogger('setup.py')
 
     formatter = ScreenFormatter("%(levelname)s: %(message)s")
-    stream_h = logging.StreamHandler(output)
+    stream_h = ScreenHandler(output)
+    screen_handler = stream_h
     stream_h.setFormatter(formatter)
 
     # Logging timezone is UTC
@@ -75,8 +84,9 @@ def setup_logging(level=PLAIN_LOG_LEVEL, output=sys.stdout):
 
 class FileFormatter(logging.Formatter):
     def format(self, record):
-        # FileHandler doesn't need color
-        record.levelname = record.levelname_orig
+        # FileHandler doesn't need color (records the screen did not show
+        # were not colored)
+        record.levelname = getattr(record, 'levelname_orig', record.levelname)
         return logging.Formatter.format(self, record)
 
 def setup_logging_file(log_file):
@@ -95,6 +105,46 @@ def setup_logging_file(log_file):
 
 
 
+def show_suppressed():
+    """Show how many lines of command output were not shown on the screen"""
+    if screen_handler:
+        screen_handler.show_suppressed()
+        # The next command starts with a new budget of lines
+        screen_handler.window = None
+
+class ScreenHandler(logging.StreamHandler):
+    """StreamHandler that rate limits command output, see CMD_OUTPUT."""
+
+    def __init__(self, stream=None):
+        logging.StreamHandler.__init__(self, stream)
+        self.window = None
+        self.count = 0
+        self.suppressed = 0
+
+    def show_suppressed(self):
+        if self.suppressed:
+            suppressed = self.suppressed
+            self.suppressed = 0
+            self.acquire()
+            try:
+                self.stream.write('... %d line(s) of output not shown ...%s' % (suppressed, self.terminator))
+                self.flush()
+            finally:
+                self.release()
+
+    def emit(self, record):
+        if getattr(record, 'cmd_output', False):
+            window = int(time.time())
+            if window != self.window:
+                self.window = window
+                self.count = 0
+            self.count += 1
+            if self.count > CMD_OUTPUT_RATE:
+                self.suppressed += 1
+                return
+        self.show_suppressed()
+        logging.StreamHandler.emit(self, record)
+
 class ScreenFormatter(logging.Formatter):
     """ScreenFormatter exists to allow printing plain messages with a different
     format than other log levels.
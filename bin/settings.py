@@ -4,6 +4,10 @@
 #        restapi-files - REST API, but only from files
 #        export        - Exported DB from a LayerIndex-web -- reads file(s)
 
+# An index with 'INCREMENTAL' : True (restapi-web only) is refreshed from
+# its cache, only fetching the objects updated since the last load.  The
+# layer index must support the 'updated__gte' filter.
+
 # url/path may contain:
 #  #INSTALL_DIR# which is replaced by the setup directory
 #  #BASE_URL# which is replaced by the base url for setup directory
@@ -32,6 +36,21 @@ INDEXES = [
 #    },
 ]
 
+# Optional SQLite database used by the layer index for queries over the
+# larger tables (recipes, machines, ...).  None disables it, ':memory:'
+# keeps it in memory, anything else is the directory where a temporary
+# database file is made for each run.
+INDEX_DATABASE = None
+
+# Rerunning setup with the same arguments within this many seconds of the
+# last successful run returns right away, as long as the project files,
+# the .repo manifest, the setup installation and the indexes are unchanged.
+# The mirror-index is checked against its remote, and the index files and
+# caches for changes, but remote indexes (without a mirror-index) and the
+# layers are not fetched again, so a rerun within this time would not pick
+# up their updates.  0 (the default) disables this.
+NOOP_MAX_AGE = 0
+
 # Bitbake URL on the same server at openembedded-core
 # bitbake is assumed to be at the same basepath as OpenEmbedded-Core
 BITBAKE = "bitbake"
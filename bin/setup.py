@@ -16,6 +16,9 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 # Please keep these sorted.
+import contextlib
+import hashlib
+import json
 import logging
 import os
 import shutil
@@ -32,7 +35,7 @@ import utils_setup
 import logger_setup
 from argparse_wrl import Argparse_Wrl
 
-from layer_index import Layer_Index
+from layer_index import Layer_Index, Lazy_Index
 
 import settings
 import sanity
@@ -66,6 +69,11 @@ class Setup():
     BINTOOLS_SSL_CERT= "/bin/buildtools/sysroots/x86_64-wrlinuxsdk-linux/etc/ssl/certs/ca-certificates.crt"
 
     def __init__(self):
+        # Timing of the phases of this run, see timed() and write_profile()
+        self.profile = { 'start' : time.time(), 'phases' : [], 'counts' : {} }
+        self.profile_file = None
+        self.profile_phase = None
+
         # Set various default values
         # Default -j for repo init
         self.jobs = str(settings.REPO_JOBS)
@@ -81,6 +89,8 @@ class Setup():
         self.mirror = False
 
         self.mirror_index_path = None
+        # Where the mirror-index was fetched from, see load_mirror_index
+        self.mirror_index_url = None
 
         # Make/Use the project mirror as PREMIRRORS for do_fetch
         self.mirror_as_premirrors = False
@@ -96,6 +106,8 @@ class Setup():
         self.dl_layers = False
         self.local_layers = []
         self.remote_layers = []
+        # (lindex, layerBranch, layer) overridden by a remote layer
+        self.remote_overrides = []
 
         # The extra layer groups enabled by user
         self.use_layer_groups = []
@@ -127,6 +139,14 @@ class Setup():
         if 'REPO_REV' in os.environ:
             self.repo_rev = os.environ['REPO_REV']
 
+        # Optional directory where the layer index cache is shared with other projects
+        self.index_cache = None
+        if 'INDEX_CACHE' in os.environ:
+            self.index_cache = os.path.abspath(os.environ['INDEX_CACHE'])
+
+        # Optional profiling of the run, see utils_setup.start_profiling
+        self.profiler = os.getenv(utils_setup.PROFILE_ENV)
+
         self.debug_lvl = 0
 
         self.repo_no_fetch = False
@@ -146,6 +166,12 @@ class Setup():
         # Save current base_branch to compare with next one
         self.saved_base_branch = os.path.join(self.conf_dir, 'saved_base_branch')
 
+        # Layers, remotes and replacements computed by the last run, see load_resolution
+        self.saved_resolution = os.path.join(self.conf_dir, 'saved_resolution.json')
+
+        # State of the last successful run, see check_noop
+        self.saved_run = os.path.join(self.conf_dir, 'saved_run.json')
+
         # Environment setup
         self.env = os.environ.copy()
 
@@ -170,8 +196,55 @@ class Setup():
 
     def exit(self, ret=0):
         logger.debug("setup.py finished (ret=%s)" % (ret))
+        self.write_profile(ret)
         sys.exit(ret)
 
+    # Time the phase name of this run.  Phases may be nested, the name of
+    # a nested phase is prefixed with the name of the phase it is part of.
+    @contextlib.contextmanager
+    def timed(self, name):
+        parent = self.profile_phase
+        if parent:
+            name = '%s/%s' % (parent, name)
+        self.profile_phase = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.profile['phases'].append({ 'name' : name, 'start' : start - self.profile['start'], 'duration' : time.time() - start })
+            self.profile_phase = parent
+
+    # Write the profile of this run (phase durations and counts) as json
+    # next to the log file, and log a one line summary of it.
+    def write_profile(self, ret):
+        if not self.profile_file:
+            return
+
+        counts = self.profile['counts']
+        counts['requiredlayers'] = len(self.requiredlayers)
+        counts['recommendedlayers'] = len(self.recommendedlayers)
+        counts['fetch_requests'] = utils_setup.fetch_stats['requests']
+        counts['fetch_bytes'] = utils_setup.fetch_stats['bytes']
+
+        phases = self.profile['phases']
+        profile = {
+            'args' : self.setup_args,
+            'base_branch' : self.base_branch,
+            'ret' : ret,
+            'duration' : time.time() - self.profile['start'],
+            'phases' : sorted(phases, key=lambda p: p['start']),
+            'counts' : counts,
+        }
+        try:
+            utils_setup.write_if_changed(self.profile_file, json.dumps(profile, sort_keys=True, indent=4))
+        except OSError as e:
+            logger.warning('Unable to write %s: %s' % (self.profile_file, e))
+            return
+
+        summary = ', '.join('%s %.2fs' % (p['name'], p['duration']) for p in profile['phases'] if '/' not in p['name'])
+        logger.plain('Setup took %.1fs (%s), %d layers, %d bytes fetched.' % (profile['duration'], summary or 'no phases',
+                counts['requiredlayers'] + counts['recommendedlayers'], counts['fetch_bytes']))
+
     def start_file_logging(self):
         log_dir = os.path.join(self.conf_dir, self.class_log_dir)
         if not os.path.exists(log_dir):
@@ -179,6 +252,8 @@ class Setup():
 
         log_file = '%s/%s.log' % (log_dir, time.strftime('%Y-%m-%d-%H:%M:%S+0000', time.gmtime()))
         logger_setup.setup_logging_file(log_file)
+        self.profile_file = log_file[:-len('.log')] + '.profile.json'
+        utils_setup.start_tracing(log_file[:-len('.log')] + '.trace.json')
 
     def main(self, orig_args):
         parser = Argparse_Wrl(self)
@@ -191,6 +266,8 @@ class Setup():
 
         self.start_file_logging()
 
+        utils_setup.start_profiling(os.path.join(self.conf_dir, self.class_log_dir), 'setup', self.profiler)
+
         logger.debug('REPO_URL = %s' % self.repo_url)
         logger.debug('REPO_BRANCH = %s' % self.repo_rev)
 
@@ -200,6 +277,15 @@ class Setup():
         if not self.base_branch:
             logger.error('Unable to determine base branch, you may need to specify --base-branch=')
 
+        # Taken before load_layer_index, which may adjust the base url
+        self.run_args = self.get_run_args()
+        if self.base_url and self.base_branch and self.check_noop():
+            self.exit(0)
+
+        # A run that fails part way must not be mistaken for a successful one
+        if os.path.exists(self.saved_run):
+            os.unlink(self.saved_run)
+
         # Check for require host tools for real project
         if not self.mirror:
             sanity.check_hosttools(self.tool_list)
@@ -213,7 +299,8 @@ class Setup():
         if None in self.tools.values():
             sys.exit(1)
 
-        self.load_layer_index()
+        with self.timed('load_layer_index'):
+            self.load_layer_index()
 
         if len(self.index.index) == 0:
             logger.critical('No indexes could be loaded.  This could be due to an invalid branch or tag.  Exiting...')
@@ -268,46 +355,180 @@ class Setup():
         if self.wrtemplates != []:
             logger.plain('Setting templates to "%s"' % (",".join(self.wrtemplates)))
 
-        self.process_layers()
+        with self.timed('process_layers'):
+            resolution_key = self.get_resolution_key()
+            resolved = self.load_resolution(resolution_key)
+            if not resolved:
+                self.process_layers()
 
-        self.project_setup()
+        with self.timed('project_setup'):
+            self.project_setup()
+
+        with self.timed('prep_replacements'):
+            if not resolved:
+                self.__prep_replacements()
+                self.save_resolution(resolution_key)
 
-        self.__prep_replacements()
         if self.mirror != True:
             # We only want to do this if we're not mirroring...
-            self.update_project()
+            with self.timed('update_project'):
+                self.update_project()
         else:
             # Setup an index for others to use if we're mirroring...
-            self.update_mirror()
-            self.update_mirror_index()
+            with self.timed('update_mirror'):
+                self.update_mirror()
+            with self.timed('update_mirror_index'):
+                self.update_mirror_index()
 
-        self.update_manifest()
+        with self.timed('update_manifest'):
+            self.update_manifest()
 
-        self.check_default_xml()
+            self.check_default_xml()
 
-        self.update_gitignore()
+            self.update_gitignore()
 
-        self.commit_files()
+        with self.timed('commit_files'):
+            self.commit_files()
 
         self.check_project_path()
 
-        self.repo_sync()
+        with self.timed('repo_sync'):
+            self.repo_sync()
 
         if self.mirror_as_premirrors:
-            if self.mirror:
-                self.make_mirror_as_premirrors()
-            else:
-                self.use_mirror_as_premirrors()
+            with self.timed('premirrors'):
+                if self.mirror:
+                    self.make_mirror_as_premirrors()
+                else:
+                    self.use_mirror_as_premirrors()
+
+        self.save_run_state()
 
         self.exit(0)
 
+    # The arguments and environment a run of setup depends on
+    def get_run_args(self):
+        return {
+            'args' : self.setup_args,
+            'base_url' : self.base_url,
+            'base_branch' : self.base_branch,
+            'buildtools_branch' : self.buildtools_branch,
+            'buildtools_remote' : self.buildtools_remote,
+            'another_buildtools_remote' : self.another_buildtools_remote,
+            'repo_url' : self.repo_url,
+            'repo_rev' : self.repo_rev,
+            'index_cache' : self.index_cache,
+            }
+
+    # Everything (besides the layers themselves) that a run of setup depends
+    # on, see check_noop.  index_paths are the local files the indexes were
+    # loaded from (see Layer_Index.paths), and mirror_index the mirror-index
+    # directory, if any.
+    def get_run_state(self, index_paths, mirror_index):
+        install_files = ['data'] + [os.path.join('bin', f) for f in sorted(os.listdir(os.path.join(self.install_dir, 'bin'))) if f.endswith('.py')]
+        project_files = [
+            'README',
+            'default.xml',
+            '.gitignore',
+            '.gitconfig',
+            '.templateconf',
+            'layers/local',
+            'config/bblayers.conf.sample',
+            'config/conf-notes.txt',
+            'config/local.conf.sample',
+            'config/site.conf.sample',
+            'config/saved_base_branch',
+            '.repo/manifest.xml',
+            '.repo/project.list',
+            ]
+
+        return {
+            'args' : self.run_args,
+            'install' : utils_setup.digest_paths(install_files, base=self.install_dir),
+            'project' : utils_setup.digest_paths(project_files, base=self.project_dir),
+            'index' : utils_setup.digest_paths(index_paths),
+            'mirror_index' : mirror_index and self.get_git_head(mirror_index),
+            }
+
+    # The commit checked out in the git repository at path, or None
+    def get_git_head(self, path):
+        cmd = [self.which('git'), 'rev-parse', 'HEAD']
+        try:
+            p = utils_setup.run(cmd, check=True, cwd=path, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except (OSError, TypeError, subprocess.CalledProcessError):
+            return None
+        return p.stdout.decode('utf-8').strip()
+
+    # Is commit what the base branch (or tag) of the git repository at url
+    # points to?
+    def check_git_head(self, url, commit):
+        cmd = [self.which('git'), 'ls-remote', url, self.base_branch, self.base_branch + '^{}']
+        try:
+            p = utils_setup.run(cmd, check=True, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except (OSError, TypeError, subprocess.CalledProcessError):
+            return False
+        return commit in [line.split()[0] for line in p.stdout.decode('utf-8').splitlines() if line.strip()]
+
+    # Is this a rerun of the last successful run, with nothing changed since
+    # then (see settings.NOOP_MAX_AGE)?  The mirror-index is checked against
+    # its remote, and the index caches and files for changes.  A remote index
+    # without a mirror-index can't be checked without fetching it, so the
+    # run is only skipped within NOOP_MAX_AGE seconds of the last one.
+    def check_noop(self):
+        if not settings.NOOP_MAX_AGE or not os.path.exists(self.saved_run):
+            return False
+
+        try:
+            with open(self.saved_run, 'r') as f:
+                saved = json.load(f)
+            age = time.time() - saved['time']
+            if age < 0 or age >= settings.NOOP_MAX_AGE:
+                logger.debug('Last run was %d seconds ago' % age)
+                return False
+            if saved['state'] != self.get_run_state(saved['index_paths'], saved['mirror_index']):
+                logger.debug('Project, arguments or indexes changed since the last run')
+                return False
+            if saved['mirror_index'] and not self.check_git_head(saved['mirror_index_url'], saved['state']['mirror_index']):
+                logger.debug('The mirror-index changed since the last run')
+                return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug('Unable to use %s: %s' % (self.saved_run, e))
+            return False
+
+        logger.plain('Nothing changed since the last run %d seconds ago, skipping setup.' % age)
+        return True
+
+    def save_run_state(self):
+        if not settings.NOOP_MAX_AGE:
+            return
+
+        # The next run is only skipped if it would load the same indexes,
+        # which can't be told for a mirror-index of unknown origin
+        # (windshare), or an index that isn't cached.
+        if self.mirror_index_path and not self.mirror_index_url:
+            logger.debug('Not saving the run state, the mirror-index can not be checked')
+            return
+        if not self.index.snapshot(entries=['recipes'] if self.recipes else []):
+            logger.debug('Not saving the run state, the indexes can not be checked')
+            return
+
+        index_paths = [os.path.abspath(path) for path in self.index.paths]
+        saved = {
+            'time' : time.time(),
+            'index_paths' : index_paths,
+            'mirror_index' : self.mirror_index_path,
+            'mirror_index_url' : self.mirror_index_url,
+            'state' : self.get_run_state(index_paths, self.mirror_index_path),
+            }
+        utils_setup.write_if_changed(self.saved_run, json.dumps(saved, sort_keys=True, indent=4))
+
     def check_project_path(self):
         self.manifest_dir = os.path.join(self.project_dir, '.repo/manifests.git')
         project_dir_last = ""
         if os.path.exists(self.manifest_dir):
             cmd = [self.tools['git'], 'config', '--get', 'remote.origin.url']
             try:
-                p = subprocess.run(cmd, check=True, cwd=self.manifest_dir, stdout=subprocess.PIPE)
+                p = utils_setup.run(cmd, check=True, cwd=self.manifest_dir, stdout=subprocess.PIPE)
                 project_dir_last = p.stdout.decode('utf-8').strip()
             except Exception as e:
                 logger.warning('Failed to run "%s": %s' % (' '.join(cmd), e))
@@ -317,7 +538,7 @@ class Setup():
             logger.info('project dir has been changed from %s to %s' % (project_dir_last, self.project_dir))
             logger.info('Updating config files for new project dir...')
             cmd = [self.tools['git'], 'config', 'remote.origin.url', self.project_dir]
-            subprocess.run(cmd, cwd=self.manifest_dir)
+            utils_setup.run(cmd, cwd=self.manifest_dir)
 
     def load_mirror_index(self, remote_mirror, folder=""):
         # See if there is a mirror index available from the BASE_URL
@@ -358,6 +579,7 @@ class Setup():
         cmd = [self.tools['git'], 'reset', '--hard' ]
         utils_setup.run_cmd(cmd, log=2, environment=self.env, cwd=mirror_index)
 
+        self.mirror_index_url = remote_mirror
         return mirror_index
 
     def check_base_branch(self):
@@ -380,7 +602,7 @@ class Setup():
 
         repo = self.tools['repo']
         cmd = [repo, 'status']
-        with subprocess.Popen(cmd, stdout=subprocess.PIPE, env=self.env, cwd=self.project_dir) as proc:
+        with utils_setup.Popen(cmd, stdout=subprocess.PIPE, env=self.env, cwd=self.project_dir) as proc:
             output = proc.stdout.read().decode('utf-8')
             if re.search('^project\s+layers/.*\s+branch', output, flags=re.M):
                 logger.error("Found checked out branches, here is the output from 'repo status':\n%s" % output)
@@ -399,14 +621,17 @@ class Setup():
             ws = Windshare(debug=self.debug_lvl)
 
             # Determine if this is a windshare install
-            (ws_base_url, ws_base_folder, ws_entitlement_url) = ws.get_windshare_urls(self.base_url)
-            if ws_base_url and ws_base_url != "" and ws.load_folders(ws_entitlement_url):
+            with self.timed('windshare'):
+                (ws_base_url, ws_base_folder, ws_entitlement_url) = ws.get_windshare_urls(self.base_url)
+                windshare = ws_base_url and ws_base_url != "" and ws.load_folders(ws_entitlement_url)
+            if windshare:
                 logger.plain('Detected Windshare configuration.  Processing entitlements and indexes.')
 
-                for folder in ws.folders:
-                    self.mirror_index_path = ws.load_mirror_index(self, ws_base_url, folder)
+                with self.timed('windshare_mirror_index'):
+                    for folder in ws.folders:
+                        self.mirror_index_path = ws.load_mirror_index(self, ws_base_url, folder)
 
-                ws.write_local_mirror_index(self, self.mirror_index_path)
+                    ws.write_local_mirror_index(self, self.mirror_index_path)
 
                 # We need to adjust the base_url so everything works properly...
                 self.base_url = ws_base_url
@@ -423,7 +648,8 @@ class Setup():
 
         # Check if we have a mirror-index, and load it if we do...
         if not self.mirror_index_path:
-            self.mirror_index_path = self.load_mirror_index(self.base_url + '/mirror-index')
+            with self.timed('mirror_index'):
+                self.mirror_index_path = self.load_mirror_index(self.base_url + '/mirror-index')
 
             # Is this a tag? if so... we only pull from mirror-indexes
             if not self.mirror_index_path and self.base_branch.startswith('refs/tags/'):
@@ -445,7 +671,19 @@ class Setup():
                    ( '#BASE_BRANCH#', self.base_branch ),
                   ]
 
-        self.index = Layer_Index(indexcfg=settings.INDEXES, base_branch=self.base_branch, replace=replace, mirror=self.mirror_index_path)
+        with self.timed('layer_index'):
+            self.index = Layer_Index(indexcfg=settings.INDEXES, base_branch=self.base_branch, replace=replace, mirror=self.mirror_index_path, database=settings.INDEX_DATABASE, shared_cache=self.index_cache)
+
+        # Number of objects loaded, a table that is loaded lazily is only
+        # counted if it was loaded already
+        objects = self.profile['counts'].setdefault('objects', {})
+        for lindex in self.index.index:
+            for table in lindex:
+                if table in ['CFG', 'apilinks']:
+                    continue
+                if isinstance(lindex, Lazy_Index) and not lindex.is_loaded(table):
+                    continue
+                objects[table] = objects.get(table, 0) + len(lindex[table] or [])
 
         # Is this a Wind River tag? if so... we need to modify the 'branches' entries to be the same as the tag
         if self.base_branch.startswith('refs/tags/vWRLINUX'):
@@ -465,6 +703,8 @@ class Setup():
                         branch['bitbake_branch'] = self.base_branch
                     if branch and branch['name'] == new_base_branch:
                         branch['name'] = self.base_branch
+                # Branch names are lookup keys, so the lookups need to be refreshed
+                self.index.reindex(lindex)
 
     def is_group_layer(self, layer_name):
         """
@@ -489,6 +729,232 @@ class Setup():
 
         return False
 
+    # The layer resolution (process_layers and __prep_replacements) only
+    # depends on the layer selection arguments, the indexes and the settings,
+    # so it is saved and reused while none of them change.  Returns None if
+    # the indexes can't be identified.
+    def get_resolution_key(self):
+        # The recipes are only part of the snapshot if they were cached
+        snapshot = self.index.snapshot(entries=['recipes'] if self.recipes else [])
+        if not snapshot:
+            return None
+
+        with open(settings.__file__, 'rb') as f:
+            settings_digest = hashlib.sha256(f.read()).hexdigest()
+
+        args = {
+            'base_url' : self.base_url,
+            'base_branch' : self.base_branch,
+            'mirror' : self.mirror,
+            'distros' : self.distros,
+            'machines' : self.machines,
+            'layers' : self.layers,
+            'recipes' : self.recipes,
+            'wrtemplates' : self.wrtemplates,
+            'all_layers' : self.all_layers,
+            'dl_layers' : self.dl_layers,
+            'no_recommend' : self.no_recommend,
+            'local_layers' : self.local_layers,
+            'remote_layers' : self.remote_layers,
+            'use_layer_groups' : self.use_layer_groups,
+            'extra_group_keys' : self.extra_group_keys,
+            'index' : snapshot,
+            'settings' : settings_digest,
+        }
+        return hashlib.sha256(json.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # Restore the layers, remotes, remote layer overrides and replacements
+    # saved by save_resolution, if they were saved with the same key.
+    # Returns True if they were.
+    def load_resolution(self, key):
+        if not key or not os.path.exists(self.saved_resolution):
+            return False
+
+        try:
+            with open(self.saved_resolution, 'r') as f:
+                saved = json.load(f)
+            if saved['key'] != key:
+                logger.debug('%s is out of date' % self.saved_resolution)
+                return False
+
+            layerBranches = {}
+            for lindex in self.index.index:
+                layerBranches[id(lindex)] = { lb['id'] : lb for lb in lindex['layerBranches'] }
+
+            def restore(layers):
+                result = []
+                for (pos, lbid) in layers:
+                    lindex = self.index.index[pos]
+                    result.append( (lindex, layerBranches[id(lindex)][lbid]) )
+                return result
+
+            requiredlayers = restore(saved['requiredlayers'])
+            recommendedlayers = restore(saved['recommendedlayers'])
+
+            # The remote layers overriding an index layer, as process_layers does
+            overrides = []
+            for (pos, lbid, layerid, vcs_url, actual_branch) in saved['remote_overrides']:
+                lindex = self.index.index[pos]
+                layer = self.index.find_layer(lindex, id=layerid)[0]
+                overrides.append( (lindex, layerBranches[id(lindex)][lbid], layer, vcs_url, actual_branch) )
+            remote_layers = saved['remote_layers']
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            logger.debug('Unable to use %s: %s' % (self.saved_resolution, e))
+            return False
+
+        logger.plain('Using the layers computed by the previous run...')
+        self.requiredlayers = requiredlayers
+        self.recommendedlayers = recommendedlayers
+        for (lindex, layerBranch, layer, vcs_url, actual_branch) in overrides:
+            layer['vcs_url'] = vcs_url
+            layerBranch['actual_branch'] = actual_branch
+            self.remote_overrides.append( (lindex, layerBranch, layer) )
+        # remote layers with the overrides removed
+        self.remote_layers = remote_layers
+        self.remotes = saved['remotes']
+        self.replacement['layers'] = saved['replacement']['layers']
+        self.replacement['machines'] = saved['replacement']['machines']
+        self.replacement['distros'] = saved['replacement']['distros']
+        return True
+
+    def save_resolution(self, key):
+        if not key:
+            return
+
+        positions = { id(lindex) : pos for (pos, lindex) in enumerate(self.index.index) }
+        saved = {
+            'key' : key,
+            'requiredlayers' : [ (positions[id(lindex)], lb['id']) for (lindex, lb) in self.requiredlayers ],
+            'recommendedlayers' : [ (positions[id(lindex)], lb['id']) for (lindex, lb) in self.recommendedlayers ],
+            'remotes' : self.remotes,
+            'remote_layers' : self.remote_layers,
+            'remote_overrides' : [ (positions[id(lindex)], lb['id'], layer['id'], layer['vcs_url'], lb['actual_branch']) for (lindex, lb, layer) in self.remote_overrides ],
+            'replacement' : {
+                'layers' : self.replacement['layers'],
+                'machines' : self.replacement['machines'],
+                'distros' : self.replacement['distros'],
+            },
+        }
+
+        os.makedirs(self.conf_dir, exist_ok=True)
+        utils_setup.write_if_changed(self.saved_resolution, json.dumps(saved, sort_keys=True, indent=4))
+
+    # Map each collection and layer name to the first index (in INDEXES
+    # order) that provides it, as (position, lindex, layerBranches).  Also
+    # returns the position of each index, keyed by id(lindex).
+    def get_layer_providers(self):
+        priority = {}
+        collections = {}
+        names = {}
+        for (pos, lindex) in enumerate(self.index.index):
+            priority[id(lindex)] = pos
+            branchid = self.index.getBranchId(lindex, self.get_branch(lindex=lindex))
+
+            # layerItem id -> layerBranches on the branch, in list order
+            branchLayers = {}
+            for lb in lindex['layerBranches']:
+                collection = lb.get('collection')
+                if collection and collection not in collections:
+                    collections[collection] = (pos, lindex, [lb])
+                if lb['branch'] == branchid:
+                    branchLayers.setdefault(lb['layer'], []).append(lb)
+
+            # Only the first layerItem of a given name is used for an index
+            seen = set()
+            for layer in lindex['layerItems']:
+                name = layer['name']
+                if name in seen:
+                    continue
+                seen.add(name)
+                if name not in names and layer['id'] in branchLayers:
+                    names[name] = (pos, lindex, branchLayers[layer['id']])
+
+        return (priority, collections, names)
+
+    # Process the queues of (lindex, layerBranch) into self.requiredlayers
+    # and self.recommendedlayers, following the dependencies of each layer.
+    # A layer that is also available from an earlier index (in INDEXES
+    # order) is replaced by the one from that index.
+    def resolve_layers(self, requiredQueue, recommendedQueue):
+        (priority, collections, names) = self.get_layer_providers()
+
+        # Set of 'collection' and layer 'name'.  This is used to avoid
+        # including duplicates.  Collection is matched first, then name -- as not
+        # all layer indexes may contain 'collection'
+        depCacheCol = set()
+        depCacheName = set()
+
+        def checkCache(lindex, layerBranch, addCache=False):
+            (collection, name, vcs_url) = self.index.getLayerInfo(lindex, layerBranch=layerBranch)
+
+            if collection in depCacheCol or name in depCacheName:
+                return True
+
+            if addCache:
+                if collection:
+                    depCacheCol.add(collection)
+                if name:
+                    depCacheName.add(name)
+            return False
+
+        def resolveIndexOrder(lindex, layerBranch, Queue):
+            # We want to recompute the dependency in INDEXES order...
+            (collection, name, vcs_url) = self.index.getLayerInfo(lindex, layerBranch)
+
+            # Look for the collection (or name if no collection) in the indexes
+            # before this one, within an index the collection wins.
+            provider = None
+            for (key, providers) in [(collection, collections), (name, names)]:
+                if key and key in providers:
+                    if not provider or providers[key][0] < provider[0]:
+                        provider = providers[key]
+
+            if not provider or provider[0] >= priority.get(id(lindex), len(priority)):
+                # We already know it'll be in this index, so we just use it as-is...
+                return (lindex, layerBranch)
+
+            (pos, pindex, new_layerBranches) = provider
+            for lb in new_layerBranches:
+                logger.info('Resolving dependency %s from %s to %s from %s' % (name, lindex['CFG']['DESCRIPTION'], name, pindex['CFG']['DESCRIPTION']))
+                Queue.append( (pindex, lb) )
+            return (None, None)
+
+        while requiredQueue:
+            (lindex, layerBranch) = requiredQueue.popleft()
+
+            (lindex, layerBranch) = resolveIndexOrder(lindex, layerBranch, requiredQueue)
+
+            if not lindex or not layerBranch:
+                continue
+
+            if not checkCache(lindex, layerBranch, True):
+                self.requiredlayers.append( (lindex, layerBranch) )
+                (required, recommended) = self.index.getDependencies(lindex, layerBranch)
+                for dep in required:
+                    requiredQueue.append( (lindex, dep) )
+
+                for dep in recommended:
+                    recommendedQueue.append( (lindex, dep) )
+
+        while recommendedQueue:
+            (lindex, layerBranch) = recommendedQueue.popleft()
+
+            (lindex, layerBranch) = resolveIndexOrder(lindex, layerBranch, recommendedQueue)
+
+            if not lindex or not layerBranch:
+                continue
+
+            if not checkCache(lindex, layerBranch, True):
+                if self.dl_layers != True:
+                    layers = self.index.find_layer(lindex, id=layerBranch['layer'])
+                    if layers and ('-dl-' in layers[0]['name'] or layers[0]['name'].endswith('-dl')):
+                        # Skip the download layer
+                        continue
+                self.recommendedlayers.append( (lindex, layerBranch) )
+                (required, recommended) = self.index.getDependencies(lindex, layerBranch)
+                for dep in required + recommended:
+                    recommendedQueue.append( (lindex, dep) )
+
     def process_layers(self):
         from collections import deque
 
@@ -606,95 +1072,7 @@ class Setup():
                             requiredQueue.append( (lindex, layerBranch) )
 
         # Compute requires and recommended layers...
-
-        # List of 'collection' and layer 'name'.  This list is used to avoid
-        # including duplicates.  Collection is matched first, then name -- as not
-        # all layer indexes may contain 'collection'
-        depCacheCol = []
-        depCacheName = []
-
-        def checkCache(lindex, layerBranch, addCache=False):
-            (collection, name, vcs_url) = self.index.getLayerInfo(lindex, layerBranch=layerBranch)
-
-            if collection in depCacheCol or name in depCacheName:
-                return True
-
-            if addCache:
-                if collection:
-                    depCacheCol.append(collection)
-                if name:
-                    depCacheName.append(name)
-            return False
-
-        def resolveIndexOrder(lindex, layerBranch, Queue):
-            # We want to recompute the dependency in INDEXES order...
-            (collection, name, vcs_url) = self.index.getLayerInfo(lindex, layerBranch)
-            found = False
-            for pindex in self.index.index:
-                # We already know it'll be in this index, so we just use it as-is...
-                if pindex == lindex:
-                    break
-
-                # Look for the collection (or name if no collection) in the indexes in
-                # priority order...
-                pbranchid = self.index.getBranchId(pindex, self.get_branch(lindex=pindex))
-                if collection:
-                    new_layerBranches = self.index.getLayerBranch(pindex, pbranchid, collection=collection)
-                    if new_layerBranches and new_layerBranches != []:
-                        for lb in new_layerBranches:
-                            logger.info('Resolving dependency %s from %s to %s from %s' % (name, lindex['CFG']['DESCRIPTION'], name, pindex['CFG']['DESCRIPTION']))
-                            Queue.append( (pindex, lb) )
-                        lindex = None
-                        layerBranch = None
-                        break
-
-                if name:
-                    new_layerBranches = self.index.getLayerBranch(pindex, pbranchid, name=name)
-                    if new_layerBranches and new_layerBranches != []:
-                        for lb in new_layerBranches:
-                            logger.info('Resolving dependency %s from %s to %s from %s' % (name, lindex['CFG']['DESCRIPTION'], name, pindex['CFG']['DESCRIPTION']))
-                            Queue.append( (pindex, lb) )
-                        lindex = None
-                        layerBranch = None
-                        break
-
-            return (lindex, layerBranch)
-
-        while requiredQueue:
-            (lindex, layerBranch) = requiredQueue.popleft()
-
-            (lindex, layerBranch) = resolveIndexOrder(lindex, layerBranch, requiredQueue)
-
-            if not lindex or not layerBranch:
-                continue
-
-            if not checkCache(lindex, layerBranch, True):
-                self.requiredlayers.append( (lindex, layerBranch) )
-                (required, recommended) = self.index.getDependencies(lindex, layerBranch)
-                for dep in required:
-                    requiredQueue.append( (lindex, dep) )
-
-                for dep in recommended:
-                    recommendedQueue.append( (lindex, dep) )
-
-        while recommendedQueue:
-            (lindex, layerBranch) = recommendedQueue.popleft()
-
-            (lindex, layerBranch) = resolveIndexOrder(lindex, layerBranch, recommendedQueue)
-
-            if not lindex or not layerBranch:
-                continue
-
-            if not checkCache(lindex, layerBranch, True):
-                if self.dl_layers != True:
-                    layers = self.index.find_layer(lindex, id=layerBranch['layer'])
-                    if layers and ('-dl-' in layers[0]['name'] or layers[0]['name'].endswith('-dl')):
-                        # Skip the download layer
-                        continue
-                self.recommendedlayers.append( (lindex, layerBranch) )
-                (required, recommended) = self.index.getDependencies(lindex, layerBranch)
-                for dep in required + recommended:
-                    recommendedQueue.append( (lindex, dep) )
+        self.resolve_layers(requiredQueue, recommendedQueue)
 
         unexpected_groups = []
         for (lindex, layerBranch) in self.requiredlayers + self.recommendedlayers:
@@ -796,6 +1174,7 @@ class Setup():
                     if remote_layer.get('path') == path:
                         layer['vcs_url'] = remote_layer.get('url')
                         layerBranch['actual_branch'] = remote_layer.get('branch')
+                        self.remote_overrides.append( (lindex, layerBranch, layer) )
                         found = True
                         break
                 if found:
@@ -955,13 +1334,6 @@ class Setup():
             cmd = [self.tools['git'], 'checkout', self.base_branch]
             utils_setup.run_cmd(cmd, log=2, environment=self.env, cwd=path)
 
-        # Make sure the directory is empty, use -f to ignore failures
-        for (dirpath, dirnames, filenames) in os.walk(path):
-            if dirpath.endswith('/.git') or path + '/.git' in dirpath:
-                continue
-            for filename in filenames:
-                os.remove(os.path.join(dirpath, filename))
-
         # Construct a list of all layers we've downloaded, by url, including sublayers not activated
         url_cache = {}
         for (lindex, layerBranch) in self.requiredlayers + self.recommendedlayers:
@@ -971,34 +1343,65 @@ class Setup():
                     url_cache[vcs_url] = []
                 url_cache[vcs_url].append((lindex, layerBranch['branch']))
 
-        # Serialize the information for each of the layers (and their sublayers)
+        # Collect the layerBranches of each of the layers (and their sublayers),
+        # each index and branch only needs to be processed once
+        exports = {}
+        layers = []
         for vcs_url in url_cache:
             for (lindex, branchid) in url_cache[vcs_url]:
+                (_, layerBranches, branchids) = exports.setdefault(id(lindex), (lindex, [], set()))
+                if branchid in branchids:
+                    continue
+                branchids.add(branchid)
                 for layer in lindex['layerItems']:
                     if layer['vcs_url'] in url_cache:
-                        for lb in self.index.getLayerBranch(lindex, branchid=branchid, layerItem=layer):
-                            self.index.serialize_index(lindex, os.path.join(path, lindex['CFG']['DESCRIPTION']), split=True, layerBranches=[lb], IncludeCFG=True, mirror=True, base_url=self.base_url)
-                        name = layer['name']
-                        destdir = os.path.join(path, 'xml')
-                        srcfile = os.path.join(self.xml_dir, '%s.inc' % (name))
-                        if os.path.exists(srcfile):
-                            os.makedirs(destdir, exist_ok=True)
-                            shutil.copy(srcfile, destdir)
-                        srcfile = os.path.join(self.xml_dir, '%s.xml' % (name))
-                        if os.path.exists(srcfile):
-                            os.makedirs(destdir, exist_ok=True)
-                            shutil.copy(srcfile, destdir)
-
-                        # Special processing for the openembedded-core layer
-                        if name == 'openembedded-core':
-                            srcfile = os.path.join(self.xml_dir, 'bitbake.inc')
-                            if os.path.exists(srcfile):
-                                os.makedirs(destdir, exist_ok=True)
-                                shutil.copy(srcfile, destdir)
-                            srcfile = os.path.join(self.xml_dir, 'bitbake.xml')
-                            if os.path.exists(srcfile):
-                                os.makedirs(destdir, exist_ok=True)
-                                shutil.copy(srcfile, destdir)
+                        layerBranches.extend(self.index.getLayerBranch(lindex, branchid=branchid, layerItem=layer))
+                        if layer['name'] not in layers:
+                            layers.append(layer['name'])
+
+        # Serialize the information for each of the layers, one pass per index.
+        # Only changed files are rewritten, anything not written is obsolete.
+        written = set()
+        for (lindex, layerBranches, _) in exports.values():
+            if layerBranches:
+                written.update(self.index.serialize_index(lindex, os.path.join(path, lindex['CFG']['DESCRIPTION']), split=True, layerBranches=layerBranches, IncludeCFG=True, mirror=True, base_url=self.base_url))
+
+        # Copy the xml files of each of the layers
+        for name in layers:
+            destdir = os.path.join(path, 'xml')
+            srcfile = os.path.join(self.xml_dir, '%s.inc' % (name))
+            if os.path.exists(srcfile):
+                os.makedirs(destdir, exist_ok=True)
+                utils_setup.copy_if_changed(srcfile, destdir)
+                written.add(os.path.join(destdir, os.path.basename(srcfile)))
+            srcfile = os.path.join(self.xml_dir, '%s.xml' % (name))
+            if os.path.exists(srcfile):
+                os.makedirs(destdir, exist_ok=True)
+                utils_setup.copy_if_changed(srcfile, destdir)
+                written.add(os.path.join(destdir, os.path.basename(srcfile)))
+
+            # Special processing for the openembedded-core layer
+            if name == 'openembedded-core':
+                srcfile = os.path.join(self.xml_dir, 'bitbake.inc')
+                if os.path.exists(srcfile):
+                    os.makedirs(destdir, exist_ok=True)
+                    utils_setup.copy_if_changed(srcfile, destdir)
+                    written.add(os.path.join(destdir, os.path.basename(srcfile)))
+                srcfile = os.path.join(self.xml_dir, 'bitbake.xml')
+                if os.path.exists(srcfile):
+                    os.makedirs(destdir, exist_ok=True)
+                    utils_setup.copy_if_changed(srcfile, destdir)
+                    written.add(os.path.join(destdir, os.path.basename(srcfile)))
+
+        # Remove obsolete files only
+        written = set(os.path.normpath(fpath) for fpath in written)
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            if dirpath.endswith('/.git') or path + '/.git' in dirpath:
+                continue
+            for filename in filenames:
+                if os.path.normpath(os.path.join(dirpath, filename)) not in written:
+                    logger.debug('mirror-index remove obsolete %s' % os.path.join(dirpath, filename))
+                    os.remove(os.path.join(dirpath, filename))
 
         # git add file.
         cmd = [self.tools['git'], 'add', '-A', '.']
@@ -1301,7 +1704,7 @@ class Setup():
             shutil.rmtree(self.premirrors_dl_downloads)
         os.mkdir(self.premirrors_dl_downloads)
         cmd = 'cp -alf %s/*-dl*/downloads/* %s' % (self.premirrors_dl, self.premirrors_dl_downloads)
-        subprocess.run(cmd, shell=True)
+        utils_setup.run(cmd, shell=True)
         logger.info('The PREMIRROR files are prepared in %s' % self.premirrors_dl_downloads)
 
     def use_mirror_as_premirrors(self):
@@ -1373,6 +1776,14 @@ class Setup():
                     '/environment-setup-*',
                     '/layers/*',
                     '!layers/local',
+                    '/config/index-cache/*.pickle',
+                    '/config/index-cache/*.http',
+                    # Run profiles, traces and profiler reports, see
+                    # write_profile and utils_setup.start_profiling
+                    '/config/log/*.profile.json',
+                    '/config/log/*.trace.json',
+                    '/config/log/*.pstats',
+                    '/config/log/*.memory.txt',
                     os.path.basename(self.install_dir),
                     ]
 
@@ -1402,9 +1813,12 @@ class Setup():
             'default.xml',
             '.gitignore',
             '.gitconfig',
-            'config/index-cache',
             ]
 
+        # The index cache is only in the project without --index-cache
+        if not self.index_cache and os.path.exists('config/index-cache'):
+            filelist.append('config/index-cache')
+
         # If we are mirroring, skip all of these...
         if self.mirror != True:
             filelist.append('layers/local')
@@ -1726,6 +2140,14 @@ class Setup():
         logger.debug('Setting base-branch to %s' % branch)
         self.base_branch = branch
 
+    def set_index_cache(self, path):
+        logger.debug('Setting index-cache to %s' % path)
+        self.index_cache = os.path.abspath(path)
+
+    def set_profiler(self, mode):
+        logger.debug('Setting profile to %s' % mode)
+        self.profiler = mode
+
     def set_debug_env(self):
         self.env["REPO_CURL_VERBOSE"] = '1'
 
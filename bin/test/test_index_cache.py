@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# Tests of the index caches of Layer_Index: the binary cache, and the
+# cache shared between projects (--index-cache).
+
+import os
+import sys
+import copy
+import glob
+import json
+import stat
+import shutil
+import struct
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from layer_index import Layer_Index, BINARY_MAGIC, BINARY_VERSION
+
+import utils_setup
+
+UPDATED = '2018-01-01T00:00:00+0000'
+
+INDEX = {
+    'branches' : [
+        { 'id' : 1, 'name' : 'master', 'bitbake_branch' : 'master', 'updated' : UPDATED },
+    ],
+    'layerItems' : [
+        { 'id' : 1, 'name' : 'openembedded-core', 'vcs_url' : 'git://git.example.com/openembedded-core', 'updated' : UPDATED },
+        { 'id' : 2, 'name' : 'meta-wr', 'vcs_url' : 'git://git.example.com/meta-wr', 'updated' : UPDATED },
+    ],
+    'layerBranches' : [
+        { 'id' : 1, 'layer' : 1, 'branch' : 1, 'collection' : 'core', 'actual_branch' : '', 'updated' : UPDATED },
+        { 'id' : 2, 'layer' : 2, 'branch' : 1, 'collection' : 'wr', 'actual_branch' : '', 'updated' : UPDATED },
+    ],
+    'layerDependencies' : [
+        { 'id' : 1, 'layerbranch' : 2, 'dependency' : 1, 'required' : True, 'updated' : UPDATED },
+    ],
+    'recipes' : [
+        { 'id' : 1, 'layerbranch' : 1, 'pn' : 'busybox', 'pv' : '1.29', 'updated' : UPDATED },
+        { 'id' : 2, 'layerbranch' : 2, 'pn' : 'wr-init', 'pv' : '1.0', 'updated' : UPDATED },
+    ],
+}
+
+class IndexCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.indexfile = os.path.join(self.dir, 'index.json')
+        self.write_index(INDEX)
+        self.cache = os.path.join(self.dir, 'project', 'index-cache', 'test')
+
+    def tearDown(self):
+        # Anything made read-only by the test
+        for (dirpath, dirnames, filenames) in os.walk(self.dir):
+            os.chmod(dirpath, 0o755)
+        shutil.rmtree(self.dir)
+
+    # Returns the Layer_Index, and the number of times the index file was
+    # loaded (instead of the binary cache)
+    def load(self, shared_cache=None, mirror=None, check=True):
+        cfg = { 'DESCRIPTION' : 'test', 'TYPE' : 'restapi-files', 'URL' : self.indexfile, 'CACHE' : self.cache }
+        with self.count_loads() as loaded:
+            index = Layer_Index(indexcfg=[cfg], base_branch='master', mirror=mirror, shared_cache=shared_cache)
+        self.assertEqual(len(index.index), 1)
+        if check:
+            self.check_index(index.index[0])
+        return (index, loaded.call_count)
+
+    # Count the calls of load_serialized_index
+    def count_loads(self):
+        load_serialized_index = Layer_Index.load_serialized_index
+        return mock.patch.object(Layer_Index, 'load_serialized_index', autospec=True, side_effect=load_serialized_index)
+
+    def header(self):
+        (header, _) = Layer_Index().load_binary_index(self.cache + '.pickle', lambda header: True, lambda header, entry: list)
+        return header
+
+    def write_index(self, index):
+        self.index = index
+        with open(self.indexfile, 'w') as f:
+            json.dump(index, f)
+
+    def check_index(self, lindex):
+        for entry in self.index:
+            self.assertEqual(lindex[entry], self.index[entry])
+
+class TestSharedCache(IndexCacheTest):
+    def setUp(self):
+        super().setUp()
+        self.shared = os.path.join(self.dir, 'shared')
+
+    def entries(self):
+        return glob.glob(os.path.join(self.shared, 'uid-%d' % os.getuid(), '*', 'test.pickle'))
+
+    def test_shared(self):
+        (_, loaded) = self.load(self.shared)
+        self.assertEqual(loaded, 1)
+        self.assertEqual(len(self.entries()), 1)
+        self.assertFalse(os.path.exists(os.path.dirname(self.cache)))
+        # Other users can add their own entries
+        self.assertEqual(os.stat(self.shared).st_mode & 0o7777, 0o1777)
+
+        (_, loaded) = self.load(self.shared)
+        self.assertEqual(loaded, 0)
+
+    def test_not_a_directory(self):
+        with open(self.shared, 'w') as f:
+            f.write('not a directory')
+        (_, loaded) = self.load(self.shared)
+        self.assertEqual(loaded, 1)
+        self.assertTrue(os.path.exists(self.cache + '.pickle'))
+
+        (_, loaded) = self.load(self.shared)
+        self.assertEqual(loaded, 0)
+
+    def test_writable_by_others(self):
+        # Someone else may have made the user's directory
+        userdir = os.path.join(self.shared, 'uid-%d' % os.getuid())
+        os.makedirs(userdir)
+        os.chmod(userdir, 0o777)
+        (_, loaded) = self.load(self.shared)
+        self.assertEqual(loaded, 1)
+        self.assertEqual(os.listdir(userdir), [])
+        self.assertTrue(os.path.exists(self.cache + '.pickle'))
+
+    @unittest.skipUnless(os.getuid() == 0, 'only root can give a directory to another user')
+    def test_other_owner(self):
+        userdir = os.path.join(self.shared, 'uid-%d' % os.getuid())
+        os.makedirs(userdir)
+        os.chown(userdir, 65534, 65534)
+        (_, loaded) = self.load(self.shared)
+        self.assertEqual(loaded, 1)
+        self.assertEqual(os.listdir(userdir), [])
+        self.assertTrue(os.path.exists(self.cache + '.pickle'))
+
+    @unittest.skipIf(os.getuid() == 0, 'root can write to read-only directories')
+    def test_read_only(self):
+        os.makedirs(self.shared)
+        os.chmod(self.shared, 0o555)
+        (_, loaded) = self.load(self.shared)
+        self.assertEqual(loaded, 1)
+        self.assertTrue(os.path.exists(self.cache + '.pickle'))
+
+class TestBinaryCache(IndexCacheTest):
+    def setUp(self):
+        super().setUp()
+        (_, loaded) = self.load()
+        self.assertEqual(loaded, 1)
+
+    # The offset of the section of entry in the binary cache
+    def section_offset(self, entry):
+        with open(self.cache + '.pickle', 'rb') as f:
+            data = f.read()
+        (version, hlen) = struct.unpack('>II', data[len(BINARY_MAGIC):len(BINARY_MAGIC) + 8])
+        offset = len(BINARY_MAGIC) + 8 + hlen
+        for (s_entry, length, digest) in json.loads(data[offset - hlen:offset].decode('utf-8'))['SECTIONS']:
+            if s_entry == entry:
+                return offset
+            offset += length
+        self.fail('No %s section' % entry)
+
+    def overwrite(self, offset, data):
+        with open(self.cache + '.pickle', 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    # The broken cache is not used, and is replaced by a good one
+    def check_reloaded(self):
+        (_, loaded) = self.load()
+        self.assertEqual(loaded, 1)
+        (_, loaded) = self.load()
+        self.assertEqual(loaded, 0)
+
+    def test_cached(self):
+        (_, loaded) = self.load()
+        self.assertEqual(loaded, 0)
+
+    def test_wrong_magic(self):
+        self.overwrite(0, b'X')
+        self.check_reloaded()
+
+    def test_wrong_version(self):
+        self.overwrite(len(BINARY_MAGIC), struct.pack('>I', BINARY_VERSION + 1))
+        self.check_reloaded()
+
+    def test_corrupt_section(self):
+        self.overwrite(self.section_offset('layerBranches') + 8, b'X')
+        self.check_reloaded()
+
+    def test_corrupt_lazy_section(self):
+        # Only noticed when the recipes are used, they are loaded again
+        self.overwrite(self.section_offset('recipes') + 8, b'X')
+        (index, loaded) = self.load(check=False)
+        self.assertEqual(loaded, 0)
+        with self.count_loads() as loaded:
+            self.check_index(index.index[0])
+        self.assertEqual(loaded.call_count, 1)
+
+    def test_truncated(self):
+        os.truncate(self.cache + '.pickle', os.stat(self.cache + '.pickle').st_size - 1)
+        self.check_reloaded()
+
+    def test_stale_source(self):
+        index = copy.deepcopy(INDEX)
+        index['recipes'][0]['pv'] = '1.30'
+        self.write_index(index)
+        self.check_reloaded()
+
+    def test_writable_by_others(self):
+        os.chmod(self.cache + '.pickle', 0o666)
+        self.check_reloaded()
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache + '.pickle').st_mode), 0o644 & ~utils_setup._umask)
+
+    @unittest.skipUnless(os.getuid() == 0, 'only root can give a file to another user')
+    def test_other_owner(self):
+        os.chown(self.cache + '.pickle', 65534, 65534)
+        self.check_reloaded()
+        self.assertEqual(os.stat(self.cache + '.pickle').st_uid, os.getuid())
+
+class TestLazyEntries(IndexCacheTest):
+    def test_binary_section(self):
+        self.load()
+        (index, loaded) = self.load(check=False)
+        self.assertEqual(loaded, 0)
+        lindex = index.index[0]
+        self.assertFalse(lindex.is_loaded('recipes'))
+        self.assertEqual(lindex['recipes'], INDEX['recipes'])
+
+    def test_binary_section_changed(self):
+        self.load()
+        (index, _) = self.load(check=False)
+
+        # Replaced (by another project) before the recipes are used, they
+        # are loaded from the index itself
+        shutil.copy(self.cache + '.pickle', self.cache + '.new')
+        os.replace(self.cache + '.new', self.cache + '.pickle')
+        with self.count_loads() as loaded:
+            self.assertEqual(index.index[0]['recipes'], INDEX['recipes'])
+        self.assertEqual(loaded.call_count, 1)
+
+    # The mirror-index files are loaded in directory order
+    def recipes(self, index):
+        return sorted(index.index[0]['recipes'], key=lambda recipe: recipe['id'])
+
+    def test_mirror(self):
+        mirror = os.path.join(self.dir, 'mirror-index')
+        os.makedirs(mirror)
+        lindex = Layer_Index().load_serialized_index(self.indexfile)
+        lindex['CFG'] = { 'DESCRIPTION' : 'test' }
+        Layer_Index().serialize_index(lindex, os.path.join(mirror, 'test'), split=True, IncludeCFG=True, mirror=True)
+
+        # The recipes are parsed again when they are used, and not cached
+        (index, _) = self.load(mirror=mirror, check=False)
+        self.assertTrue(index.index[0].is_deferred('recipes'))
+        self.assertEqual(self.header()['DEFERRED'], ['recipes'])
+        self.assertEqual(self.recipes(index), INDEX['recipes'])
+
+        (index, _) = self.load(mirror=mirror, check=False)
+        self.assertTrue(index.index[0].is_deferred('recipes'))
+        self.assertEqual(self.recipes(index), INDEX['recipes'])
+
+        # Only covered by the snapshot as the mirror-index is
+        self.assertIsNotNone(index.snapshot(entries=['recipes']))
+
+if __name__ == '__main__':
+    unittest.main()
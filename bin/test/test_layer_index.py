@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# Tests of Layer_Index.load_API_Index, against a small REST API served
+# from this process.
+
+import os
+import sys
+import json
+import datetime
+import shutil
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from layer_index import Layer_Index
+
+import utils_setup
+
+UPDATED = '2018-01-01T00:00:00+0000'
+
+class RestApi():
+    """
+        The tables of a layer index, and the filters load_API_Index uses on
+        them: 'field:value1ORvalue2,...', where branch__name and
+        layerbranch__branch__name are the name of the branch, and
+        updated__gte is a minimum updated time.  'fields=id' lists only
+        the ids.  requests lists the entries that were requested, queries
+        their queries.  hook(entry, query) is called after each request.
+    """
+    def __init__(self, tables):
+        self.tables = tables
+        self.requests = []
+        self.queries = []
+        self.hook = None
+
+    def branch_name(self, branchid):
+        for branch in self.tables['branches']:
+            if branch['id'] == branchid:
+                return branch['name']
+
+    def field(self, obj, field):
+        if field == 'branch__name':
+            return self.branch_name(obj['branch'])
+        if field == 'layerbranch__branch__name':
+            for lb in self.tables['layerBranches']:
+                if lb['id'] == obj['layerbranch']:
+                    return self.branch_name(lb['branch'])
+        return '%s' % obj[field]
+
+    def get(self, entry, query):
+        self.requests.append(entry)
+        self.queries.append((entry, query))
+        objs = self.tables[entry]
+        query = parse_qs(query)
+        for filter in ','.join(query.get('filter', [])).split(','):
+            if not filter:
+                continue
+            (field, values) = filter.split(':', 1)
+            if field == 'updated__gte':
+                objs = [ obj for obj in objs if parse_time(obj['updated']) >= parse_time(values) ]
+                continue
+            values = values.split('OR')
+            objs = [ obj for obj in objs if self.field(obj, field) in values ]
+        if query.get('fields') == ['id']:
+            objs = [ { 'id' : obj['id'] } for obj in objs ]
+        if self.hook:
+            self.hook(entry, query)
+        return objs
+
+def parse_time(updated):
+    return datetime.datetime.strptime(updated[:19], '%Y-%m-%dT%H:%M:%S')
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+0000')
+
+def serve(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            up = urlparse(self.path)
+            entry = up.path.strip('/')
+            if not entry:
+                (host, port) = self.server.server_address
+                data = { name : 'http://%s:%d/%s/' % (host, port, name) for name in api.tables }
+            elif entry in api.tables:
+                data = api.get(entry, up.query)
+            else:
+                self.send_error(404)
+                return
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_tables(layers):
+    """
+        layers is a list of (name, [branch names]), every layer is on
+        master or thud.  There is no distros table, so load_API_Index
+        emulates it.
+    """
+    tables = {
+        'branches' : [
+            { 'id' : 1, 'name' : 'master', 'bitbake_branch' : 'master', 'updated' : UPDATED },
+            { 'id' : 2, 'name' : 'thud', 'bitbake_branch' : '1.40', 'updated' : UPDATED },
+        ],
+        'layerItems' : [],
+        'layerBranches' : [],
+        'layerDependencies' : [],
+        'machines' : [],
+        'recipes' : [],
+    }
+    branchids = { branch['name'] : branch['id'] for branch in tables['branches'] }
+    for (layerid, (name, branches)) in enumerate(layers, 1):
+        tables['layerItems'].append({ 'id' : layerid, 'name' : name, 'vcs_url' : 'git://git.example.com/%s' % name, 'updated' : UPDATED })
+        for branch in branches:
+            tables['layerBranches'].append({ 'id' : len(tables['layerBranches']) + 1, 'layer' : layerid, 'branch' : branchids[branch],
+                                             'collection' : name, 'actual_branch' : '', 'updated' : UPDATED })
+    return tables
+
+# Close the connections fetch_url kept open to the servers
+def close_connections():
+    with utils_setup._pool_lock:
+        for conns in utils_setup._pool.values():
+            for conn in conns:
+                conn.close()
+        utils_setup._pool.clear()
+
+class TestLoadAPIIndex(unittest.TestCase):
+    def load(self, layers, branches):
+        server = serve(RestApi(make_tables(layers)))
+        try:
+            return Layer_Index().load_API_Index('http://127.0.0.1:%d/' % server.server_address[1], 'test', branches=branches)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def tearDown(self):
+        close_connections()
+
+    def test_nodistro(self):
+        lindex = self.load([ ('openembedded-core', ['master', 'thud']), ('meta-wr', ['master']) ], 'master')
+        self.assertEqual([ distro['name'] for distro in lindex['distros'] ], ['nodistro'])
+        self.assertEqual(lindex['distros'][0]['layerbranch'], 1)
+
+    def test_nodistro_without_oe_core(self):
+        # openembedded-core is not on master, so its layerItem is not fetched
+        lindex = self.load([ ('openembedded-core', ['thud']), ('meta-wr', ['master']) ], 'master')
+        self.assertEqual([ layer['name'] for layer in lindex['layerItems'] ], ['meta-wr'])
+        self.assertEqual(lindex['distros'], [])
+
+    def test_lazy_recipes(self):
+        tables = make_tables([ ('openembedded-core', ['master']) ])
+        tables['recipes'].append({ 'id' : 1, 'layerbranch' : 1, 'pn' : 'busybox', 'updated' : UPDATED })
+        api = RestApi(tables)
+        server = serve(api)
+        try:
+            lindex = Layer_Index().load_API_Index('http://127.0.0.1:%d/' % server.server_address[1], 'test', branches='master')
+            self.assertIn('recipes', lindex)
+            self.assertFalse(lindex.is_loaded('recipes'))
+            self.assertNotIn('recipes', api.requests)
+
+            self.assertEqual(lindex['recipes'], tables['recipes'])
+            self.assertEqual(api.requests.count('recipes'), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_cached_lazy_recipes(self):
+        tables = make_tables([ ('openembedded-core', ['master']) ])
+        tables['recipes'].append({ 'id' : 1, 'layerbranch' : 1, 'pn' : 'busybox', 'updated' : UPDATED })
+        api = RestApi(tables)
+        server = serve(api)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cfg = { 'DESCRIPTION' : 'test', 'TYPE' : 'restapi-web', 'URL' : 'http://127.0.0.1:%d/' % server.server_address[1],
+                    'CACHE' : os.path.join(tmpdir, 'project', 'test') }
+            index = Layer_Index(indexcfg=[dict(cfg)], base_branch='master', shared_cache=os.path.join(tmpdir, 'shared'))
+            self.assertNotIn('recipes', api.requests)
+
+            # The recipes were not cached, they are fetched when they are used
+            del api.requests[:]
+            index = Layer_Index(indexcfg=[dict(cfg)], base_branch='master', shared_cache=os.path.join(tmpdir, 'shared'))
+            self.assertEqual(api.requests, [])
+            self.assertTrue(index.index[0].is_deferred('recipes'))
+            self.assertEqual(index.index[0]['recipes'], tables['recipes'])
+            self.assertEqual(api.requests.count('recipes'), 1)
+
+            # and the snapshot doesn't identify them
+            self.assertIsNotNone(index.snapshot())
+            self.assertIsNone(index.snapshot(entries=['recipes']))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmpdir)
+
+class TestRefreshTable(unittest.TestCase):
+    def setUp(self):
+        self.tables = make_tables([ ('openembedded-core', ['master']), ('meta-wr', ['master']), ('meta-old', ['master']) ])
+        self.api = RestApi(self.tables)
+        self.server = serve(self.api)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+        close_connections()
+
+    def load(self):
+        cfg = { 'DESCRIPTION' : 'test', 'TYPE' : 'restapi-web', 'URL' : 'http://127.0.0.1:%d/' % self.server.server_address[1],
+                'CACHE' : os.path.join(self.dir, 'test'), 'INCREMENTAL' : True }
+        del self.api.queries[:]
+        index = Layer_Index(indexcfg=[cfg], base_branch='master')
+        return index.index[0]
+
+    def layerBranches(self, lindex):
+        return sorted(lindex['layerBranches'], key=lambda lb: lb['id'])
+
+    def refreshed(self):
+        return [ query for (entry, query) in self.api.queries if entry == 'layerBranches' ]
+
+    def test_unchanged(self):
+        self.load()
+        lindex = self.load()
+        self.assertEqual(self.layerBranches(lindex), self.tables['layerBranches'])
+        # The updates, then the listing of the ids
+        self.assertEqual(len(self.refreshed()), 2)
+        self.assertIn('updated__gte', self.refreshed()[0])
+        self.assertIn('fields=id', self.refreshed()[1])
+
+    def test_updated_added_deleted(self):
+        self.load()
+        self.tables['layerBranches'][1]['actual_branch'] = 'next'
+        self.tables['layerBranches'][1]['updated'] = now()
+        del self.tables['layerBranches'][2]
+        self.tables['layerBranches'].append({ 'id' : 4, 'layer' : 1, 'branch' : 1, 'collection' : 'core2', 'actual_branch' : '', 'updated' : now() })
+
+        lindex = self.load()
+        self.assertEqual(self.layerBranches(lindex), self.tables['layerBranches'])
+        self.assertEqual(len(self.refreshed()), 2)
+
+    def test_race(self):
+        self.load()
+
+        # Right after the updates are fetched, one object is updated and
+        # another is added (with an earlier 'updated' time)
+        def hook(entry, query):
+            if entry == 'layerBranches' and 'updated__gte' in ','.join(query.get('filter', [])):
+                self.api.hook = None
+                self.tables['layerBranches'][0]['actual_branch'] = 'next'
+                self.tables['layerBranches'][0]['updated'] = now()
+                self.tables['layerBranches'].append({ 'id' : 4, 'layer' : 1, 'branch' : 1, 'collection' : 'core2', 'actual_branch' : '', 'updated' : UPDATED })
+        self.api.hook = hook
+
+        # The added object is fetched by its id
+        lindex = self.load()
+        self.assertEqual(len(self.refreshed()), 3)
+        self.assertIn('id:4', self.refreshed()[2])
+        self.assertEqual([ lb['id'] for lb in self.layerBranches(lindex) ], [1, 2, 3, 4])
+        self.assertEqual(lindex['layerBranches'][0]['actual_branch'], '')
+
+        # The update is after the server time of the updates, so it's found
+        # by the next refresh
+        lindex = self.load()
+        self.assertEqual(self.layerBranches(lindex), self.tables['layerBranches'])
+        self.assertEqual(len(self.refreshed()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# Tests of the optional SQLite database of Layer_Index (layer_index_sqlite)
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from layer_index import Layer_Index
+from layer_index_sqlite import Layer_Index_DB
+
+UPDATED = '2018-01-01T00:00:00+0000'
+
+INDEX = {
+    'branches' : [
+        { 'id' : 1, 'name' : 'master', 'bitbake_branch' : 'master', 'updated' : UPDATED },
+        { 'id' : 2, 'name' : 'thud', 'bitbake_branch' : '1.40', 'updated' : UPDATED },
+    ],
+    'layerItems' : [
+        { 'id' : 1, 'name' : 'openembedded-core', 'vcs_url' : 'git://git.example.com/openembedded-core', 'updated' : UPDATED },
+        { 'id' : 2, 'name' : 'meta-bsp', 'vcs_url' : 'git://git.example.com/meta-bsp', 'updated' : UPDATED },
+    ],
+    'layerBranches' : [
+        { 'id' : 1, 'layer' : 1, 'branch' : 1, 'collection' : 'core', 'actual_branch' : '', 'updated' : UPDATED },
+        { 'id' : 2, 'layer' : 2, 'branch' : 1, 'collection' : 'bsp', 'actual_branch' : '', 'updated' : UPDATED },
+        { 'id' : 3, 'layer' : 2, 'branch' : 2, 'collection' : 'bsp', 'actual_branch' : '', 'updated' : UPDATED },
+    ],
+    'machines' : [
+        { 'id' : 1, 'layerbranch' : 2, 'name' : 'bsp-b', 'updated' : UPDATED },
+        { 'id' : 2, 'layerbranch' : 1, 'name' : 'qemux86', 'updated' : UPDATED },
+        { 'id' : 3, 'layerbranch' : 3, 'name' : 'bsp-thud', 'updated' : UPDATED },
+        { 'id' : 4, 'layerbranch' : 2, 'name' : 'bsp-a', 'updated' : UPDATED },
+    ],
+}
+
+class TestIndexDatabase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.indexfile = os.path.join(self.dir, 'index.json')
+        with open(self.indexfile, 'w') as f:
+            json.dump(INDEX, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, database=None):
+        cfg = { 'DESCRIPTION' : 'test', 'TYPE' : 'restapi-files', 'URL' : self.indexfile, 'CACHE' : os.path.join(self.dir, 'cache', 'test') }
+        return Layer_Index(indexcfg=[cfg], base_branch='master', database=database)
+
+    def test_memory(self):
+        expected = ['qemux86', 'bsp-b', 'bsp-a']
+        self.assertEqual(self.load().get_machines('master'), expected)
+        self.assertEqual(self.load(':memory:').get_machines('master'), expected)
+
+    def test_changed(self):
+        # The database follows the changes of the index
+        index = self.load(':memory:')
+        self.assertEqual(index.get_machines('master'), ['qemux86', 'bsp-b', 'bsp-a'])
+        index.index[0]['machines'].append({ 'id' : 5, 'layerbranch' : 1, 'name' : 'qemuarm' })
+        self.assertEqual(index.get_machines('master'), ['qemux86', 'qemuarm', 'bsp-b', 'bsp-a'])
+
+    def test_directory(self):
+        dbdir = os.path.join(self.dir, 'db')
+        os.makedirs(dbdir)
+        index = self.load(dbdir)
+        self.assertEqual(index.get_machines('master'), ['qemux86', 'bsp-b', 'bsp-a'])
+        self.assertEqual(len(os.listdir(dbdir)), 1)
+
+        # The temporary database is removed once it is closed
+        index.database.close()
+        self.assertEqual(os.listdir(dbdir), [])
+
+    def test_existing(self):
+        # Another database in the directory is left alone
+        dbdir = os.path.join(self.dir, 'db')
+        os.makedirs(dbdir)
+        path = os.path.join(dbdir, 'other.sqlite')
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE objects (name TEXT)')
+        db.execute("INSERT INTO objects VALUES ('kept')")
+        db.commit()
+        db.close()
+
+        database = Layer_Index_DB(dbdir)
+        self.assertNotEqual(database.path, path)
+        database.close()
+
+        db = sqlite3.connect(path)
+        self.assertEqual(db.execute('SELECT name FROM objects').fetchall(), [('kept',)])
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# Tests of the layer resolution of setup (Setup.resolve_layers), against
+# the resolutions of the original implementation recorded in
+# data/resolver/resolve-*.json.  To record them again, from data/resolver:
+#   check_layer_resolver.py --branch master --record resolve-master.json wrlinux.json openembedded.json
+
+import os
+import sys
+import glob
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import check_layer_resolver
+
+from setup import Setup
+
+# setup sends stderr to its logger, give it back to unittest
+sys.stderr = sys.__stderr__
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'resolver')
+
+class TestLayerResolver(unittest.TestCase):
+    def check_recorded(self, path):
+        with open(path, 'r') as f:
+            record = json.load(f)
+
+        indexes = [ os.path.join(DATA_DIR, index) for index in record['indexes'] ]
+        setup = check_layer_resolver.load_setup(indexes, record['branch'], record['dl_layers'])
+        self.assertIsNotNone(setup)
+
+        (base, starts) = check_layer_resolver.get_starts(setup)
+        self.assertEqual([ name for (name, queue) in starts ], list(record['resolutions']))
+
+        for (name, queue) in starts:
+            with self.subTest(record=os.path.basename(path), start=name):
+                ((required, recommended), _) = check_layer_resolver.resolve(setup, Setup.resolve_layers, base, queue)
+                self.assertEqual(required, record['resolutions'][name]['required'])
+                self.assertEqual(recommended, record['resolutions'][name]['recommended'])
+
+    def test_recorded(self):
+        records = sorted(glob.glob(os.path.join(DATA_DIR, 'resolve-*.json')))
+        self.assertTrue(records)
+        for path in records:
+            self.check_recorded(path)
+
+if __name__ == '__main__':
+    unittest.main()
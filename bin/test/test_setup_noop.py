@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# Tests of the skipping of a rerun of setup (Setup.check_noop), when the
+# indexes or the mirror-index changed since the last run.
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import settings
+
+from layer_index import Layer_Index
+from setup import Setup
+
+# setup sends stderr to its logger, give it back to unittest
+sys.stderr = sys.__stderr__
+
+UPDATED = '2018-01-01T00:00:00+0000'
+
+INDEX = {
+    'branches' : [
+        { 'id' : 1, 'name' : 'master', 'bitbake_branch' : 'master', 'updated' : UPDATED },
+    ],
+    'layerItems' : [
+        { 'id' : 1, 'name' : 'openembedded-core', 'vcs_url' : 'git://git.example.com/openembedded-core', 'updated' : UPDATED },
+    ],
+    'layerBranches' : [
+        { 'id' : 1, 'layer' : 1, 'branch' : 1, 'collection' : 'core', 'actual_branch' : '', 'updated' : UPDATED },
+    ],
+}
+
+class TestNoop(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.indexfile = os.path.join(self.dir, 'index.json')
+        self.write_index('master')
+
+        self.setup = Setup()
+        self.setup.project_dir = os.path.join(self.dir, 'project')
+        self.setup.saved_run = os.path.join(self.setup.project_dir, 'config', 'saved_run.json')
+        os.makedirs(os.path.dirname(self.setup.saved_run))
+        self.setup.base_branch = 'master'
+        self.setup.run_args = { 'base_branch' : 'master' }
+
+        patcher = mock.patch.object(settings, 'NOOP_MAX_AGE', 600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_index(self, actual_branch):
+        index = json.loads(json.dumps(INDEX))
+        index['layerBranches'][0]['actual_branch'] = actual_branch
+        with open(self.indexfile, 'w') as f:
+            json.dump(index, f)
+
+    def load(self):
+        cfg = { 'DESCRIPTION' : 'test', 'TYPE' : 'restapi-files', 'URL' : self.indexfile,
+                'CACHE' : os.path.join(self.setup.project_dir, 'config', 'index-cache', 'test') }
+        self.setup.index = Layer_Index(indexcfg=[cfg], base_branch='master')
+
+    def git(self, path, *args):
+        cmd = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args)
+        subprocess.run(cmd, cwd=path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_unchanged(self):
+        self.load()
+        self.setup.save_run_state()
+        self.assertTrue(self.setup.check_noop())
+
+    def test_index_changed(self):
+        self.load()
+        self.setup.save_run_state()
+        self.write_index('next')
+        self.assertFalse(self.setup.check_noop())
+
+    def test_index_cache_changed(self):
+        # As when another project refreshed a shared index cache
+        self.load()
+        self.setup.save_run_state()
+        cache = os.path.join(self.setup.project_dir, 'config', 'index-cache', 'test.json')
+        with open(cache, 'a') as f:
+            f.write('\n')
+        self.assertFalse(self.setup.check_noop())
+
+    def test_too_old(self):
+        self.load()
+        self.setup.save_run_state()
+        with mock.patch.object(settings, 'NOOP_MAX_AGE', 0):
+            self.assertFalse(self.setup.check_noop())
+
+    @unittest.skipUnless(shutil.which('git'), 'git is needed for the mirror-index')
+    def test_mirror_index_changed(self):
+        remote = os.path.join(self.dir, 'remote-mirror-index')
+        os.makedirs(remote)
+        self.git(remote, 'init', '-q', '-b', 'master')
+        self.git(remote, 'commit', '-q', '--allow-empty', '-m', 'initial')
+        mirror = os.path.join(self.setup.project_dir, 'config', 'mirror-index')
+        self.git(self.dir, 'clone', '-q', remote, mirror)
+        self.setup.mirror_index_path = mirror
+        self.setup.mirror_index_url = remote
+
+        self.load()
+        self.setup.save_run_state()
+        self.assertTrue(self.setup.check_noop())
+
+        self.git(remote, 'commit', '-q', '--allow-empty', '-m', 'update')
+        self.assertFalse(self.setup.check_noop())
+
+    def test_mirror_index_unknown_origin(self):
+        # A windshare mirror-index can't be checked, the run isn't saved
+        self.setup.mirror_index_path = os.path.join(self.dir, 'mirror-index')
+        self.load()
+        self.setup.save_run_state()
+        self.assertFalse(os.path.exists(self.setup.saved_run))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016 Wind River Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+# Tests of utils_setup
+
+import os
+import sys
+import stat
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import utils_setup
+
+class TestTrace(unittest.TestCase):
+    def traced(self, cmd):
+        with utils_setup._trace_lock:
+            for c in reversed(utils_setup._trace):
+                if c['argv'] == cmd:
+                    return c
+        self.fail('%s was not traced' % cmd)
+
+    def test_output_bytes(self):
+        cmd = ['sh', '-c', 'printf 12345']
+        utils_setup.run(cmd, stdout=subprocess.PIPE)
+        self.assertEqual(self.traced(cmd)['output_bytes'], 5)
+
+    def test_output_bytes_with_stderr(self):
+        # communicate reads both pipes with os.read
+        cmd = ['sh', '-c', 'printf 1234567; printf err >&2']
+        p = utils_setup.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual((p.stdout, p.stderr), (b'1234567', b'err'))
+        self.assertEqual(self.traced(cmd)['output_bytes'], 7)
+        self.assertEqual(self.traced(cmd)['returncode'], 0)
+
+    def test_output_bytes_read(self):
+        cmd = ['sh', '-c', 'echo 123; echo 456']
+        p = utils_setup.Popen(cmd, stdout=subprocess.PIPE)
+        lines = p.stdout.readlines()
+        p.stdout.close()
+        p.wait()
+        self.assertEqual(lines, [b'123\n', b'456\n'])
+        self.assertEqual(self.traced(cmd)['output_bytes'], 8)
+
+class TestWriteIfChanged(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def set_old_mtime(self):
+        os.utime(self.path, (1000000000, 1000000000))
+
+    def test_missing(self):
+        self.assertTrue(utils_setup.write_if_changed(self.path, 'content'))
+        self.assertEqual(self.read(), b'content')
+        # Nothing but the file is left in the directory
+        self.assertEqual(os.listdir(self.dir), ['file'])
+
+    def test_unchanged(self):
+        utils_setup.write_if_changed(self.path, b'content')
+        self.set_old_mtime()
+        self.assertFalse(utils_setup.write_if_changed(self.path, 'content'))
+        self.assertEqual(os.stat(self.path).st_mtime, 1000000000)
+        self.assertEqual(os.listdir(self.dir), ['file'])
+
+    def test_changed(self):
+        utils_setup.write_if_changed(self.path, 'content')
+        self.set_old_mtime()
+        # Same size, different content
+        self.assertTrue(utils_setup.write_if_changed(self.path, 'CONTENT'))
+        self.assertEqual(self.read(), b'CONTENT')
+        self.assertNotEqual(os.stat(self.path).st_mtime, 1000000000)
+        self.assertTrue(utils_setup.write_if_changed(self.path, 'longer content'))
+        self.assertEqual(self.read(), b'longer content')
+        self.assertEqual(os.listdir(self.dir), ['file'])
+
+    def test_chunks(self):
+        chunks = [ '%d,' % i for i in range(200000) ]
+        self.assertTrue(utils_setup.write_if_changed(self.path, iter(chunks)))
+        self.assertEqual(self.read(), ''.join(chunks).encode('utf-8'))
+        self.assertFalse(utils_setup.write_if_changed(self.path, iter(chunks)))
+        self.assertTrue(utils_setup.write_if_changed(self.path, [ b'a' * utils_setup.WRITE_BLOCK_SIZE, b'b' ]))
+        self.assertEqual(self.read(), b'a' * utils_setup.WRITE_BLOCK_SIZE + b'b')
+
+    def test_mode(self):
+        utils_setup.write_if_changed(self.path, 'content')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o666 & ~utils_setup._umask)
+
+        os.remove(self.path)
+        utils_setup.write_if_changed(self.path, 'content', mode=0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600 & ~utils_setup._umask)
+
+        # An existing file keeps its permissions
+        os.chmod(self.path, 0o640)
+        utils_setup.write_if_changed(self.path, 'changed', mode=0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+
+    def test_error(self):
+        def chunks():
+            yield 'partial'
+            raise ValueError('failed')
+        utils_setup.write_if_changed(self.path, 'content')
+        with self.assertRaises(ValueError):
+            utils_setup.write_if_changed(self.path, chunks())
+        self.assertEqual(self.read(), b'content')
+        self.assertEqual(os.listdir(self.dir), ['file'])
+
+    def test_copy(self):
+        src = os.path.join(self.dir, 'src')
+        with open(src, 'w') as f:
+            f.write('source')
+        self.assertTrue(utils_setup.copy_if_changed(src, self.path))
+        self.assertEqual(self.read(), b'source')
+        self.assertFalse(utils_setup.copy_if_changed(src, self.path))
+
+        # Into a directory, keeping the name
+        os.mkdir(os.path.join(self.dir, 'dst'))
+        self.assertTrue(utils_setup.copy_if_changed(src, os.path.join(self.dir, 'dst')))
+        with open(os.path.join(self.dir, 'dst', 'src'), 'rb') as f:
+            self.assertEqual(f.read(), b'source')
+
+if __name__ == '__main__':
+    unittest.main()
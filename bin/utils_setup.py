@@ -17,15 +17,187 @@
 
 import os
 import sys
+import selectors
 import subprocess
+import threading
+import time
+
+import hashlib
+import json
+import tempfile
+
+from collections import deque
 
 # Setup-specific modules
 import logger_setup
 
 logger = logger_setup.setup_logging()
 
+# Commands run through run_cmd, run and Popen, see trace_cmd and start_tracing
+_trace_lock = threading.Lock()
+_trace = []
+_trace_start = time.time()
+_trace_path = None
+_trace_summary = False
+
+# Number of commands in the slowest commands summary
+TRACE_TOP = 5
+
+# Record a command that ran from start to end (time.time() values)
+def trace_cmd(cmd, cwd, start, end, returncode, output_bytes=None):
+    if isinstance(cmd, (str, bytes)):
+        argv = [os.fsdecode(cmd)]
+    else:
+        argv = [os.fsdecode(arg) for arg in cmd]
+    with _trace_lock:
+        _trace.append({ 'argv' : argv, 'cwd' : cwd and os.fsdecode(cwd), 'start' : start, 'end' : end,
+                        'returncode' : returncode, 'output_bytes' : output_bytes, 'tid' : threading.get_ident() })
+
+# Write the recorded commands to path (as Chrome trace-event json, see
+# chrome://tracing) when the program exits, and log the slowest ones.  The
+# summary goes to the console if summary is set, otherwise to the log file.
+# A later call replaces the path and summary of an earlier one.
+def start_tracing(path, summary=False):
+    global _trace_path
+    global _trace_summary
+
+    if not _trace_path:
+        import atexit
+        atexit.register(_write_trace)
+    _trace_path = path
+    _trace_summary = summary
+
+def _write_trace():
+    with _trace_lock:
+        commands = list(_trace)
+
+    events = []
+    for c in commands:
+        name = ' '.join([os.path.basename(c['argv'][0])] + c['argv'][1:2])
+        events.append({ 'name' : name, 'cat' : 'cmd', 'ph' : 'X', 'pid' : os.getpid(), 'tid' : c['tid'],
+                        'ts' : int((c['start'] - _trace_start) * 1000000), 'dur' : int((c['end'] - c['start']) * 1000000),
+                        'args' : { 'argv' : c['argv'], 'cwd' : c['cwd'], 'returncode' : c['returncode'], 'output_bytes' : c['output_bytes'] } })
+
+    try:
+        dir = os.path.dirname(_trace_path)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        write_if_changed(_trace_path, json.dumps({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, indent=1))
+    except OSError as e:
+        logger.warning('Unable to write %s: %s' % (_trace_path, e))
+        return
+
+    log = [logger.debug, logger.plain][_trace_summary]
+    log('Wrote %d command(s) to %s' % (len(commands), _trace_path))
+    if commands:
+        log('Slowest commands:')
+        for c in sorted(commands, key=lambda c: c['start'] - c['end'])[:TRACE_TOP]:
+            log('  %8.2fs %s%s' % (c['end'] - c['start'], ' '.join(c['argv']), ['', ' (in %s)' % c['cwd']][c['cwd'] is not None]))
+
+class _CountingReader():
+    """
+        Wraps the stdout pipe of a Popen, counting the bytes read from it.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.count += len(data or b'')
+        return data
+
+    def readline(self, *args):
+        data = self.f.readline(*args)
+        self.count += len(data or b'')
+        return data
+
+    def read1(self, *args):
+        data = self.f.read1(*args)
+        self.count += len(data or b'')
+        return data
+
+    def readlines(self, *args):
+        lines = self.f.readlines(*args)
+        self.count += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        for line in self.f:
+            self.count += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+class Popen(subprocess.Popen):
+    """
+        subprocess.Popen that records the command (see trace_cmd) once it
+        has exited.  The bytes read from stdout are counted if it is a pipe.
+    """
+    def __init__(self, args, **kwargs):
+        self.trace_start = time.time()
+        self.trace_cwd = kwargs.get('cwd')
+        self.traced = False
+        self.trace_held = False
+        super().__init__(args, **kwargs)
+        if self.stdout:
+            self.stdout = _CountingReader(self.stdout)
+
+    def __trace(self):
+        if self.returncode is not None and not self.traced and not self.trace_held:
+            self.traced = True
+            trace_cmd(self.args, self.trace_cwd, self.trace_start, time.time(), self.returncode, self.stdout.count if self.stdout else None)
+
+    def communicate(self, input=None, timeout=None):
+        # With more than one pipe, communicate reads them with os.read,
+        # past the _CountingReader.  So it uses the pipe itself, and the
+        # output it returns is counted instead.  The command is recorded
+        # once that is done.
+        reader = self.stdout
+        if reader:
+            self.stdout = reader.f
+        self.trace_held = True
+        try:
+            (stdout, stderr) = super().communicate(input, timeout)
+        finally:
+            self.stdout = reader
+            self.trace_held = False
+        if reader and stdout:
+            reader.count += len(stdout)
+        self.__trace()
+        return (stdout, stderr)
+
+    def poll(self):
+        ret = super().poll()
+        self.__trace()
+        return ret
+
+    def wait(self, timeout=None):
+        ret = super().wait(timeout)
+        self.__trace()
+        return ret
+
+# subprocess.run, with the command recorded (see Popen)
+def run(cmd, check=False, **kwargs):
+    with Popen(cmd, **kwargs) as proc:
+        (stdout, stderr) = proc.communicate()
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+# Size of the chunks read from the output of run_cmd commands
+RUN_CMD_CHUNK_SIZE = 64 * 1024
+
+# Number of output lines (after the first error line) kept for the
+# exception raised by run_cmd
+RUN_CMD_ERR_LINES = 100
+
 def run_cmd(cmd, environment=None, cwd=None, log=1, expected_ret=0, err=b'GitError', err2=b'error', err3=b'fatal', stderr=None, stdout=None):
-    err_msg = []
+    # The first error line of the output, and the (last) lines after it
+    err_first = None
+    err_msg = deque(maxlen=RUN_CMD_ERR_LINES)
+    err_dropped = 0
 
     logger.debug('Running cmd: "%s"' % repr(cmd))
     if cwd:
@@ -38,22 +210,48 @@ def run_cmd(cmd, environment=None, cwd=None, log=1, expected_ret=0, err=b'GitErr
         if stderr is None:
             stderr = subprocess.STDOUT
 
-        ret = subprocess.Popen(cmd, env=environment, cwd=cwd, stderr=stderr, stdout=subprocess.PIPE)
-        while True:
-            output = ret.stdout.readline()
-            if not output and ret.poll() is not None:
-                break
-            if output:
-                output = output.strip()
-                if len(err_msg) > 0 or output.startswith(err) or output.startswith(err2) or output.startswith(err3):
-                    err_msg.append("%s" % output.decode('utf-8'))
-                if log == 1:
-                    logger.plain("%s" % output.decode('utf-8'))
-                elif log == 2:
-                    logger.debug("%s" % output.decode('utf-8'))
+        ret = Popen(cmd, env=environment, cwd=cwd, stderr=stderr, stdout=subprocess.PIPE)
+
+        def process(line):
+            nonlocal err_first
+            nonlocal err_dropped
+
+            output = line.strip()
+            text = output.decode('utf-8', errors='replace')
+            if err_first is not None:
+                if len(err_msg) == err_msg.maxlen:
+                    err_dropped += 1
+                err_msg.append(text)
+            elif output.startswith(err) or output.startswith(err2) or output.startswith(err3):
+                err_first = text
+            if log == 1:
+                logger.plain("%s" % text, extra=logger_setup.CMD_OUTPUT)
+            elif log == 2:
+                logger.debug("%s" % text)
+
+        # Read the output in large chunks, as it becomes available.  If
+        # the command is quiet for a while, say how much of its output was
+        # not shown (see logger_setup.CMD_OUTPUT_RATE).
+        partial = b''
+        with selectors.DefaultSelector() as selector:
+            selector.register(ret.stdout, selectors.EVENT_READ)
+            while True:
+                if not selector.select(timeout=1):
+                    logger_setup.show_suppressed()
+                    continue
+                chunk = ret.stdout.read1(RUN_CMD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    process(line)
+        if partial:
+            process(partial)
+        logger_setup.show_suppressed()
     else:
         logger.debug('output not logged for this command (%s) without verbose flag (-v).' % (cmd))
-        ret = subprocess.Popen(cmd, env=environment, cwd=cwd, close_fds=True, stderr=stderr, stdout=stdout)
+        ret = Popen(cmd, env=environment, cwd=cwd, close_fds=True, stderr=stderr, stdout=stdout)
 
     ret.wait()
     if ret.returncode != expected_ret:
@@ -71,7 +269,12 @@ def run_cmd(cmd, environment=None, cwd=None, log=1, expected_ret=0, err=b'GitErr
             if cwd:
                 msg += cwd + ': '
             msg += " ".join(cmd) + '\n'
-            msg += '\n'.join(err_msg)
+            lines = []
+            if err_first is not None:
+                lines.append(err_first)
+            if err_dropped:
+                lines.append('... %d line(s) not shown ...' % err_dropped)
+            msg += '\n'.join(lines + list(err_msg))
             msg += '\n'
         raise Exception(msg)
     logger.debug('Finished running cmd: "%s"' % repr(cmd))
@@ -102,7 +305,7 @@ def query_input(question, interactive):
         if 'PYTHONHOME' in environ:
             del environ['PYTHONHOME']
 
-        ret = subprocess.Popen(cmd, env=environ, close_fds=True, stdout=subprocess.PIPE)
+        ret = Popen(cmd, env=environ, close_fds=True, stdout=subprocess.PIPE)
         retval = ""
         while True:
             lin = ret.stdout.readline()
@@ -117,47 +320,491 @@ def query_input(question, interactive):
     return retval
 
 
-def fetch_url(url=None, auth=False, debuglevel=0, interactive=0):
+# The umask, read once when this module is loaded, before any threads are
+# started: reading it means setting it, for the whole process.
+_umask = os.umask(0)
+os.umask(_umask)
+
+# Size of the blocks write_if_changed reads and writes (and hashes) at once,
+# and the number of small chunks of the data joined into one block
+WRITE_BLOCK_SIZE = 1024 * 1024
+WRITE_BLOCK_CHUNKS = 64 * 1024
+
+# Write data to path, unless path already has exactly that content.  data is
+# a str or bytes, or an iterable of them (such as json.JSONEncoder.iterencode)
+# which is written as it is produced, without building the whole content.
+# The file is replaced atomically, so readers never see a partial file, and
+# an unchanged file keeps its mtime.  A new file is created with mode (less
+# the umask), an existing one keeps its permissions.  Returns True if path
+# was written.
+def write_if_changed(path, data, mode=0o666):
+    if isinstance(data, (str, bytes)):
+        data = [data]
+
+    if os.path.exists(path):
+        perms = os.stat(path).st_mode & 0o7777
+    else:
+        # Same permissions open() would have used
+        perms = mode & ~_umask
+
+    # The content is written to a temporary file, and hashed on the way
+    (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.%s.' % os.path.basename(path))
+    try:
+        digest = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), perms)
+
+            # The (usually small) chunks are joined into blocks first
+            pending = []
+
+            def flush():
+                nonlocal size
+                if pending:
+                    block = pending[0][:0].join(pending)
+                    if isinstance(block, str):
+                        block = block.encode('utf-8')
+                    f.write(block)
+                    digest.update(block)
+                    size += len(block)
+                    pending.clear()
+
+            for chunk in data:
+                pending.append(chunk)
+                if len(pending) >= WRITE_BLOCK_CHUNKS or len(chunk) >= WRITE_BLOCK_SIZE:
+                    flush()
+            flush()
+
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            existing = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(WRITE_BLOCK_SIZE), b''):
+                    existing.update(block)
+            if existing.digest() == digest.digest():
+                logger.debug('%s is unchanged' % path)
+                os.remove(tmppath)
+                return False
+
+        os.replace(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    logger.debug('Wrote %s' % path)
+    return True
+
+# Copy src to dst (a file or directory, like shutil.copy) with
+# write_if_changed.  Returns True if the destination was written.
+def copy_if_changed(src, dst):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    with open(src, 'rb') as f:
+        return write_if_changed(dst, iter(lambda: f.read(WRITE_BLOCK_SIZE), b''))
+
+# Return a digest of the names and contents of the files in paths
+# (relative to base).  Directories are walked, and a missing path is
+# recorded as missing, so removing a file changes the digest too.
+def digest_paths(paths, base=''):
+    digest = hashlib.sha256()
+
+    def add_file(fpath):
+        digest.update(os.path.relpath(fpath, base or '.').encode('utf-8') + b'\0')
+        if os.path.islink(fpath):
+            digest.update(b'L' + os.readlink(fpath).encode('utf-8') + b'\0')
+            return
+        with open(fpath, 'rb') as f:
+            data = f.read()
+        digest.update(b'F%d\0' % len(data) + data)
+
+    for path in paths:
+        path = os.path.join(base, path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    add_file(os.path.join(dirpath, filename))
+        elif os.path.lexists(path):
+            add_file(path)
+        else:
+            digest.update(os.path.relpath(path, base or '.').encode('utf-8') + b'\0-\0')
+
+    return digest.hexdigest()
+
+# Environment variable that enables profiling (see start_profiling) in setup
+# and the mirror tools: 'cpu' for cProfile, 'memory' for cProfile and
+# tracemalloc.
+PROFILE_ENV = 'SETUP_PROFILE'
+PROFILE_MODES = ['cpu', 'memory']
+
+# Number of entries in the allocation report
+PROFILE_TOP = 25
+
+# Profile the rest of this run with cProfile, and tracemalloc if mode is
+# 'memory'.  When the program exits the reports are written to log_dir as
+# <name>-<time>.pstats and <name>-<time>.memory.txt, and the commands run
+# are traced to <name>-<time>.trace.json.  Nothing is done if mode is not
+# set.
+def start_profiling(log_dir, name, mode):
+    if not mode:
+        return
+    if mode not in PROFILE_MODES:
+        logger.warning('Unknown profile mode %s, expected one of: %s' % (mode, ', '.join(PROFILE_MODES)))
+        return
+
+    import atexit
+    import cProfile
+    import time
+    import tracemalloc
+
+    prefix = os.path.join(log_dir, '%s-%s' % (name, time.strftime('%Y-%m-%d-%H:%M:%S+0000', time.gmtime())))
+
+    if mode == 'memory':
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    start_tracing(prefix + '.trace.json', summary=True)
+
+    def write_reports():
+        profiler.disable()
+        os.makedirs(log_dir, exist_ok=True)
+        profiler.dump_stats(prefix + '.pstats')
+        logger.plain('Wrote profile %s.pstats' % prefix)
+
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(prefix + '.memory.txt', 'w') as f:
+                f.write('Current %d bytes, peak %d bytes\n' % (current, peak))
+                f.write('Top %d allocations:\n' % PROFILE_TOP)
+                for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                    f.write('%s\n' % stat)
+            logger.plain('Wrote allocation report %s.memory.txt' % prefix)
+
+    atexit.register(write_reports)
+
+# fetch_url may be called from several threads at once, only ask for the
+# credentials of each server once.
+_auth_lock = threading.Lock()
+_auth_cache = {}
+
+# Idle HTTP(S) connections, kept open so later requests to the same server
+# (or through the same proxy) skip the TCP and TLS setup.
+#   (scheme, host, port, proxy host, proxy port) -> [connections]
+_pool_lock = threading.Lock()
+_pool = {}
+
+# Maximum idle connections kept per server
+_POOL_SIZE = 8
+
+# Maximum redirects followed for a single request
+_MAX_REDIRECTS = 10
+
+# Size of the compressed chunks read from a response
+_CHUNK_SIZE = 64 * 1024
+
+# Number of requests made by fetch_url and the bytes read from the HTTP(S)
+# responses (after decompression), reported in the run profile of setup
+fetch_stats = { 'requests' : 0, 'bytes' : 0 }
+_fetch_stats_lock = threading.Lock()
+
+class _PooledResponse():
+    """
+        Response of a pooled HTTP(S) request.  Like the urllib response it
+        replaces it is file-like (read), and has geturl, info and getcode.
+        The connection goes back to the pool once the body has been read,
+        or right away if there is no body.
+
+        A gzip or deflate Content-Encoding is decompressed as the body is
+        read, so read() always returns the plain body.
+    """
+    def __init__(self, response, url, release):
+        import zlib
+
+        self.response = response
+        self.url = url
+        self.release = release
+        self.headers = response.headers
+        self.status = response.status
+        self.code = response.status
+        self.reason = response.reason
+
+        self.encoding = (response.getheader('Content-Encoding') or 'identity').strip().lower()
+        self.decompressor = None
+        self.inflated = False
+        self.buffer = b''
+        if self.encoding in ['gzip', 'x-gzip']:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+
+        # A response without a body (304, 204 or Content-Length: 0) is
+        # already complete, so the connection goes back to the pool now.
+        if response.length == 0:
+            response.read()
+            if self.release:
+                self.release()
+                self.release = None
+
+    def __inflate(self, chunk):
+        import zlib
+
+        first = not self.inflated
+        self.inflated = True
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error:
+            # Some servers send raw deflate data, without the zlib header
+            if self.encoding != 'deflate' or not first:
+                raise
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompressor.decompress(chunk)
+
+    def __decompress(self, amt):
+        chunks = [self.buffer]
+        size = len(self.buffer)
+        while amt is None or size < amt:
+            chunk = self.response.read(_CHUNK_SIZE)
+            if not chunk:
+                chunks.append(self.decompressor.flush())
+                break
+            chunk = self.__inflate(chunk)
+            chunks.append(chunk)
+            size += len(chunk)
+
+        data = b''.join(chunks)
+        if amt is None:
+            self.buffer = b''
+        else:
+            self.buffer = data[amt:]
+            data = data[:amt]
+        return data
+
+    def read(self, amt=None):
+        if self.decompressor:
+            data = self.__decompress(amt)
+        else:
+            data = self.response.read(amt)
+        with _fetch_stats_lock:
+            fetch_stats['bytes'] += len(data)
+        if self.response.isclosed() and self.release:
+            self.release()
+            self.release = None
+        return data
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        # Closing before the body was read leaves the connection in an
+        # unknown state, so it is not returned to the pool.
+        self.response.close()
+        self.release = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _basic_auth(uname, passwd):
+    import base64
+    return 'Basic %s' % base64.b64encode(('%s:%s' % (uname, passwd)).encode('utf-8')).decode('ascii')
+
+def _http_connection(up):
+    """
+        Returns the pool key, the connection (from the pool or new), if it was
+        reused, the request path and any extra headers for the url up
+        (urlparse result).  The environment proxy settings are honoured the
+        same way urllib does.
+    """
+    import http.client
+    from urllib.parse import urlparse
+    from urllib.request import getproxies, proxy_bypass
+
+    host = up.hostname
+    port = up.port or [http.client.HTTP_PORT, http.client.HTTPS_PORT][up.scheme == 'https']
+
+    path = up.path or '/'
+    if up.query:
+        path += '?' + up.query
+
+    headers = {}
+    tunnel_headers = {}
+    phost = None
+    pport = None
+    proxy = getproxies().get(up.scheme)
+    if proxy and not proxy_bypass(up.netloc.rsplit('@', 1)[-1]):
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        pp = urlparse(proxy)
+        phost = pp.hostname
+        pport = pp.port or [http.client.HTTP_PORT, http.client.HTTPS_PORT][pp.scheme == 'https']
+        if pp.username:
+            from urllib.parse import unquote
+            tunnel_headers['Proxy-Authorization'] = _basic_auth(unquote(pp.username), unquote(pp.password or ''))
+        if up.scheme == 'http':
+            # Plain http goes through the proxy as a full url
+            path = '%s://%s%s' % (up.scheme, up.netloc.rsplit('@', 1)[-1], path)
+            headers.update(tunnel_headers)
+
+    key = (up.scheme, host, port, phost, pport)
+    with _pool_lock:
+        if _pool.get(key):
+            return (key, _pool[key].pop(), True, path, headers)
+
+    if up.scheme == 'https' and phost:
+        conn = http.client.HTTPSConnection(phost, pport)
+        conn.set_tunnel(host, port, headers=tunnel_headers)
+    elif up.scheme == 'https':
+        conn = http.client.HTTPSConnection(host, port)
+    elif phost:
+        conn = http.client.HTTPConnection(phost, pport)
+    else:
+        conn = http.client.HTTPConnection(host, port)
+    return (key, conn, False, path, headers)
+
+def _http_release(key, conn):
+    with _pool_lock:
+        conns = _pool.setdefault(key, [])
+        if len(conns) < _POOL_SIZE:
+            conns.append(conn)
+            return
+    conn.close()
+
+def _http_open(url, headers, credentials, debuglevel):
+    """
+        GET url over a pooled, persistent HTTP(S) connection, following
+        redirects.  gzip and deflate transfers are accepted.  Errors (other than 304) are raised as urllib.error.HTTPError and URLError,
+        the same as urllib would.  credentials, (username, password), are
+        sent as Basic authentication to the server of url.
+    """
+    import io
+    import http.client
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urljoin, urlparse
+
+    netloc = urlparse(url).netloc
+    for redirect in range(_MAX_REDIRECTS + 1):
+        up = urlparse(url)
+
+        req_headers = dict(headers)
+        req_headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if credentials and up.netloc == netloc:
+            req_headers['Authorization'] = _basic_auth(credentials[0], credentials[1])
+
+        while True:
+            (key, conn, reused, path, extra_headers) = _http_connection(up)
+            req_headers.update(extra_headers)
+            conn.set_debuglevel(debuglevel)
+            try:
+                conn.request('GET', path, headers=req_headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused:
+                    # The server closed the idle connection, try a new one
+                    logger.debug("%s: connection closed by the server, reconnecting..." % url)
+                    continue
+                raise URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise URLError(e)
+            break
+
+        def release(key=key, conn=conn):
+            _http_release(key, conn)
+
+        if response.status in [301, 302, 303, 307, 308] and response.getheader('Location'):
+            response.read()
+            release()
+            logger.debug("%s: redirected (%s) to %s" % (url, response.status, response.getheader('Location')))
+            url = urljoin(url, response.getheader('Location'))
+            continue
+
+        if not 200 <= response.status < 300 and response.status != 304:
+            body = _PooledResponse(response, url, None).read()
+            release()
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+        return _PooledResponse(response, url, release)
+
+    raise HTTPError(url, response.status, "The HTTP server returned a redirect error that would lead to an infinite loop.", response.headers, None)
+
+# headers are any additional request headers.  For http(s) a 304 (Not
+# Modified) response to a conditional request is returned, not raised.
+def fetch_url(url=None, auth=False, debuglevel=0, interactive=0, headers=None):
     assert url is not None
 
     import urllib
-    from urllib.request import urlopen, Request
+    from urllib.request import Request
     from urllib.parse import urlparse
 
+    up = urlparse(url)
+
     if auth:
         logger.debug("Configuring authentication for %s..." % url)
 
-        up = urlparse(url)
-
-        uname = query_input("Username for '%s://%s': " % (up.scheme, up.netloc), interactive)
-        passwd = query_input("Password for '%s://%s@%s': " % (up.scheme, uname, up.netloc), interactive)
+        with _auth_lock:
+            if (up.scheme, up.netloc) not in _auth_cache:
+                uname = query_input("Username for '%s://%s': " % (up.scheme, up.netloc), interactive)
+                passwd = query_input("Password for '%s://%s@%s': " % (up.scheme, uname, up.netloc), interactive)
+                _auth_cache[(up.scheme, up.netloc)] = (uname, passwd)
+            credentials = _auth_cache[(up.scheme, up.netloc)]
+        (uname, passwd) = credentials
 
         # This is a security leak, as the username/password could be logged.
         # Only enable this during development.
         #logger.debug("%s: u:'%s' p:'%s'" % ( url, uname, passwd ))
-
-        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        password_mgr.add_password(None, "%s://%s" % (up.scheme, up.netloc), uname, passwd)
-        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-        opener = urllib.request.build_opener(handler, urllib.request.HTTPSHandler(debuglevel=debuglevel))
     else:
-        opener = urllib.request.build_opener(urllib.request.HTTPSHandler(debuglevel=debuglevel))
-
-    urllib.request.install_opener(opener)
+        # Reuse the credentials of an earlier authenticated request, this
+        # saves the round trip for the 401.
+        with _auth_lock:
+            credentials = _auth_cache.get((up.scheme, up.netloc))
+        if credentials:
+            (uname, passwd) = credentials
 
     logger.debug("Fetching %s (%s)..." % (url, ["without authentication", "with authentication"][auth]))
+    with _fetch_stats_lock:
+        fetch_stats['requests'] += 1
+
+    req_headers = {'User-Agent': 'Mozilla/5.0 (Wind River Linux/setup.sh)'}
+    if headers:
+        req_headers.update(headers)
 
     try:
-        res = urlopen(Request(url, headers={'User-Agent': 'Mozilla/5.0 (Wind River Linux/setup.sh)'}, unverifiable=True))
+        if up.scheme in ['http', 'https']:
+            res = _http_open(url, req_headers, credentials, debuglevel)
+        else:
+            # Anything else (file, ftp...) is left to urllib
+            handlers = [urllib.request.HTTPSHandler(debuglevel=debuglevel)]
+            if credentials:
+                password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+                password_mgr.add_password(None, "%s://%s" % (up.scheme, up.netloc), uname, passwd)
+                handlers.append(urllib.request.HTTPBasicAuthHandler(password_mgr))
+            opener = urllib.request.build_opener(*handlers)
+            res = opener.open(Request(url, headers=req_headers, unverifiable=True))
     except urllib.error.HTTPError as e:
         logger.debug("HTTP Error: %s: %s" % (e.code, e.reason))
         logger.debug(" Requested: %s" % (url))
         logger.debug(" Actual:    %s" % (e.geturl()))
-        if auth:
+        if credentials:
             logger.debug(" Authentication enabled.  Using username '%s'." % uname)
+            if e.code == 401:
+                # Ask again next time
+                with _auth_lock:
+                    _auth_cache.pop((up.scheme, up.netloc), None)
         if not auth and e.code == 401:
             logger.debug("Retrying with authentication...")
-            res = fetch_url(url, auth=True, debuglevel=debuglevel, interactive=interactive)
+            res = fetch_url(url, auth=True, debuglevel=debuglevel, interactive=interactive, headers=headers)
             logger.debug("...retrying with authentication successful, continuing.")
         elif e.code == 404:
             logger.debug("Request not found.")
@@ -212,7 +212,7 @@ class Windshare():
     def write_local_mirror_index(self, setup, mirror_index_path):
         import subprocess
 
-        # We need access to the sortRestApi function...
+        # We need access to the canonical_json function...
         from layer_index import Layer_Index
         li = Layer_Index()
 
@@ -235,18 +235,17 @@ class Windshare():
                     logger.debug('ws mirror-index remove obsolete %s' % os.path.join(dirpath, filename))
                     os.remove(os.path.join(dirpath, filename))
 
+        # Only files whose contents changed are rewritten
         for entry in self.indexes:
             logger.debug('Writing windshare index %s...' % entry)
             fpath = os.path.join(mirror_index_path, entry)
-            json.dump(li.sortRestApi(self.indexes[entry]), open(fpath, 'wt'), indent=4)
+            utils_setup.write_if_changed(fpath, li.iter_canonical_json(self.indexes[entry]))
 
         for entry in self.xmls:
             logger.debug('Writing windshare xml %s...' % entry)
             os.makedirs(os.path.join(mirror_index_path, 'xml'), exist_ok=True)
             fpath = os.path.join(mirror_index_path, 'xml', entry)
-            with open(fpath, 'wt') as fout:
-                for _line in self.xmls[entry]:
-                    fout.write(_line + '\n')
+            utils_setup.write_if_changed(fpath, ''.join(_line + '\n' for _line in self.xmls[entry]))
 
         cmd = [setup.tools['git'], 'add', '-A', '.']
         utils_setup.run_cmd(cmd, log=2, environment=setup.env, cwd=mirror_index_path)